@@ -0,0 +1,276 @@
+#######################################################################
+## The following code is free to use for the general public.
+## The author makes no promises and provides no warranty.
+## This code is meant to be a starting point for others to use.
+#######################################################################
+'''
+Persistent response cache for deterministic chat requests.
+
+When the sampling is pinned (temperature 0, top_k 1 or a fixed seed), sending
+the same GenericChatRequest to the same model returns the same answer, so there
+is no need to pay for the inference again.  CachedChatClient sits in front of
+GenerativeAiInferenceClient.chat and looks the request up by a canonical hash of
+the serving mode (model id), the sampling parameters and the full message list.
+
+Entries are kept in a SQLite file with an in-process LRU layer on top, and are
+evicted by entry count and age (TTL).  Hit and miss counters are kept on the
+cache.
+
+Usage:
+    cache = ResponseCache("~/.oci/genai_chat_cache.sqlite", ttl_seconds=7*24*3600)
+    client = CachedChatClient(generative_ai_inference_client, cache)
+    result = client.chat(chat_details)   # same call as the inference client
+'''
+import collections
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import oci
+
+
+## access times of memory hits written to SQLite at once
+_TOUCH_BATCH = 100
+
+## request fields that do not change the generated answer
+_KEY_IGNORED_FIELDS = ("compartmentId", "isStream", "streamOptions")
+
+
+class ResponseCache(object):
+    '''
+    SQLite backed key/value cache with an in-memory LRU layer
+    REQUIRES:
+      path(str) - location of the SQLite file (":memory:" for a process-only cache)
+    KWARGS:
+      max_entries(int) - entries kept on disk, least recently used are evicted first
+      ttl_seconds(float) - age after which an entry is no longer served (None keeps entries forever)
+      memory_entries(int) - entries kept in the in-process LRU
+    '''
+
+    def __init__(self, path, max_entries=100000, ttl_seconds=None, memory_entries=1024):
+        self.path = path if path == ":memory:" else os.path.expanduser(path)
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.memory_entries = memory_entries
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._memory = collections.OrderedDict()
+        ## key -> last memory hit not yet written to accessed_at, flushed in batches and before evicting
+        self._touched = {}
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self._connection.commit()
+        self._count = self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def _expired(self, created_at, now):
+        return self.ttl_seconds is not None and now - created_at > self.ttl_seconds
+
+    def get(self, key):
+        '''
+        Returns the cached value for key, or None on a miss
+        '''
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and not self._expired(entry[1], now):
+                self._memory.move_to_end(key)
+                self._touched[key] = now
+                if len(self._touched) >= _TOUCH_BATCH:
+                    self._flush_touched()
+                    self._connection.commit()
+                self.hits += 1
+                return entry[0]
+
+            row = self._connection.execute(
+                "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or self._expired(row[1], now):
+                if row is not None:
+                    self._delete(key)
+                self._memory.pop(key, None)
+                self.misses += 1
+                return None
+
+            self._connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self._connection.commit()
+            self._remember(key, row[0], row[1])
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, value):
+        '''
+        Stores value (str) under key and evicts the least recently used entries if over max_entries
+        '''
+        now = time.time()
+        with self._lock:
+            existed = self._connection.execute("SELECT 1 FROM responses WHERE key = ?", (key,)).fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now, now)
+            )
+            if not existed:
+                self._count += 1
+            self._remember(key, value, now)
+
+            if self._count > self.max_entries:
+                ## the entries served from memory are recently used too
+                self._flush_touched()
+                over = self._count - self.max_entries
+                evicted = self._connection.execute(
+                    "SELECT key FROM responses ORDER BY accessed_at LIMIT ?", (over,)
+                ).fetchall()
+                for (evicted_key,) in evicted:
+                    self._delete(evicted_key)
+            self._connection.commit()
+
+    def _flush_touched(self):
+        if self._touched:
+            self._connection.executemany(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?",
+                [(accessed_at, key) for key, accessed_at in self._touched.items()]
+            )
+            self._touched.clear()
+
+    def _remember(self, key, value, created_at):
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _delete(self, key):
+        if self._connection.execute("DELETE FROM responses WHERE key = ?", (key,)).rowcount:
+            self._count -= 1
+            self.evictions += 1
+        self._memory.pop(key, None)
+        self._touched.pop(key, None)
+
+    def purge_expired(self):
+        '''
+        Deletes every entry older than the TTL, returns the number deleted
+        '''
+        if self.ttl_seconds is None:
+            return 0
+        with self._lock:
+            cutoff = time.time() - self.ttl_seconds
+            deleted = self._connection.execute("DELETE FROM responses WHERE created_at < ?", (cutoff,)).rowcount
+            self._connection.commit()
+            self._count -= deleted
+            self.evictions += deleted
+            self._memory = collections.OrderedDict(
+                (key, entry) for key, entry in self._memory.items() if entry[1] >= cutoff
+            )
+            return deleted
+
+    def clear(self):
+        '''
+        Deletes every entry
+        '''
+        with self._lock:
+            self._connection.execute("DELETE FROM responses")
+            self._connection.commit()
+            self._memory.clear()
+            self._touched.clear()
+            self._count = 0
+
+    def stats(self):
+        '''
+        Returns the hit/miss counters and the number of entries
+        '''
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else None,
+            "evictions": self.evictions,
+            "entries": self._count,
+            "memory_entries": len(self._memory),
+        }
+
+    def close(self):
+        with self._lock:
+            self._flush_touched()
+            self._connection.commit()
+            self._connection.close()
+
+    def __len__(self):
+        return self._count
+
+
+def is_deterministic(chat_request):
+    '''
+    Returns True if the chat request always produces the same answer
+    REQUIRES:
+      chat_request(GenericChatRequest) - the request to check
+    '''
+    if chat_request.is_stream:
+        return False
+    if chat_request.seed is not None:
+        return True
+    return chat_request.temperature == 0 or chat_request.top_k == 1
+
+
+class CachedChatClient(object):
+    '''
+    Wraps a GenerativeAiInferenceClient so deterministic chat calls are served from a ResponseCache
+    REQUIRES:
+      client(GenerativeAiInferenceClient) - the client used on a cache miss
+      cache(ResponseCache) - where the responses are kept
+    KWARGS:
+      only_deterministic(bool) - if False, every non-streaming request is cached
+    '''
+
+    def __init__(self, client, cache, only_deterministic=True):
+        self.client = client
+        self.cache = cache
+        self.only_deterministic = only_deterministic
+
+    def cache_key(self, chat_details):
+        '''
+        Returns the canonical hash of the model, sampling parameters and messages of a request
+        '''
+        serialized = self.client.base_client.sanitize_for_serialization(chat_details)
+        serialized.pop("compartmentId", None)
+        request = dict(serialized.get("chatRequest") or {})
+        for field in _KEY_IGNORED_FIELDS:
+            request.pop(field, None)
+        serialized["chatRequest"] = request
+        canonical = json.dumps(serialized, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def chat(self, chat_details, **kwargs):
+        '''
+        Same as GenerativeAiInferenceClient.chat, answered from the cache when possible.
+        Cached responses have the "opc-cache" header set to "hit".
+        '''
+        chat_request = chat_details.chat_request
+        if chat_request.is_stream or (self.only_deterministic and not is_deterministic(chat_request)):
+            return self.client.chat(chat_details, **kwargs)
+
+        key = self.cache_key(chat_details)
+        cached = self.cache.get(key)
+        if cached is not None:
+            data = self.client.base_client.deserialize_response_data(cached.encode("utf-8"), "ChatResult")
+            return oci.response.Response(200, {"opc-cache": "hit"}, data, None)
+
+        response = self.client.chat(chat_details, **kwargs)
+        self.cache.put(key, json.dumps(self.client.base_client.sanitize_for_serialization(response.data)))
+        return response
+
+    def __getattr__(self, name):
+        ## everything else goes straight to the wrapped client
+        return getattr(self.client, name)
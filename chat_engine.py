@@ -0,0 +1,477 @@
+#######################################################################
+## The following code is free to use for the general public.
+## The author makes no promises and provides no warranty.
+## This code is meant to be a starting point for others to use.
+#######################################################################
+'''
+Asyncio chat engine that serves many independent conversations at once.
+
+llama3_oci_chat.py and rag_agent_chat.py are single user loops.  ChatEngine
+hosts any number of sessions behind one event loop, for example behind a web
+front end:
+    - LLM sessions keep their own ChatHistory and talk to the inference model
+    - agent sessions keep their own agent session_id and talk to a GenAI agent
+
+All sessions share one client per service with a connection pool sized for the
+engine, and the blocking SDK calls run on a bounded thread pool, so a slow 240
+second read only holds one worker and never blocks the event loop or the other
+sessions.
+
+Each session processes its turns in order and accepts at most max_pending
+turns at a time (backpressure).  Session.cancel() abandons the running and
+queued turns, their callers get TurnCancelledError; cancelled turns are not
+added to the history.  Closing an agent session (or the engine) deletes its
+agent session on the endpoint.
+
+Usage:
+    engine = ChatEngine(config, agent_endpoint_id="ocid1.genaiagentendpoint...")
+    session = engine.open_chat_session()
+    reply = await session.send("Hello")
+    async for text in session.stream("Tell me more"):
+        print(text, end="")
+    await engine.close()
+'''
+import asyncio
+import concurrent.futures
+import itertools
+import json
+import threading
+import time
+
+import oci
+
+import llama3_oci_chat
+import rag_agent_chat
+from chat_history import ChatHistory, make_text_message
+from oci_instrumentation import instrument_client
+from oci_transport import configure_connection_pool
+
+
+class SessionBusyError(Exception):
+    '''
+    Raised when a session already has max_pending turns and the caller asked not to wait
+    '''
+
+
+class SessionClosedError(Exception):
+    '''
+    Raised when a turn is sent to a session that has been closed
+    '''
+
+
+class TurnCancelledError(Exception):
+    '''
+    Raised to the caller of a turn that Session.cancel() or close() abandoned
+    '''
+
+
+def _is_cancelling():
+    ## True when the running task itself is being cancelled, not only a turn it awaits
+    task = asyncio.current_task()
+    cancelling = getattr(task, "cancelling", None)
+    return bool(cancelling and cancelling())
+
+
+class _Session(object):
+    '''
+    Ordering, backpressure and cancellation shared by the session types
+    '''
+
+    def __init__(self, engine, session_key, max_pending):
+        self.engine = engine
+        self.session_key = session_key
+        self.max_pending = max_pending
+        self.closed = False
+        self.last_used = time.monotonic()
+
+        ## bounds the turns waiting on this session, the turn lock keeps them in order
+        self._slots = asyncio.Semaphore(max_pending)
+        self._turn_lock = asyncio.Lock()
+        self._tasks = set()
+        self._cancel_event = None
+
+    @property
+    def pending(self):
+        '''
+        Number of turns running or waiting on this session
+        '''
+        return len(self._tasks)
+
+    def _start_turn(self, function, wait=True):
+        ## every turn runs as its own task, so cancel() and close() never cancel the caller
+        return asyncio.ensure_future(self._run_turn(function, wait=wait))
+
+    async def _wait_turn(self, turn_task):
+        try:
+            return await turn_task
+        except asyncio.CancelledError:
+            ## a caller cancelled itself takes its turn with it, any other cancel was the session's
+            if turn_task.cancelled() and not _is_cancelling():
+                raise TurnCancelledError(self.session_key)
+            raise
+
+    async def _run_turn(self, function, wait=True):
+        if self.closed:
+            raise SessionClosedError(self.session_key)
+        if not wait and self._slots.locked():
+            raise SessionBusyError(self.session_key)
+
+        task = asyncio.current_task()
+        async with self._slots:
+            self._tasks.add(task)
+            try:
+                async with self._turn_lock:
+                    ## a fresh event per turn, so a cancelled turn's thread never sees it cleared
+                    self._cancel_event = threading.Event()
+                    self.last_used = time.monotonic()
+                    return await function(self._cancel_event)
+            finally:
+                self._tasks.discard(task)
+
+    def cancel(self):
+        '''
+        Cancels the running turn and every turn waiting on this session
+        '''
+        ## the worker thread of a streamed turn stops reading at the next event
+        if self._cancel_event is not None:
+            self._cancel_event.set()
+        for task in list(self._tasks):
+            task.cancel()
+
+    def close(self):
+        '''
+        Cancels the pending turns and refuses new ones
+        '''
+        self.closed = True
+        self.cancel()
+
+
+class ChatSession(_Session):
+    '''
+    A conversation with the inference model, created by ChatEngine.open_chat_session
+    '''
+
+    def __init__(self, engine, session_key, max_pending, history):
+        super(ChatSession, self).__init__(engine, session_key, max_pending)
+        self.history = history
+
+    def _chat_details(self, user_message, is_stream):
+        ## each turn gets its own request model since the client is shared across threads
+        chat_request = llama3_oci_chat.get_chat_request(is_stream=is_stream)
+        chat_request.messages = self.history.messages() + [user_message]
+        return llama3_oci_chat.get_chat_details(self.engine.config, chat_request)
+
+    async def send(self, text, wait=True):
+        '''
+        Sends a user message and returns the reply text
+        REQUIRES:
+          text(str) - the user message
+        KWARGS:
+          wait(bool) - if False, raise SessionBusyError instead of waiting for a free slot
+        RETURNS:
+          str - the assistant reply
+        '''
+        user_message = make_text_message("USER", text)
+
+        async def turn(cancel_event):
+            chat_details = self._chat_details(user_message, is_stream=False)
+            result = await self.engine.run_blocking(self.engine.inference_client.chat, chat_details)
+            response_message = result.data.chat_response.choices[0].message
+            ## only completed turns become part of the conversation
+            self.history.append(user_message)
+            self.history.append(response_message)
+            return response_message.content[0].text
+
+        return await self._wait_turn(self._start_turn(turn, wait=wait))
+
+    async def stream(self, text, wait=True):
+        '''
+        Sends a user message and yields the reply text as it is generated
+        REQUIRES:
+          text(str) - the user message
+        KWARGS:
+          wait(bool) - if False, raise SessionBusyError instead of waiting for a free slot
+        YIELDS:
+          str - pieces of the assistant reply
+        '''
+        user_message = make_text_message("USER", text)
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue()
+        done = object()
+        turn_events = []
+
+        def read_events(cancel_event):
+            ## runs on a worker thread, hands every piece of text to the event loop
+            pieces = []
+            try:
+                chat_details = self._chat_details(user_message, is_stream=True)
+                result = self.engine.inference_client.chat(chat_details)
+                for event in result.data.events():
+                    if cancel_event.is_set():
+                        return None
+                    if not event.data or not event.data.strip().startswith("{"):
+                        continue
+                    for content in (json.loads(event.data).get("message") or {}).get("content") or []:
+                        if content.get("text"):
+                            pieces.append(content["text"])
+                            loop.call_soon_threadsafe(chunks.put_nowait, content["text"])
+                return "".join(pieces)
+            finally:
+                loop.call_soon_threadsafe(chunks.put_nowait, done)
+
+        async def turn(cancel_event):
+            turn_events.append(cancel_event)
+            reply = await self.engine.run_blocking(read_events, cancel_event)
+            if reply is not None:
+                self.history.append(user_message)
+                self.history.append(make_text_message("ASSISTANT", reply))
+            return reply
+
+        turn_task = self._start_turn(turn, wait=wait)
+        try:
+            while True:
+                getter = asyncio.ensure_future(chunks.get())
+                finished, _ = await asyncio.wait({getter, turn_task}, return_when=asyncio.FIRST_COMPLETED)
+                if getter not in finished:
+                    getter.cancel()
+                    ## the turn ended without producing more text (error, busy or cancelled)
+                    await self._wait_turn(turn_task)
+                    return
+                chunk = getter.result()
+                if chunk is done:
+                    await self._wait_turn(turn_task)
+                    return
+                yield chunk
+        finally:
+            ## the caller stopped reading, abandon the rest of the reply
+            if not turn_task.done():
+                turn_task.cancel()
+                for cancel_event in turn_events:
+                    cancel_event.set()
+
+
+class AgentSession(_Session):
+    '''
+    A conversation with a GenAI agent endpoint, created by ChatEngine.open_agent_session
+    '''
+
+    def __init__(self, engine, session_key, max_pending, session_id):
+        super(AgentSession, self).__init__(engine, session_key, max_pending)
+        self.session_id = session_id
+
+    async def send(self, text, wait=True):
+        '''
+        Sends a user message to the agent and returns the reply text
+        REQUIRES:
+          text(str) - the user message
+        KWARGS:
+          wait(bool) - if False, raise SessionBusyError instead of waiting for a free slot
+        RETURNS:
+          str - the agent reply
+        '''
+        async def turn(cancel_event):
+            return await self.engine.run_blocking(
+                rag_agent_chat.chat_with_ai,
+                text,
+                self.engine.agent_endpoint_id,
+                self.engine.agent_runtime_client,
+                self.session_id
+            )
+
+        return await self._wait_turn(self._start_turn(turn, wait=wait))
+
+
+class ChatEngine(object):
+    '''
+    Hosts many chat and agent sessions on one event loop
+    REQUIRES:
+      config(dict) - valid OCI configuration
+    KWARGS:
+      max_workers(int) - blocking SDK calls that can run at the same time (also the connection pool size)
+      max_pending(int) - turns a session accepts before send() waits or raises SessionBusyError
+      history_token_budget(int) - token budget of the ChatHistory of each chat session
+      agent_endpoint_id(str) - OCID of the agent endpoint used by agent sessions
+      agent_runtime_endpoint(str) - agent runtime service endpoint
+      agent_endpoint(str) - agent (control plane) service endpoint
+    '''
+
+    def __init__(self, config, max_workers=64, max_pending=4, history_token_budget=6000,
+                 agent_endpoint_id=None, agent_runtime_endpoint=None, agent_endpoint=None):
+        self.config = config
+        self.max_pending = max_pending
+        self.history_token_budget = history_token_budget
+        self.agent_endpoint_id = agent_endpoint_id
+        self.agent_runtime_endpoint = agent_runtime_endpoint
+        self.agent_endpoint = agent_endpoint
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="chat-engine")
+        self._max_workers = max_workers
+        self._sessions = {}
+        ## keys of the agent sessions being opened
+        self._opening = set()
+        self._keys = itertools.count(1)
+        self._inference_client = None
+        self._agent_runtime_client = None
+        self._agent_client = None
+        self._agent_session_pool = None
+
+    @property
+    def inference_client(self):
+        '''
+        Inference client shared by every chat session
+        '''
+        if self._inference_client is None:
+            self._inference_client = configure_connection_pool(
+                llama3_oci_chat.get_client(self.config), self._max_workers
+            )
+        return self._inference_client
+
+    @property
+    def agent_runtime_client(self):
+        '''
+        Agent runtime client shared by every agent session
+        '''
+        if self._agent_runtime_client is None:
+            self._agent_runtime_client = configure_connection_pool(
+                instrument_client(oci.generative_ai_agent_runtime.GenerativeAiAgentRuntimeClient(
+                    self.config, service_endpoint=self.agent_runtime_endpoint
+                )),
+                self._max_workers
+            )
+        return self._agent_runtime_client
+
+    @property
+    def agent_client(self):
+        '''
+        Agent control plane client used when agent sessions are opened
+        '''
+        if self._agent_client is None:
+            self._agent_client = instrument_client(oci.generative_ai_agent.GenerativeAiAgentClient(
+                self.config, service_endpoint=self.agent_endpoint
+            ))
+        return self._agent_client
+
+    @property
+    def agent_session_pool(self):
+        '''
+        Pre-created agent sessions handed to new agent sessions
+        '''
+        if self._agent_session_pool is None:
+            self._agent_session_pool = rag_agent_chat.AgentSessionPool(self.agent_runtime_client, self.agent_client)
+        return self._agent_session_pool
+
+    async def run_blocking(self, function, *args):
+        '''
+        Runs a blocking SDK call on the engine's worker threads
+        '''
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def _new_key(self, session_key):
+        if session_key is None:
+            session_key = "session-%d" % next(self._keys)
+        if session_key in self._sessions or session_key in self._opening:
+            raise ValueError("session " + str(session_key) + " already exists")
+        return session_key
+
+    def open_chat_session(self, session_key=None, system_prompt=None, summarize=False):
+        '''
+        Starts a conversation with the inference model
+        KWARGS:
+          session_key(str) - key to find the session by, generated if not provided
+          system_prompt(str) - pinned preamble of the conversation
+          summarize(bool) - fold evicted turns into a summary message
+        RETURNS:
+          ChatSession
+        '''
+        session_key = self._new_key(session_key)
+        history = ChatHistory(token_budget=self.history_token_budget, summarize=summarize)
+        if system_prompt:
+            history.pin(make_text_message("SYSTEM", system_prompt))
+        session = ChatSession(self, session_key, self.max_pending, history)
+        self._sessions[session_key] = session
+        return session
+
+    async def open_agent_session(self, session_key=None, display_name=None, description=None):
+        '''
+        Starts a conversation with the agent endpoint, creating an agent session if the endpoint uses them
+        KWARGS:
+          session_key(str) - key to find the session by, generated if not provided
+          display_name(str) - display name of the agent session
+          description(str) - description of the agent session
+                             Sessions without a display name or description come from the session pool
+        RETURNS:
+          AgentSession
+        '''
+        session_key = self._new_key(session_key)
+        ## hold the key while the agent session is created, so a second open with it fails
+        self._opening.add(session_key)
+        try:
+            if display_name or description:
+                session_id = await self.run_blocking(
+                    rag_agent_chat.get_session,
+                    self.agent_endpoint_id,
+                    self.agent_runtime_client,
+                    self.agent_client,
+                    display_name,
+                    description
+                )
+            else:
+                session_id = await self.run_blocking(self.agent_session_pool.acquire, self.agent_endpoint_id)
+        finally:
+            self._opening.discard(session_key)
+        session = AgentSession(self, session_key, self.max_pending, session_id)
+        self._sessions[session_key] = session
+        return session
+
+    def get_session(self, session_key):
+        '''
+        Returns the session with the given key, or None
+        '''
+        return self._sessions.get(session_key)
+
+    def _delete_agent_session(self, session_id):
+        ## do not leave the agent session open on the endpoint until it times out
+        try:
+            self.agent_runtime_client.delete_session(self.agent_endpoint_id, session_id)
+        except Exception as e:
+            print("Failed to delete agent session " + str(session_id) + ": " + str(e))
+
+    def close_session(self, session_key):
+        '''
+        Cancels the pending turns of a session and forgets it, the agent session is deleted in the background
+        '''
+        session = self._sessions.pop(session_key, None)
+        if session is not None:
+            session.close()
+            if getattr(session, "session_id", None) is not None:
+                self._executor.submit(self._delete_agent_session, session.session_id)
+
+    def close_idle_sessions(self, idle_seconds):
+        '''
+        Closes the sessions that have not been used for idle_seconds, returns how many were closed
+        '''
+        now = time.monotonic()
+        idle = [key for key, session in self._sessions.items()
+                if not session.pending and now - session.last_used > idle_seconds]
+        for key in idle:
+            self.close_session(key)
+        return len(idle)
+
+    def stats(self):
+        '''
+        Returns the number of sessions and the turns they have pending
+        '''
+        return {
+            "sessions": len(self._sessions),
+            "pending_turns": sum(session.pending for session in self._sessions.values()),
+        }
+
+    async def close(self):
+        '''
+        Closes every session, waits for their agent sessions to be deleted and shuts down the worker threads
+        '''
+        for key in list(self._sessions):
+            self.close_session(key)
+        if self._agent_session_pool is not None:
+            await self.run_blocking(self._agent_session_pool.close)
+        await asyncio.get_running_loop().run_in_executor(None, self._executor.shutdown)
@@ -0,0 +1,196 @@
+#######################################################################
+## The following code is free to use for the general public.
+## The author makes no promises and provides no warranty.
+## This code is meant to be a starting point for others to use.
+#######################################################################
+'''
+Token-budgeted conversation history for the generic chat API.
+
+Instead of appending every message to chat_request.messages forever, keep the
+conversation in a ChatHistory.  It tracks a running token estimate per message
+and, once the budget is exceeded, evicts the oldest turns (a USER message and
+the replies that followed it) so each request carries a bounded payload.
+Pinned messages (system prompt / preamble) are never evicted.  Optionally the
+evicted turns are folded into a single summary message.
+
+Usage:
+    history = ChatHistory(token_budget=6000)
+    history.pin(system_message)
+    history.append(user_message)
+    chat_request.messages = history.messages()
+'''
+import collections
+
+import oci
+
+
+## rough number of characters per token for the llama family
+CHARS_PER_TOKEN = 4
+## fixed cost of a message (role markers, separators) in the prompt template
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(message):
+    '''
+    Estimates the number of prompt tokens a message will use
+    REQUIRES:
+      message(oci.generative_ai_inference.models.Message) - message to measure
+    RETURNS:
+      int - estimated token count
+    '''
+    characters = 0
+    for content in message.content or []:
+        characters += len(getattr(content, "text", None) or "")
+    return MESSAGE_OVERHEAD_TOKENS + -(-characters // CHARS_PER_TOKEN)
+
+
+def message_text(message):
+    '''
+    Returns the text of a message, joining all of its text contents
+    '''
+    return "".join(getattr(content, "text", None) or "" for content in message.content or [])
+
+
+def make_text_message(role, text):
+    '''
+    Builds a generic chat message with a single text content
+    REQUIRES:
+      role(str) - USER, ASSISTANT or SYSTEM
+      text(str) - text of the message
+    RETURNS:
+      oci.generative_ai_inference.models.Message
+    '''
+    content = oci.generative_ai_inference.models.TextContent()
+    content.text = text
+    message = oci.generative_ai_inference.models.Message()
+    message.role = role
+    message.content = [content]
+    return message
+
+
+def truncate_summarizer(evicted_messages, previous_summary, max_tokens):
+    '''
+    Default summarizer: keeps the opening of every evicted message.
+    It runs locally so it does not add a model call to the turn.
+    REQUIRES:
+      evicted_messages(list) - messages that were just evicted, oldest first
+      previous_summary(str) - summary text so far, or None
+      max_tokens(int) - token size the summary should stay under
+    RETURNS:
+      str - new summary text
+    '''
+    lines = [previous_summary] if previous_summary else []
+    for message in evicted_messages:
+        text = " ".join(message_text(message).split())
+        if len(text) > 200:
+            text = text[:200] + "..."
+        lines.append(str(message.role).lower() + ": " + text)
+
+    ## drop the oldest lines until the summary fits
+    max_characters = max_tokens * CHARS_PER_TOKEN
+    summary = "\n".join(lines)
+    while len(summary) > max_characters and len(lines) > 1:
+        lines.pop(0)
+        summary = "\n".join(lines)
+    return summary[-max_characters:]
+
+
+class ChatHistory(object):
+    '''
+    Conversation history with a token budget and sliding-window eviction
+    KWARGS:
+      token_budget(int) - maximum estimated prompt tokens sent per request
+      summarize(bool) - replace evicted turns with a single summary message
+      summary_tokens(int) - token budget reserved for the summary message
+      summarizer(callable) - summarizer(evicted_messages, previous_summary, max_tokens) -> str
+                             If not provided, truncate_summarizer is used
+    '''
+
+    def __init__(self, token_budget=6000, summarize=False, summary_tokens=500, summarizer=None):
+        self.token_budget = token_budget
+        self.summarize = summarize
+        self.summary_tokens = summary_tokens
+        self.summarizer = summarizer or truncate_summarizer
+
+        self._pinned = []
+        self._pinned_tokens = 0
+        ## each turn is [tokens, [messages]] - kept as a deque so eviction is O(1)
+        self._turns = collections.deque()
+        self._window_tokens = 0
+        self._summary = None
+        self._summary_message = None
+        self.evicted_messages = 0
+
+    def pin(self, message):
+        '''
+        Adds a message that is always sent first and never evicted (system prompt, preamble)
+        '''
+        self._pinned.append(message)
+        self._pinned_tokens += estimate_tokens(message)
+
+    def append(self, message):
+        '''
+        Adds a message to the conversation and evicts old turns if over budget.
+        A USER message starts a new turn, anything else joins the current turn.
+        '''
+        tokens = estimate_tokens(message)
+        if message.role == "USER" or not self._turns:
+            self._turns.append([tokens, [message]])
+        else:
+            turn = self._turns[-1]
+            turn[0] += tokens
+            turn[1].append(message)
+        self._window_tokens += tokens
+        self._enforce_budget()
+
+    def _enforce_budget(self):
+        available = self.token_budget - self._pinned_tokens
+        if self.summarize:
+            available -= self.summary_tokens
+
+        evicted = []
+        ## always keep the newest turn, even if it alone is over budget
+        while self._window_tokens > available and len(self._turns) > 1:
+            tokens, messages = self._turns.popleft()
+            self._window_tokens -= tokens
+            evicted.extend(messages)
+
+        if evicted:
+            self.evicted_messages += len(evicted)
+            if self.summarize:
+                self._summary = self.summarizer(evicted, self._summary, self.summary_tokens)
+                self._summary_message = make_text_message(
+                    "SYSTEM", "Summary of the earlier conversation:\n" + self._summary
+                )
+
+    def messages(self):
+        '''
+        Returns the list of messages to send: pinned, summary (if any), then the recent turns
+        '''
+        result = list(self._pinned)
+        if self._summary_message is not None:
+            result.append(self._summary_message)
+        for _, messages in self._turns:
+            result.extend(messages)
+        return result
+
+    def token_estimate(self):
+        '''
+        Returns the estimated prompt tokens of messages()
+        '''
+        total = self._pinned_tokens + self._window_tokens
+        if self._summary_message is not None:
+            total += estimate_tokens(self._summary_message)
+        return total
+
+    def clear(self):
+        '''
+        Drops the conversation but keeps the pinned messages
+        '''
+        self._turns.clear()
+        self._window_tokens = 0
+        self._summary = None
+        self._summary_message = None
+
+    def __len__(self):
+        return len(self._pinned) + sum(len(messages) for _, messages in self._turns)
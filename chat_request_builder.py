@@ -0,0 +1,192 @@
+#######################################################################
+## The following code is free to use for the general public.
+## The author makes no promises and provides no warranty.
+## This code is meant to be a starting point for others to use.
+#######################################################################
+'''
+Incremental request bodies for multi-turn chat.
+
+Every turn of a conversation sends the whole history again.  Passed to
+client.chat as models, the SDK walks and serializes every message of the
+history on every turn, so the client cost of a turn grows with the length of
+the conversation.  ChatRequestBuilder serializes each message once, keeps the
+JSON of the messages already sent and only serializes the messages added since
+the last turn.  The body goes to the client already serialized.
+
+With compress=True the body is also gzip compressed (Content-Encoding: gzip).
+The compressor is kept between turns, so only the new messages are compressed,
+and the history compresses well since the replies are sent back verbatim.  Only
+use it with endpoints that accept compressed request bodies.
+
+The service is stateless, so the full history is still sent on every turn.  On
+a dedicated AI cluster endpoint (DedicatedServingMode, see endpoint_id in
+llama3_oci_chat.py) the unchanged start of the prompt can be served from the
+prefix cache, which cuts the prefill time of long conversations.
+
+Messages are treated as immutable once sent (ChatHistory never changes one):
+build a new message instead of editing the text of a message already sent.
+One builder per conversation, it is not thread-safe.
+
+Usage:
+    builder = ChatRequestBuilder(generative_ai_inference_client)
+    chat_request.messages = history.messages()
+    result = builder.chat(chat_details)
+'''
+import copy
+import json
+import threading
+import zlib
+
+
+## stands in for the message list while the rest of the body is serialized
+_MESSAGES_MARKER = "\u0000messages\u0000"
+
+## gzip container for zlib
+_GZIP_WBITS = 31
+
+## headers added to the calls of this thread, client.chat has no argument for them
+_request_headers = threading.local()
+
+
+def _dumps(value):
+    return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+
+def _add_request_headers(base_client):
+    ## wraps call_api once per client, client.chat (retries, instrumentation) stays the entry point
+    if getattr(base_client, "_request_headers_added", False):
+        return
+    call_api = base_client.call_api
+
+    def call_api_with_headers(*args, **kwargs):
+        headers = getattr(_request_headers, "headers", None)
+        if headers:
+            kwargs["header_params"] = dict(kwargs.get("header_params") or {}, **headers)
+        return call_api(*args, **kwargs)
+    base_client.call_api = call_api_with_headers
+    base_client._request_headers_added = True
+
+
+class ChatRequestBuilder(object):
+    '''
+    Builds the chat request bodies of one conversation, serializing every message only once
+    REQUIRES:
+      client(oci.generative_ai_inference.GenerativeAiInferenceClient) - client the requests are sent with
+    KWARGS:
+      compress(bool) - send the body gzip compressed
+      compression_level(int) - zlib level, 1 (fastest) to 9 (smallest)
+    '''
+
+    def __init__(self, client, compress=False, compression_level=6):
+        self.client = client
+        self.compress = compress
+        self.compression_level = compression_level
+
+        ## sizes of the last body and the messages serialized for it
+        self.body_bytes = 0
+        self.wire_bytes = 0
+        self.serialized_messages = 0
+
+        ## id(message) -> (message, JSON), only for the messages of the last body
+        self._encoded = {}
+        ## the body up to the last message sent, and those messages in order
+        self._head = None
+        self._sent = []
+        self._prefix = bytearray()
+        self._prefix_bytes = 0
+        self._compressor = None
+        self._compressed = bytearray()
+        if compress:
+            _add_request_headers(client.base_client)
+
+    def _encode(self, message):
+        entry = self._encoded.get(id(message))
+        if entry is None or entry[0] is not message:
+            entry = (message, _dumps(self.client.base_client.sanitize_for_serialization(message)))
+            self.serialized_messages += 1
+        return entry
+
+    def _frame(self, chat_details):
+        ## everything but the messages, a fixed cost per turn
+        chat_request = copy.copy(chat_details.chat_request)
+        chat_request.messages = []
+        details = copy.copy(chat_details)
+        details.chat_request = chat_request
+        frame = self.client.base_client.sanitize_for_serialization(details)
+        frame["chatRequest"]["messages"] = _MESSAGES_MARKER
+        head, tail = _dumps(frame).split(_dumps(_MESSAGES_MARKER))
+        return head + b"[", b"]" + tail
+
+    def _restart(self, head):
+        self._head = head
+        self._sent = []
+        self._prefix_bytes = len(head)
+        if self.compress:
+            self._prefix = bytearray()
+            self._compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, _GZIP_WBITS)
+            self._compressed = bytearray(self._compressor.compress(head))
+        else:
+            self._prefix = bytearray(head)
+
+    def build(self, chat_details):
+        '''
+        Builds the request body for chat_details.chat_request.messages
+        REQUIRES:
+          chat_details(oci.generative_ai_inference.models.ChatDetails) - chat details with the messages to send
+        RETURNS:
+          bytes - the JSON body, gzip compressed when compress is set
+        '''
+        head, tail = self._frame(chat_details)
+        messages = chat_details.chat_request.messages or []
+        self.serialized_messages = 0
+        encoded = dict((id(message), self._encode(message)) for message in messages)
+        self._encoded = encoded
+
+        ## keep building on the last body while its messages still start the conversation,
+        ## start over when the history evicted a turn or the serving mode changed
+        if (head != self._head or len(self._sent) > len(messages)
+                or any(sent is not message for sent, message in zip(self._sent, messages))):
+            self._restart(head)
+
+        new_messages = messages[len(self._sent):]
+        for message in new_messages:
+            piece = (b"," if self._sent else b"") + encoded[id(message)][1]
+            self._prefix_bytes += len(piece)
+            if self.compress:
+                self._compressed += self._compressor.compress(piece)
+            else:
+                self._prefix += piece
+            self._sent.append(message)
+
+        self.body_bytes = self._prefix_bytes + len(tail)
+        if not self.compress:
+            body = bytes(self._prefix) + tail
+        else:
+            if new_messages:
+                self._compressed += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+            ## finish a copy, the compressor carries on with the next turn
+            finisher = self._compressor.copy()
+            body = bytes(self._compressed) + finisher.compress(tail) + finisher.flush()
+        self.wire_bytes = len(body)
+        return body
+
+    def chat(self, chat_details, **kwargs):
+        '''
+        Sends chat_details, same as client.chat(chat_details, **kwargs)
+        REQUIRES:
+          chat_details(oci.generative_ai_inference.models.ChatDetails) - chat details with the messages to send
+        KWARGS:
+          the optional arguments of client.chat (retry_strategy, opc_request_id, ...)
+        RETURNS:
+          oci.response.Response - the chat result, or the server-sent events when streaming
+        '''
+        body = self.build(chat_details)
+        if not self.compress:
+            return self.client.chat(body, **kwargs)
+
+        ## same call as uncompressed, the header is added on the way to call_api
+        _request_headers.headers = {"content-encoding": "gzip"}
+        try:
+            return self.client.chat(body, **kwargs)
+        finally:
+            _request_headers.headers = None
@@ -0,0 +1,290 @@
+#######################################################################
+## The following code is free to use for the general public.
+## The author makes no promises and provides no warranty.
+## This code is meant to be a starting point for others to use.
+#######################################################################
+'''
+Routing and hedged requests over several inference targets.
+
+llama3_oci_chat.py sends every turn to one model on one endpoint, so a slow or
+throttled model makes the user wait up to the read timeout.  ChatRouter takes
+an ordered list of (service endpoint, model id) targets, for example the same
+model in two regions or a second model as a fallback, and:
+    - keeps the latency and the outcome of the last calls of each target
+    - sends each request to the fastest healthy target; targets without
+      enough calls yet are tried first, in the order given
+    - takes a target out of rotation for cooldown_seconds when it is throttled
+      or too many of its last calls failed, and fails over to the next target
+      on throttling, server and connection errors
+    - with hedge=True, sends a duplicate of the request to the next target when
+      the first has not answered after its p95 latency, and keeps whichever
+      answers first
+
+Latency is the time until chat returns: the full answer, or the start of the
+server-sent events of a streaming request.  A hedged duplicate costs the
+tokens of a second request, and is only sent for the calls slower than the
+p95 of their target (no hedging until a target has min_samples calls).
+
+The model id of a target can also be the OCID of a dedicated AI cluster
+endpoint (DedicatedServingMode).  The serving mode of the chat details sent
+to the router is replaced by the one of the target.
+
+Usage:
+    router = ChatRouter(config, [
+        ("https://inference.generativeai.us-chicago-1.oci.oraclecloud.com", chicago_model_id),
+        ("https://inference.generativeai.eu-frankfurt-1.oci.oraclecloud.com", frankfurt_model_id),
+    ], hedge=True)
+    result = router.chat(chat_details)   # same call as the inference client
+    print(result.headers["opc-route-target"], router.stats())
+'''
+import collections
+import concurrent.futures
+import copy
+import math
+import threading
+import time
+
+import oci
+
+import llama3_oci_chat
+from oci_retry import is_retryable, is_throttled
+
+
+## model ids with this prefix are dedicated AI cluster endpoints
+_DEDICATED_ENDPOINT_PREFIX = "ocid1.generativeaiendpoint."
+
+
+def _percentile(samples, percent):
+    ## nearest rank
+    ordered = sorted(samples)
+    return ordered[max(0, int(math.ceil(percent / 100.0 * len(ordered))) - 1)]
+
+
+def _serving_mode(model_id):
+    if model_id.startswith(_DEDICATED_ENDPOINT_PREFIX):
+        return oci.generative_ai_inference.models.DedicatedServingMode(endpoint_id=model_id)
+    return oci.generative_ai_inference.models.OnDemandServingMode(model_id=model_id)
+
+
+def _discard(future):
+    ## the losing call of a hedged request, release its connection once it answers
+    if future.cancelled() or future.exception() is not None:
+        return
+    close = getattr(future.result().data, "close", None)
+    if close:
+        close()
+
+
+class _Target(object):
+    '''
+    Client, serving mode and rolling stats of one (endpoint, model id) target
+    '''
+
+    def __init__(self, name, client, serving_mode, window):
+        self.name = name
+        self.client = client
+        self.serving_mode = serving_mode
+        ## seconds of the last successful calls, and the outcome of the last calls (True for a success)
+        self.latencies = collections.deque(maxlen=window)
+        self.outcomes = collections.deque(maxlen=window)
+        self.unhealthy_until = 0.0
+        self.calls = 0
+        self.errors = 0
+        self.hedges = 0
+        self.wins = 0
+
+
+class ChatRouter(object):
+    '''
+    Sends chat requests to the fastest healthy of several (endpoint, model id) targets
+    REQUIRES:
+      config(dict) - valid OCI configuration
+      targets(list) - (service endpoint, model id) tuples, in order of preference
+    KWARGS:
+      hedge(bool) - send a duplicate to the next target when the first is slower than its p95
+      window(int) - calls of each target the latency and error rate are computed on
+      min_samples(int) - calls a target needs before its latency and error rate are trusted
+      max_error_rate(float) - share of failed calls in the window that takes a target out of rotation
+      cooldown_seconds(float) - how long a throttled or failing target is left out
+      hedge_min_delay(float) - hedged duplicates are never sent sooner than this many seconds
+      max_workers(int) - calls in flight at the same time when hedging
+    '''
+
+    def __init__(self, config, targets, hedge=False, window=50, min_samples=5, max_error_rate=0.5,
+                 cooldown_seconds=30, hedge_min_delay=0.2, max_workers=16):
+        if not targets:
+            raise Exception("at least one target is needed")
+        self.hedge = hedge
+        self.min_samples = min_samples
+        self.max_error_rate = max_error_rate
+        self.cooldown_seconds = cooldown_seconds
+        self.hedge_min_delay = hedge_min_delay
+
+        ## one client (and connection pool) per endpoint, shared by the models it serves
+        clients = {}
+        self.targets = []
+        for service_endpoint, model_id in targets:
+            if service_endpoint not in clients:
+                clients[service_endpoint] = llama3_oci_chat.get_client(config, service_endpoint=service_endpoint)
+            self.targets.append(_Target(service_endpoint + " " + model_id, clients[service_endpoint],
+                                        _serving_mode(model_id), window))
+
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="chat-router") if hedge else None
+
+    def ranked(self):
+        '''
+        Returns the targets in the order they are tried: healthy targets, fastest (median) first,
+        then the targets still cooling down, the one back soonest first
+        '''
+        with self._lock:
+            now = time.monotonic()
+            healthy = [target for target in self.targets if target.unhealthy_until <= now]
+            cooling = sorted((target for target in self.targets if target.unhealthy_until > now),
+                             key=lambda target: target.unhealthy_until)
+            ## sorted is stable, targets still short of samples (0) keep the order given
+            healthy.sort(key=lambda target: _percentile(target.latencies, 50) if len(target.latencies) >= self.min_samples else 0.0)
+        return healthy + cooling
+
+    def hedge_delay(self, target):
+        '''
+        Returns the seconds to wait on target before sending a duplicate, None before it has min_samples calls
+        '''
+        with self._lock:
+            if len(target.latencies) < self.min_samples:
+                return None
+            return max(self.hedge_min_delay, _percentile(target.latencies, 95))
+
+    def _record(self, target, seconds, error=None):
+        with self._lock:
+            target.calls += 1
+            if error is None:
+                target.latencies.append(seconds)
+                target.outcomes.append(True)
+                return
+            target.errors += 1
+            target.outcomes.append(False)
+            failed = target.outcomes.count(False)
+            if is_throttled(error) or (len(target.outcomes) >= self.min_samples
+                                       and failed >= self.max_error_rate * len(target.outcomes)):
+                target.unhealthy_until = time.monotonic() + self.cooldown_seconds
+
+    def _call(self, target, chat_details, kwargs):
+        details = copy.copy(chat_details)
+        details.serving_mode = target.serving_mode
+        start = time.perf_counter()
+        try:
+            response = target.client.chat(details, **kwargs)
+        except Exception as e:
+            ## errors of the request itself (400, 401, ...) say nothing about the target
+            if is_retryable(e):
+                self._record(target, time.perf_counter() - start, e)
+            raise
+        self._record(target, time.perf_counter() - start)
+        response.headers["opc-route-target"] = target.name
+        return response
+
+    def chat(self, chat_details, **kwargs):
+        '''
+        Same as GenerativeAiInferenceClient.chat, sent to the fastest healthy target.
+        The target that answered is in the "opc-route-target" header of the response.
+        REQUIRES:
+          chat_details(oci.generative_ai_inference.models.ChatDetails) - chat details, the serving mode is set per target
+        KWARGS:
+          the optional arguments of client.chat (opc_request_id, ...)
+        RETURNS:
+          oci.response.Response - the chat result, or the server-sent events when streaming
+        '''
+        ranked = self.ranked()
+        if self.hedge and len(ranked) > 1:
+            return self._hedged_chat(ranked, chat_details, kwargs)
+
+        ## fail over in order on throttling, server and connection errors
+        last_error = None
+        for target in ranked:
+            try:
+                return self._call(target, chat_details, kwargs)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                last_error = e
+        raise last_error
+
+    def _hedged_chat(self, ranked, chat_details, kwargs):
+        waiting = list(ranked)
+        ## future -> (target, True for a hedged duplicate)
+        futures = {}
+
+        def send(hedge):
+            target = waiting.pop(0)
+            if hedge:
+                with self._lock:
+                    target.hedges += 1
+            futures[self._executor.submit(self._call, target, chat_details, kwargs)] = (target, hedge)
+
+        send(False)
+        hedged = False
+        last_error = None
+        while futures:
+            ## only one duplicate per request, and only while a single call is in flight
+            timeout = None
+            if not hedged and waiting and len(futures) == 1:
+                timeout = self.hedge_delay(next(iter(futures.values()))[0])
+            done, _ = concurrent.futures.wait(futures, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+            if not done:
+                send(True)
+                hedged = True
+                continue
+
+            for future in done:
+                target, hedge = futures.pop(future)
+                try:
+                    response = future.result()
+                except Exception as e:
+                    last_error = e
+                    continue
+                if hedge:
+                    with self._lock:
+                        target.wins += 1
+                    response.headers["opc-route-hedged"] = "true"
+                for loser in futures:
+                    loser.add_done_callback(_discard)
+                return response
+
+            ## the request itself is wrong, the other targets would give the same answer
+            if not is_retryable(last_error):
+                break
+            ## fail over right away, unless a call is still in flight
+            if waiting and not futures:
+                send(False)
+
+        for loser in futures:
+            loser.add_done_callback(_discard)
+        raise last_error
+
+    def stats(self):
+        '''
+        Returns the calls, errors, latency percentiles and health of every target
+        '''
+        now = time.monotonic()
+        stats = collections.OrderedDict()
+        with self._lock:
+            for target in self.targets:
+                stats[target.name] = {
+                    "calls": target.calls,
+                    "errors": target.errors,
+                    "error_rate": (target.outcomes.count(False) / len(target.outcomes)) if target.outcomes else 0.0,
+                    "p50_seconds": _percentile(target.latencies, 50) if target.latencies else None,
+                    "p95_seconds": _percentile(target.latencies, 95) if target.latencies else None,
+                    "healthy": target.unhealthy_until <= now,
+                    "hedges": target.hedges,
+                    "hedge_wins": target.wins,
+                }
+        return stats
+
+    def close(self):
+        '''
+        Shuts down the hedging threads
+        '''
+        if self._executor is not None:
+            self._executor.shutdown()
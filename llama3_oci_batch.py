@@ -0,0 +1,273 @@
+#######################################################################
+## The following code is free to use for the general public.
+## The author makes no promises and provides no warranty.
+## This code is meant to be a starting point for others to use.
+#######################################################################
+'''
+Runs a file of prompts through the chat model used by llama3_oci_chat.py.
+
+Prompts are read from a JSONL file, one per line, either as
+    {"id": "q1", "prompt": "What is OCI?"}
+or with a full conversation
+    {"id": "q2", "messages": [{"role": "SYSTEM", "text": "..."}, {"role": "USER", "text": "..."}]}
+If "id" is missing, the line number is used.
+
+Requests are dispatched over a bounded thread pool.  Each worker thread keeps
+its own client and ChatDetails/GenericChatRequest template, the number of
+requests in flight and the requests per second are capped, and throttling
+(429) and server errors (5xx) are retried with jittered backoff.
+
+With --cache, deterministic requests (temperature 0, top_k 1 or a seed) are
+answered from a persistent ResponseCache when the same prompt was already run,
+which makes regression reruns nearly free.  The sampling of llama3_oci_chat.py
+is not deterministic, pin it with --temperature 0 or --seed for the cache to
+be used.
+
+Results are appended to the output JSONL in completion order and flushed
+after every line, so the output file doubles as the checkpoint: rerunning
+with the same output skips every id that already has a successful result.
+
+Usage:
+    python llama3_oci_batch.py prompts.jsonl results.jsonl --max-in-flight 16 --rps 10
+'''
+import argparse
+import concurrent.futures
+import json
+import os
+import threading
+import time
+
+import llama3_oci_chat
+from chat_cache import CachedChatClient, ResponseCache, is_deterministic
+from chat_history import make_text_message
+from oci_retry import RateLimiter, call_with_backoff
+
+
+## per worker thread client and request template
+_worker = threading.local()
+
+
+def read_prompts(input_path):
+    '''
+    Reads the prompt records from a JSONL file
+    REQUIRES:
+      input_path(str) - location of the prompts file
+    RETURNS:
+      generator of dict - {"id": str, "messages": [Message, ...]}
+    '''
+    with open(input_path) as input_file:
+        for line_number, line in enumerate(input_file, start=1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "messages" in record:
+                messages = [make_text_message(m.get("role", "USER").upper(), m["text"]) for m in record["messages"]]
+            else:
+                messages = [make_text_message("USER", record["prompt"])]
+            yield {"id": str(record.get("id", line_number)), "messages": messages}
+
+
+def load_completed(output_path):
+    '''
+    Reads the ids that already have a successful result in the output file
+    REQUIRES:
+      output_path(str) - location of the results file
+    RETURNS:
+      set of str
+    '''
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path) as output_file:
+        for line in output_file:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                ## a partially written line from a crashed run
+                continue
+            if not result.get("error"):
+                completed.add(result["id"])
+    return completed
+
+
+def trim_partial_line(output_path):
+    '''
+    Cuts a partially written last line (no trailing newline) from the results file,
+    so the next result is not appended onto it
+    REQUIRES:
+      output_path(str) - location of the results file
+    '''
+    if not os.path.exists(output_path):
+        return
+    with open(output_path, "rb+") as output_file:
+        output_file.seek(0, os.SEEK_END)
+        end = output_file.tell()
+        position = end
+        ## walk back to the last newline, a block at a time
+        while position > 0:
+            size = min(4096, position)
+            output_file.seek(position - size)
+            block = output_file.read(size)
+            newline = block.rfind(b"\n")
+            if newline != -1:
+                position = position - size + newline + 1
+                break
+            position -= size
+        if position != end:
+            output_file.truncate(position)
+
+
+class _RateLimitedClient(object):
+    '''
+    Takes a token from the limiter before every chat call that reaches the service.
+    It sits under the CachedChatClient, so cache hits do not count against the rate limit
+    '''
+
+    def __init__(self, client):
+        self.client = client
+        self.limiter = None
+
+    def chat(self, chat_details, **kwargs):
+        if self.limiter is not None:
+            self.limiter.acquire()
+        return self.client.chat(chat_details, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+def _get_worker(config, cache=None):
+    '''
+    Returns the client and chat details template of the current worker thread
+    '''
+    if not hasattr(_worker, "client"):
+        _worker.limited_client = _RateLimitedClient(llama3_oci_chat.get_client(config))
+        _worker.client = _worker.limited_client
+        if cache is not None:
+            _worker.client = CachedChatClient(_worker.limited_client, cache)
+        _worker.chat_request = llama3_oci_chat.get_chat_request()
+        _worker.chat_details = llama3_oci_chat.get_chat_details(config, _worker.chat_request)
+    return _worker
+
+
+def run_prompt(record, config, limiter, max_attempts=6, cache=None):
+    '''
+    Sends one prompt record to the model
+    REQUIRES:
+      record(dict) - record from read_prompts
+      config(dict) - valid OCI configuration
+      limiter(RateLimiter) - shared requests per second limit
+    KWARGS:
+      max_attempts(int) - attempts before a retryable error is reported
+      cache(ResponseCache) - cache shared by the workers
+    RETURNS:
+      dict - result record for the output file
+    '''
+    worker = _get_worker(config, cache)
+    worker.chat_request.messages = record["messages"]
+    ## every attempt that reaches the service, including retries, counts against the rate limit
+    worker.limited_client.limiter = limiter
+
+    start = time.perf_counter()
+    response = None
+    try:
+        response, attempts = call_with_backoff(worker.client.chat, worker.chat_details, max_attempts=max_attempts)
+        choice = response.data.chat_response.choices[0]
+        ## a reply can come back without content (for some finish reasons)
+        text = choice.message.content[0].text
+    except Exception as e:
+        result = {"id": record["id"], "error": str(e) or type(e).__name__, "latency_seconds": time.perf_counter() - start}
+        if response is not None:
+            result["opc_request_id"] = response.headers.get("opc-request-id")
+        return result
+
+    return {
+        "id": record["id"],
+        "text": text,
+        "finish_reason": choice.finish_reason,
+        "latency_seconds": time.perf_counter() - start,
+        "attempts": attempts,
+        "opc_request_id": response.headers.get("opc-request-id"),
+        "cached": response.headers.get("opc-cache") == "hit",
+    }
+
+
+def run_batch(input_path, output_path, max_in_flight=8, requests_per_second=None, max_attempts=6, config=None, cache=None):
+    '''
+    Runs every prompt of the input file that does not have a result yet
+    REQUIRES:
+      input_path(str) - location of the prompts JSONL file
+      output_path(str) - location of the results JSONL file (appended to)
+    KWARGS:
+      max_in_flight(int) - number of concurrent chat calls
+      requests_per_second(float) - limit on chat calls per second (None for no limit)
+      max_attempts(int) - attempts per prompt for retryable errors
+      config(dict) - OCI configuration. If not provided, llama3_oci_chat.get_config() is used
+      cache(ResponseCache) - serve repeated deterministic prompts from this cache
+    RETURNS:
+      dict - counts of succeeded, failed and skipped prompts
+    '''
+    config = config or llama3_oci_chat.get_config()
+    limiter = RateLimiter(requests_per_second, burst=max_in_flight)
+    completed = load_completed(output_path)
+    trim_partial_line(output_path)
+    summary = {"succeeded": 0, "failed": 0, "skipped": 0}
+
+    with open(output_path, "a") as output_file, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+
+        def write_results(futures):
+            for future in futures:
+                result = future.result()
+                output_file.write(json.dumps(result) + "\n")
+                output_file.flush()
+                os.fsync(output_file.fileno())
+                summary["failed" if result.get("error") else "succeeded"] += 1
+
+        pending = set()
+        for record in read_prompts(input_path):
+            if record["id"] in completed:
+                summary["skipped"] += 1
+                continue
+            ## keep only a small queue ahead of the workers so huge files are not loaded at once
+            if len(pending) >= max_in_flight * 2:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                write_results(done)
+            pending.add(pool.submit(run_prompt, record, config, limiter, max_attempts, cache))
+
+        for future in concurrent.futures.as_completed(pending):
+            write_results([future])
+
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a JSONL file of prompts through the OCI generative AI chat model")
+    parser.add_argument("input", help="JSONL file of prompts")
+    parser.add_argument("output", help="JSONL file the results are appended to (also used to resume)")
+    parser.add_argument("--max-in-flight", type=int, default=8, help="concurrent chat calls")
+    parser.add_argument("--rps", type=float, default=None, help="maximum chat calls per second")
+    parser.add_argument("--max-attempts", type=int, default=6, help="attempts per prompt on throttling and server errors")
+    parser.add_argument("--cache", default=None, help="SQLite file caching deterministic responses")
+    parser.add_argument("--cache-ttl", type=float, default=None, help="seconds a cached response is served")
+    parser.add_argument("--temperature", type=float, default=None, help="sampling temperature, 0 makes the answers cacheable")
+    parser.add_argument("--seed", type=int, default=None, help="sampling seed, makes the answers cacheable")
+    args = parser.parse_args()
+
+    if args.temperature is not None:
+        llama3_oci_chat.temperature = args.temperature
+    if args.seed is not None:
+        llama3_oci_chat.seed = args.seed
+    if args.cache and not is_deterministic(llama3_oci_chat.get_chat_request()):
+        print("warning: the requests are not deterministic and will not be cached, use --temperature 0 or --seed")
+
+    cache = ResponseCache(args.cache, ttl_seconds=args.cache_ttl) if args.cache else None
+
+    start = time.perf_counter()
+    summary = run_batch(args.input, args.output, max_in_flight=args.max_in_flight,
+                        requests_per_second=args.rps, max_attempts=args.max_attempts, cache=cache)
+    print("succeeded: %(succeeded)d, failed: %(failed)d, skipped: %(skipped)d" % summary
+          + " in %.1fs" % (time.perf_counter() - start))
+    if cache is not None:
+        print("cache: %(hits)d hits, %(misses)d misses, %(entries)d entries" % cache.stats())
+        cache.close()
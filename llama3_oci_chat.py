@@ -6,22 +6,31 @@
 ##   Oracle Cloud Infrastructure's Generative AI Playground:
 ##   https://cloud.oracle.com/ai-service/generative-ai/playground/chat
 #######################################################################
+import json
+import time
+
 import oci
 
+from chat_history import ChatHistory, make_text_message
+from chat_request_builder import ChatRequestBuilder
+from oci_instrumentation import instrument_client
+
 
 #################################################################
 ## UNIQUE CONFIG
 ##   Setup your unique config, like config file location, region
 ##   endpoint, and model for use
 #################################################################
-## get your configuration
-config = oci.config.from_file(file_location='~/.oci/config', profile_name="DEFAULT")
+## location and profile of your configuration
+config_file_location = '~/.oci/config'
+config_profile_name = "DEFAULT"
 
 ## set the region in correspondence with the endpoint
-config['region']='us-chicago-1'
+region = 'us-chicago-1'
 
 ## set the compartment ID where this will be run
-compartment_id = config['tenancy']
+##   (None uses the tenancy from the config)
+compartment_id = None
 
 ## Service endpoint
 endpoint = "https://inference.generativeai.us-chicago-1.oci.oraclecloud.com"
@@ -32,6 +41,10 @@ endpoint = "https://inference.generativeai.us-chicago-1.oci.oraclecloud.com"
 ## model below represents meta.llama-3.1-70b-instruct
 model_id="ocid1.generativeaimodel.oc1.us-chicago-1.amaaaaaask7dceyaiir6nnhmlgwvh37dr2mvragxzszqmz3hok52pcgmpqta"
 
+## OCID of a dedicated AI cluster endpoint to use instead of the on-demand model_id
+##   (DedicatedServingMode, where the unchanged start of the prompt can come from the prefix cache)
+endpoint_id = None
+
 ## set the timeouts for the interaction with the chat client
 connection_timeout_seconds=10 # default is 10
 read_timeout_seconds=240 # default is 60
@@ -44,84 +57,269 @@ frequency_penalty = 0
 presence_penalty = 0
 top_p = 0.75
 top_k = -1
+## fixed seed for repeatable answers (None lets the service pick one)
+seed = None
+
+## stream tokens to the screen as they are generated instead of waiting
+##   for the full completion (set to False for the blocking behavior)
+stream = True
+
+## bound the conversation history that is re-sent on every turn
+##   history_token_budget - estimated prompt tokens kept (oldest turns are dropped first)
+##   summarize_history - fold dropped turns into a single summary message
+##   system_prompt - optional preamble that is always sent and never dropped
+history_token_budget = 6000
+summarize_history = False
+system_prompt = None
+
+## build the request bodies incrementally: every message is serialized once and
+##   only the new turn is added to the body (see chat_request_builder.py)
+##   compress_requests - also gzip the body, only for endpoints that accept it
+incremental_requests = True
+compress_requests = False
+
+## route every turn over several (endpoint, model_id) targets instead of the single
+##   endpoint and model above, the fastest healthy one first (see chat_router.py);
+##   the request bodies are then built per target, not incrementally
+##   hedge_requests - also send a duplicate to the next target when the first is slower
+##                    than its p95 latency, keeping whichever answers first
+routing_targets = []
+# routing_targets = [
+#     (endpoint, model_id),
+#     (endpoint, "ocid1.generativeaimodel.oc1.us-chicago-1.amaaaaaask7dceyarleil5jr7k2rykljkhapnvhrqvzx4cwuvtfedlfxet4q"),
+# ]
+hedge_requests = False
+
+
+#################################################################
+## STREAMING HELPERS
+##   When is_stream is set on the chat request, the service answers
+##   with server-sent events.  Each event carries a small JSON chunk
+##   of the assistant message, so we print the text as it arrives and
+##   stitch the chunks back together into a single Message
+#################################################################
+def stream_chat_response(result, request_start=None):
+    '''
+    Prints a streamed chat response as it arrives and rebuilds the final message
+    REQUIRES:
+      result(oci.response.Response) - response of a chat call made with is_stream=True
+    KWARGS:
+      request_start(float) - time.perf_counter() taken right before the chat call
+                             If not provided, timing starts when the events are read
+    RETURNS:
+      (oci.generative_ai_inference.models.Message, dict) - the assembled assistant
+        message and the stats for the turn (time_to_first_token, total_seconds,
+        tokens, tokens_per_second)
+    '''
+    start = request_start if request_start is not None else time.perf_counter()
+    first_token_at = None
+    tokens = 0
+    pieces = []
+
+    for event in result.data.events():
+        ## skip keep-alives and anything that is not a JSON chunk
+        if not event.data or not event.data.strip().startswith("{"):
+            continue
+        chunk = json.loads(event.data)
+
+        ## each chunk carries the newly generated text in message.content
+        for content in (chunk.get("message") or {}).get("content") or []:
+            text = content.get("text")
+            if not text:
+                continue
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+            ## the generic format sends roughly one token per event
+            tokens += 1
+            pieces.append(text)
+            print(text, end="", flush=True)
+    print()
+
+    end = time.perf_counter()
+    generation_seconds = end - first_token_at if first_token_at else 0
+    stats = {
+        "time_to_first_token": (first_token_at - start) if first_token_at else None,
+        "total_seconds": end - start,
+        "tokens": tokens,
+        "tokens_per_second": (tokens / generation_seconds) if generation_seconds > 0 else None,
+    }
+
+    ## assemble the assistant message so the conversation can continue
+    return make_text_message("ASSISTANT", "".join(pieces)), stats
+
+
+def format_stream_stats(stats):
+    '''
+    Formats the stats of a streamed turn for display
+    REQUIRES:
+      stats(dict) - stats returned from stream_chat_response
+    RETURNS:
+      str - one line summary of the turn
+    '''
+    parts = []
+    if stats["time_to_first_token"] is not None:
+        parts.append("time to first token: %.2fs" % stats["time_to_first_token"])
+    parts.append("total: %.2fs" % stats["total_seconds"])
+    parts.append("tokens: %d" % stats["tokens"])
+    if stats["tokens_per_second"] is not None:
+        parts.append("%.1f tokens/sec" % stats["tokens_per_second"])
+    return "[" + ", ".join(parts) + "]"
 
 
 #################################################################
 ## CONSTANT SETUP
-##   In this first block before the while statement:
-##   we setup the client, initialize the models, 
-##   and set the attributes that need to persist
+##   These functions setup the client and initialize the models
+##   that need to persist.  They are shared with the other scripts
+##   (such as the batch runner) that reuse this configuration
 #################################################################
+def get_config():
+    '''
+    Loads the OCI configuration and sets the region for the endpoint
+    RETURNS:
+      dict - OCI configuration
+    '''
+    config = oci.config.from_file(file_location=config_file_location, profile_name=config_profile_name)
+    config['region'] = region
+    return config
+
 
-## if using Instance Principals, be sure to setup your signer and then use it for authentication in the client creation below
-## signer = oci.auth.signers.InstancePrincipalsSecurityTokenSigner()
+def get_client(config, retry_strategy=None, service_endpoint=None):
+    '''
+    Creates the generative AI inference client
+    REQUIRES:
+      config(dict) - valid OCI configuration
+    KWARGS:
+      retry_strategy(oci.retry strategy) - If not provided, retries are disabled
+      service_endpoint(str) - If not provided, the endpoint from the config above
+    RETURNS:
+      oci.generative_ai_inference.GenerativeAiInferenceClient
+    '''
+    ## if using Instance Principals, be sure to setup your signer and then use it for authentication in the client creation below
+    ## signer = oci.auth.signers.InstancePrincipalsSecurityTokenSigner()
+    ## per-call timings are recorded when OCI_CALL_TRACE or OCI_CALL_METRICS is set (see oci_instrumentation.py)
+    return instrument_client(oci.generative_ai_inference.GenerativeAiInferenceClient(
+        config=config,
+        service_endpoint=service_endpoint or endpoint,
+        retry_strategy=retry_strategy or oci.retry.NoneRetryStrategy(),
+        timeout=(connection_timeout_seconds, read_timeout_seconds)
+    ))
 
-##  define the client
-generative_ai_inference_client = oci.generative_ai_inference.GenerativeAiInferenceClient(config=config, service_endpoint=endpoint, retry_strategy=oci.retry.NoneRetryStrategy(), timeout=(connection_timeout_seconds,read_timeout_seconds))
 
-## Initialize the Chat Details model
-chat_details = oci.generative_ai_inference.models.ChatDetails()
-chat_details.serving_mode = oci.generative_ai_inference.models.OnDemandServingMode(model_id=model_id)
-chat_details.compartment_id = compartment_id
+def get_chat_request(is_stream=False):
+    '''
+    Initializes the GenericChatRequest model with the chat parameters
+    KWARGS:
+      is_stream(bool) - request server-sent events instead of a single response
+    RETURNS:
+      oci.generative_ai_inference.models.GenericChatRequest
+    '''
+    chat_request = oci.generative_ai_inference.models.GenericChatRequest()
+    chat_request.api_format = oci.generative_ai_inference.models.BaseChatRequest.API_FORMAT_GENERIC
+    chat_request.max_tokens = max_tokens
+    chat_request.temperature = temperature
+    chat_request.frequency_penalty = frequency_penalty
+    chat_request.presence_penalty = presence_penalty
+    chat_request.top_p = top_p
+    chat_request.top_k = top_k
+    chat_request.seed = seed
+    chat_request.is_stream = is_stream
+    return chat_request
+
+
+def get_chat_details(config, chat_request=None):
+    '''
+    Initializes the Chat Details model for the configured model (or dedicated endpoint) and compartment
+    REQUIRES:
+      config(dict) - valid OCI configuration
+    KWARGS:
+      chat_request(GenericChatRequest) - chat request to attach
+    RETURNS:
+      oci.generative_ai_inference.models.ChatDetails
+    '''
+    chat_details = oci.generative_ai_inference.models.ChatDetails()
+    if endpoint_id:
+        chat_details.serving_mode = oci.generative_ai_inference.models.DedicatedServingMode(endpoint_id=endpoint_id)
+    else:
+        chat_details.serving_mode = oci.generative_ai_inference.models.OnDemandServingMode(model_id=model_id)
+    chat_details.compartment_id = compartment_id or config['tenancy']
+    chat_details.chat_request = chat_request
+    return chat_details
 
-## Initialize the GenericChatRequest model
-chat_request = oci.generative_ai_inference.models.GenericChatRequest()
-chat_request.api_format = oci.generative_ai_inference.models.BaseChatRequest.API_FORMAT_GENERIC
-chat_request.max_tokens = max_tokens
-chat_request.temperature = temperature
-chat_request.frequency_penalty = frequency_penalty
-chat_request.presence_penalty = presence_penalty
-chat_request.top_p = top_p
-chat_request.top_k = top_k
 
 #################################################################
 ## start the endless loop of asking questions 
 ##   (ctrl+c to end chat session)
 #################################################################
-while True:
-
-    ## get the user prompt
-    print("="*72)
-    user_input=input("You: ")
-
-    ## here is where you could insert some prompt engineering,
-    ## such as asking it to cite its sources or giving direction
-    ## on how to respond (voice)
-    # if user_input[-1] not in [".","?","!"]:
-    #     user_input+="."
-    # user_input+=" Please be sure to cite your sources."
-
-    ## create the content model for this question
-    content = oci.generative_ai_inference.models.TextContent()
-    content.text = user_input
-
-    ## create a message model from that content
-    message = oci.generative_ai_inference.models.Message()
-    message.role = "USER"
-    message.content = [content]
-
-    ## If there has been any interaction so far, we need to append the message to the chat request
-    if chat_request.messages:
-        chat_request.messages.append(message)
-    ## If this is the first run through, we need to initialize the messages attribute of the chat request
+def main():
+    config = get_config()
+
+    ##  define the client, or the router over the routing targets
+    if routing_targets:
+        ## imported here, chat_router builds its clients with get_client from this module
+        from chat_router import ChatRouter
+        generative_ai_inference_client = ChatRouter(config, routing_targets, hedge=hedge_requests)
     else:
-        chat_request.messages = [message]
-    
+        generative_ai_inference_client = get_client(config)
 
-    ## add the updated chat request to the chat
-    chat_details.chat_request = chat_request
-    ## send the chat detail to the chat method
-    result = generative_ai_inference_client.chat(chat_details)
-
-    ## print the results
-    print("-"*72)
-    print(result.data.chat_response.choices[0].message.content[0].text)
-    ## append the chatbot's response to the chat_request messages list attribute
-    ##   in order to maintain a conversation
-    chat_request.messages.append(result.data.chat_response.choices[0].message)
-
-    ## Detailed outputs if you'd like to see more info about the response
-    # print("**************************Detail Chat Result**************************")
-    # print(vars(result))
-    # print("------------------------------------------------------------------------")
-    # print(chat_request.messages)
+    ## Initialize the Chat Details and GenericChatRequest models
+    chat_request = get_chat_request(is_stream=stream)
+    chat_details = get_chat_details(config, chat_request)
+
+    ## Initialize the conversation history that feeds chat_request.messages
+    history = ChatHistory(token_budget=history_token_budget, summarize=summarize_history)
+    if system_prompt:
+        history.pin(make_text_message("SYSTEM", system_prompt))
+
+    ## reuses the serialized messages of the earlier turns
+    request_builder = None
+    if incremental_requests and not routing_targets:
+        request_builder = ChatRequestBuilder(generative_ai_inference_client, compress=compress_requests)
+
+    while True:
+
+        ## get the user prompt
+        print("="*72)
+        user_input=input("You: ")
+
+        ## here is where you could insert some prompt engineering,
+        ## such as asking it to cite its sources or giving direction
+        ## on how to respond (voice)
+        # if user_input[-1] not in [".","?","!"]:
+        #     user_input+="."
+        # user_input+=" Please be sure to cite your sources."
+
+        ## create the message model for this question and add it to the history,
+        ##   which drops the oldest turns once the token budget is exceeded
+        history.append(make_text_message("USER", user_input))
+        chat_request.messages = history.messages()
+
+        ## add the updated chat request to the chat
+        chat_details.chat_request = chat_request
+        ## send the chat detail to the chat method
+        request_start = time.perf_counter()
+        if request_builder:
+            result = request_builder.chat(chat_details)
+        else:
+            result = generative_ai_inference_client.chat(chat_details)
+
+        ## print the results
+        print("-"*72)
+        if stream:
+            ## tokens are printed as they arrive, then the full reply is rebuilt
+            response_message, stats = stream_chat_response(result, request_start=request_start)
+            print(format_stream_stats(stats))
+        else:
+            response_message = result.data.chat_response.choices[0].message
+            print(response_message.content[0].text)
+        ## append the chatbot's response to the history in order to maintain a conversation
+        history.append(response_message)
+
+        ## Detailed outputs if you'd like to see more info about the response
+        # print("**************************Detail Chat Result**************************")
+        # print(vars(result))
+        # print("------------------------------------------------------------------------")
+        # print(chat_request.messages)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,396 @@
+#######################################################################
+## The following code is free to use for the general public.
+## The author makes no promises and provides no warranty.
+## This code is meant to be a starting point for others to use.
+#######################################################################
+'''
+Offline benchmarks of the scripts in this repository, run against
+oci_fake_server.py so no tenancy is needed.
+
+Scenarios (throughput and p50/p99 latency of each):
+  chat      chat turns of llama3_oci_chat.py, non-streaming and streaming
+            (the streaming turns also report the time to first token)
+  batch     the questions of rag_agent_batch.run_batch
+  vault     key and secret replication of simple_key_backup.py and
+            simple_secret_backup.py, latency is per replication run
+  transfer  upload and download of one file with rover_transfer.py
+
+The fake answers immediately unless --latency/--jitter are given, so the
+numbers measure the client side: serialization, signing, connection reuse,
+thread pools and rate limiters.  Add latency and faults to see how the
+scripts behave against a slow or throttling service.
+
+Save the results with --json and compare a later run with --baseline: any
+p50 or throughput more than --tolerance worse than the baseline is reported
+and the exit code is 1.
+
+Usage:
+  python oci_benchmark.py --json baseline.json
+  python oci_benchmark.py --baseline baseline.json --tolerance 0.2
+  python oci_benchmark.py --scenarios chat,vault --latency 0.05 --throttle-rate 0.02
+'''
+import argparse
+import base64
+import concurrent.futures
+import contextlib
+import csv
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+import oci
+
+import llama3_oci_chat
+import rag_agent_batch
+import rover_get_clients
+import rover_transfer
+import vault_clients
+from chat_history import make_text_message
+from oci_fake_server import FakeOCIServer
+from oci_instrumentation import instrument_client
+from replication_job import FAILED
+from simple_key_backup import KeyBackup
+from simple_secret_backup import SecretBackup
+
+
+SCENARIOS = ["chat", "batch", "vault", "transfer"]
+
+## results where a higher value is better, every other result is a latency
+HIGHER_IS_BETTER = ("throughput",)
+
+
+def percentile(samples, percent):
+    '''
+    Nearest rank percentile
+    REQUIRES:
+      samples(list) - measured values
+      percent(float) - 0 to 100
+    RETURNS:
+      float - the percentile, None without samples
+    '''
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = max(1, int(round(percent / 100.0 * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize(name, samples, units, seconds, unit, errors=0):
+    '''
+    Builds the result of a scenario
+    REQUIRES:
+      name(str) - name of the result
+      samples(list) - latency of every operation in seconds
+      units(float) - work done, in unit
+      seconds(float) - wall clock time of the work
+      unit(str) - what units counts (turns, questions, items, MB)
+    KWARGS:
+      errors(int) - failed operations
+    RETURNS:
+      dict - name, count, errors, p50, p99, mean, throughput (unit per second) and unit
+    '''
+    return {
+        "name": name,
+        "count": len(samples),
+        "errors": errors,
+        "p50": percentile(samples, 50),
+        "p99": percentile(samples, 99),
+        "mean": sum(samples) / len(samples) if samples else None,
+        "throughput": units / seconds if seconds > 0 else None,
+        "unit": unit,
+    }
+
+
+@contextlib.contextmanager
+def quiet():
+    ## the scripts print their progress, keep it out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+#################################################################
+## SCENARIOS
+##   every scenario takes the running server and the parsed
+##   arguments and returns a list of results
+#################################################################
+def bench_chat(server, args):
+    '''
+    Runs args.chat_turns conversation turns on args.concurrency threads, every thread
+    keeps its own growing conversation, once without and once with streaming
+    '''
+    config = server.config()
+    ## get_client reads the module endpoint, put it back for whatever runs next
+    endpoint = llama3_oci_chat.endpoint
+    llama3_oci_chat.endpoint = server.url
+    try:
+        client = llama3_oci_chat.get_client(config, retry_strategy=oci.retry.DEFAULT_RETRY_STRATEGY)
+    finally:
+        llama3_oci_chat.endpoint = endpoint
+    results = []
+
+    for is_stream in (False, True):
+        turns_per_thread = max(1, args.chat_turns // args.concurrency)
+
+        def conversation(_):
+            latencies, first_tokens, errors = [], [], 0
+            messages = []
+            for turn in range(turns_per_thread):
+                messages.append(make_text_message("USER", "question %d of the benchmark conversation" % turn))
+                chat_details = llama3_oci_chat.get_chat_details(config, llama3_oci_chat.get_chat_request(is_stream))
+                chat_details.chat_request.messages = messages
+                start = time.perf_counter()
+                try:
+                    response = client.chat(chat_details)
+                    if is_stream:
+                        message, stats = llama3_oci_chat.stream_chat_response(response, start)
+                        first_tokens.append(stats["time_to_first_token"])
+                    else:
+                        message = response.data.chat_response.choices[0].message
+                except oci.exceptions.ServiceError:
+                    errors += 1
+                    messages.pop()
+                    continue
+                latencies.append(time.perf_counter() - start)
+                messages.append(message)
+            return latencies, first_tokens, errors
+
+        start = time.perf_counter()
+        with quiet(), concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            outcomes = list(pool.map(conversation, range(args.concurrency)))
+        seconds = time.perf_counter() - start
+
+        latencies = [latency for outcome in outcomes for latency in outcome[0]]
+        errors = sum(outcome[2] for outcome in outcomes)
+        name = "chat_stream" if is_stream else "chat"
+        results.append(summarize(name, latencies, len(latencies), seconds, "turns", errors))
+        if is_stream:
+            first_tokens = [first_token for outcome in outcomes for first_token in outcome[1] if first_token is not None]
+            ## same turns as chat_stream, only the latency is of interest
+            results.append(summarize("chat_stream_ttft", first_tokens, 0, 0, "turns"))
+    return results
+
+
+def bench_batch(server, args):
+    '''
+    Asks args.questions questions through rag_agent_batch.run_batch
+    '''
+    config = server.config()
+    agent_endpoint_id = server.add_agent_endpoint()
+    runtime_client = instrument_client(oci.generative_ai_agent_runtime.GenerativeAiAgentRuntimeClient(config, service_endpoint=server.url))
+    agent_client = instrument_client(oci.generative_ai_agent.GenerativeAiAgentClient(config, service_endpoint=server.url))
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        questions_path = os.path.join(work_dir, "questions.jsonl")
+        output_path = os.path.join(work_dir, "answers.csv")
+        with open(questions_path, "w") as questions_file:
+            for number in range(args.questions):
+                questions_file.write(json.dumps({"id": "q%d" % number, "question": "benchmark question %d?" % number}) + "\n")
+
+        with quiet():
+            summary = rag_agent_batch.run_batch(questions_path, output_path, agent_endpoint_id, runtime_client,
+                                                agent_client, workers=args.concurrency)
+        with open(output_path) as output_file:
+            rows = list(csv.DictReader(output_file))
+
+    latencies = [float(row["latency_seconds"]) for row in rows if not row["error"]]
+    return [summarize("batch_qa", latencies, summary["answered"], summary["seconds"], "questions", summary["failed"])]
+
+
+def bench_vault(server, args):
+    '''
+    Replicates args.keys keys and args.secrets secrets to an empty vault, args.repeat times,
+    then once more with nothing changed (the incremental run)
+    '''
+    vault_clients.configure(server.config(), {"kms_vault": server.url, "vaults": server.url, "secrets": server.url})
+    runs = {"vault_keys": [], "vault_keys_unchanged": [], "vault_secrets": [], "vault_secrets_unchanged": []}
+    errors = dict((name, 0) for name in runs)
+
+    def timed(name, replication):
+        start = time.perf_counter()
+        with quiet():
+            job = replication.run()
+        runs[name].append(time.perf_counter() - start)
+        errors[name] += len(job.summary().get(FAILED, []))
+
+    try:
+        for repeat in range(args.repeat):
+            ## fresh vaults every time, the fake keeps keys per compartment
+            source_compartment = "ocid1.compartment.oc1..benchsource%d" % repeat
+            target_compartment = "ocid1.compartment.oc1..benchtarget%d" % repeat
+            source_vault = server.add_vault(source_compartment)
+            target_vault = server.add_vault(target_compartment)
+            target_key = server.add_key(target_compartment, target_vault, "replication")
+            for number in range(args.keys):
+                server.add_key(source_compartment, source_vault, "key-%d" % number)
+            for number in range(args.secrets):
+                content = base64.b64encode(os.urandom(64)).decode("ascii")
+                server.add_secret(source_compartment, source_vault, "secret-%d" % number, content)
+
+            with tempfile.TemporaryDirectory() as work_dir:
+                def keys():
+                    return KeyBackup("bench-source", source_compartment, source_vault, "bench-target", target_compartment, target_vault,
+                                     export_rate=args.vault_rate, import_rate=args.vault_rate,
+                                     state_file=os.path.join(work_dir, "key_state.json"),
+                                     journal_file=os.path.join(work_dir, "key_journal.jsonl"))
+
+                def secrets():
+                    return SecretBackup("bench-source", source_compartment, source_vault, "bench-target", target_compartment, target_vault, target_key,
+                                        source_read_rate=args.vault_rate, target_read_rate=args.vault_rate, write_rate=args.vault_rate,
+                                        journal_file=os.path.join(work_dir, "secret_journal.jsonl"))
+
+                timed("vault_keys", keys())
+                timed("vault_keys_unchanged", keys())
+                timed("vault_secrets", secrets())
+                timed("vault_secrets_unchanged", secrets())
+    finally:
+        vault_clients.configure()
+
+    results = []
+    for name, samples in runs.items():
+        items = args.keys if name.startswith("vault_keys") else args.secrets
+        results.append(summarize(name, samples, items * len(samples), sum(samples), "items", errors[name]))
+    return results
+
+
+def bench_transfer(server, args):
+    '''
+    Uploads and downloads one file of args.size_mb MB, args.repeat times
+    '''
+    ## the transfer clients are cached per host, point the device port at the fake
+    port = int(server.object_storage_url.rsplit(":", 1)[1])
+    client_type = rover_get_clients.CLIENT_TYPES["object_storage"]
+    ## clients cached earlier still point at the real port
+    rover_get_clients.close_clients("localhost")
+    rover_get_clients.CLIENT_TYPES["object_storage"] = (oci.object_storage.ObjectStorageClient, port)
+    transfer = None
+    uploads, downloads = [], []
+    size = int(args.size_mb * rover_transfer.MB)
+    try:
+        transfer = rover_transfer.RoverTransfer(server.config(), "benchmark", "localhost", server.cert_bundle,
+                                                part_size=args.part_size_mb * rover_transfer.MB, concurrency=args.concurrency)
+        ## REQUESTS_CA_BUNDLE in the environment would replace the fake's certificate
+        transfer.client.base_client.session.trust_env = False
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            local_path = os.path.join(work_dir, "upload.bin")
+            with open(local_path, "wb") as local_file:
+                local_file.write(os.urandom(size))
+            for repeat in range(args.repeat):
+                object_name = "benchmark/%d.bin" % repeat
+                start = time.perf_counter()
+                transfer.upload_file(local_path, object_name)
+                uploads.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                transfer.download_file(object_name, os.path.join(work_dir, "download.bin"))
+                downloads.append(time.perf_counter() - start)
+    finally:
+        if transfer is not None:
+            transfer.close()
+        ## and the clients built here must not outlive the fake
+        rover_get_clients.close_clients("localhost")
+        rover_get_clients.CLIENT_TYPES["object_storage"] = client_type
+
+    megabytes = size / float(rover_transfer.MB)
+    return [
+        summarize("transfer_upload", uploads, megabytes * len(uploads), sum(uploads), "MB"),
+        summarize("transfer_download", downloads, megabytes * len(downloads), sum(downloads), "MB"),
+    ]
+
+
+BENCHMARKS = {"chat": bench_chat, "batch": bench_batch, "vault": bench_vault, "transfer": bench_transfer}
+
+
+#################################################################
+## REPORT
+#################################################################
+def _format(value, scale=1000.0):
+    return "-" if value is None else "%.2f" % (value * scale)
+
+
+def print_results(results):
+    print("%-26s %7s %6s %10s %10s %14s" % ("benchmark", "count", "errors", "p50 ms", "p99 ms", "throughput"))
+    for result in results:
+        throughput = "-" if result["throughput"] is None else "%.1f %s/s" % (result["throughput"], result["unit"])
+        print("%-26s %7d %6d %10s %10s %14s" % (result["name"], result["count"], result["errors"],
+                                                _format(result["p50"]), _format(result["p99"]), throughput))
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Compares results with a baseline
+    REQUIRES:
+      results(list) - results of this run
+      baseline(list) - results of an earlier run
+      tolerance(float) - allowed slowdown, 0.2 is 20%
+    RETURNS:
+      list of str - one line per regression
+    '''
+    previous = dict((result["name"], result) for result in baseline)
+    regressions = []
+    for result in results:
+        before = previous.get(result["name"])
+        if before is None:
+            continue
+        for field in ("p50", "throughput"):
+            old, new = before.get(field), result.get(field)
+            if not old or new is None:
+                continue
+            change = (old - new) / old if field in HIGHER_IS_BETTER else (new - old) / old
+            if change > tolerance:
+                regressions.append("%s %s is %.0f%% worse: %.4g -> %.4g" % (result["name"], field, change * 100, old, new))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the scripts against the local fake OCI server")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated, from " + ", ".join(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=8, help="threads of the chat, batch and transfer scenarios")
+    parser.add_argument("--chat-turns", type=int, default=200, help="chat turns per mode")
+    parser.add_argument("--questions", type=int, default=200, help="questions of the batch scenario")
+    parser.add_argument("--keys", type=int, default=50, help="keys replicated per run")
+    parser.add_argument("--secrets", type=int, default=50, help="secrets replicated per run")
+    parser.add_argument("--vault-rate", type=float, default=0, help="rate limit of the vault calls, 0 for none")
+    parser.add_argument("--size-mb", type=float, default=64, help="size of the transferred file")
+    parser.add_argument("--part-size-mb", type=int, default=8, help="part size of the transfers")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of the vault and transfer scenarios")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every call")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random seconds added to every call")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of calls answered with 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of calls answered with 500")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="seconds between streamed tokens")
+    parser.add_argument("--object-storage-port", type=int, default=0, help="port of the fake device, 0 picks a free port")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    args = parser.parse_args(argv)
+
+    scenarios = [scenario.strip() for scenario in args.scenarios.split(",") if scenario.strip()]
+    for scenario in scenarios:
+        if scenario not in BENCHMARKS:
+            parser.error("unknown scenario " + scenario)
+
+    results = []
+    with FakeOCIServer(object_storage_port=args.object_storage_port, token_delay=args.token_delay) as server:
+        server.set_faults(latency=args.latency, jitter=args.jitter, throttle_rate=args.throttle_rate, error_rate=args.error_rate)
+        for scenario in scenarios:
+            results.extend(BENCHMARKS[scenario](server, args))
+            server.reset()
+    print_results(results)
+
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump({"arguments": vars(args), "results": results}, json_file, indent=1)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file)["results"], args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
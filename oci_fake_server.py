@@ -0,0 +1,893 @@
+#######################################################################
+## The following code is free to use for the general public.
+## The author makes no promises and provides no warranty.
+## This code is meant to be a starting point for others to use.
+#######################################################################
+'''
+Local stand-in for the OCI services the scripts in this repository call, so
+they can be exercised and timed without a tenancy.
+
+Operations served (same REST paths as the OCI SDK, so real SDK clients are
+pointed at it with service_endpoint):
+  Generative AI inference  chat, streaming or not (GENERIC and COHERE formats)
+  Generative AI agents     get_agent_endpoint, create_session, delete_session,
+                           chat (streaming or not)
+  Key management           get_vault, list_keys, get_key, get_wrapping_key,
+                           import_key, import_key_version, export_key
+  Vault and secrets        list_secrets, create_secret, update_secret,
+                           get_secret_bundle
+  Object storage           get_namespace, list_buckets, list_objects, put_object, get_object
+                           (ranges, if-match), head_object, delete_object and
+                           the multipart upload calls
+
+Everything is kept in memory.  The request signature is not checked.  Every
+vault uses the same endpoint, so keys are kept per compartment: give every
+fake vault its own compartment.
+
+Roving Edge object storage is also served over https with a self-signed
+certificate, written to server.cert_bundle.  FakeOCIServer picks a free port
+(server.object_storage_url) so parallel runs do not collide; pass
+object_storage_port=8019 (the default of the command line) for the device
+port, so that
+rover_get_clients.get_client(config, "object_storage", "localhost", server.cert_bundle)
+works unchanged.
+
+Any operation can be slowed down, throttled (429) or failed (500):
+  server.set_faults(latency=0.05, jitter=0.02, throttle_rate=0.01)
+  server.set_faults("export_key", error_rate=0.5)
+
+Usage:
+  with FakeOCIServer() as server:
+      client = oci.generative_ai_inference.GenerativeAiInferenceClient(server.config(), service_endpoint=server.url)
+      vault_clients.configure(server.config(), {"kms_vault": server.url, "vaults": server.url, "secrets": server.url})
+  python oci_fake_server.py --port 8080 --latency 0.05
+'''
+import argparse
+import base64
+import collections
+import datetime
+import gzip
+import hashlib
+import http.server
+import ipaddress
+import json
+import os
+import random
+import re
+import ssl
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+
+
+## the Roving Edge device port of object storage
+ROVER_OBJECT_STORAGE_PORT = 8019
+
+## namespace returned by get_namespace
+NAMESPACE = "fakenamespace"
+
+## page size of the list calls when the request has no limit
+DEFAULT_PAGE_SIZE = 100
+
+Faults = collections.namedtuple("Faults", ["latency", "jitter", "throttle_rate", "error_rate"])
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def _ocid(resource_type):
+    return "ocid1." + resource_type + ".oc1..fake" + uuid.uuid4().hex
+
+
+def _b64_md5(data):
+    return base64.b64encode(hashlib.md5(data).digest()).decode("ascii")
+
+
+def _private_key_pem(key):
+    return key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                             serialization.NoEncryption()).decode("ascii")
+
+
+class ServiceException(Exception):
+    '''
+    Error answered to the client as an OCI error response
+    '''
+
+    def __init__(self, status, code, message):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.message = message
+
+
+class Reply(object):
+    '''
+    Response of an operation
+    KWARGS:
+      body - dict/list/str (sent as JSON), bytes, or None
+      status(int) - HTTP status
+      headers(dict) - extra response headers
+      events(iterable) - dicts sent as server-sent events instead of a body
+    '''
+
+    def __init__(self, body=None, status=200, headers=None, events=None):
+        self.body = body
+        self.status = status
+        self.headers = headers or {}
+        self.events = events
+
+
+class _Request(object):
+
+    def __init__(self, method, params, query, headers, body):
+        self.method = method
+        self.params = params
+        self.query = query
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body.decode("utf-8")) if self.body else {}
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    ## keep-alive, like the real services
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeOCI/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.fake._dispatch(self)
+
+    do_POST = do_PUT = do_DELETE = do_HEAD = do_GET
+
+
+class _HTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class FakeOCIServer(object):
+    '''
+    In-memory OCI services on a local port
+    KWARGS:
+      host(str) - address to listen on
+      port(int) - port of the http endpoint, 0 picks a free port
+      object_storage_port(int) - https port of Roving Edge object storage, 0 picks a free port, None to not serve it
+      reply_tokens(int) - words in every chat reply
+      token_delay(float) - seconds between the tokens of a chat reply (generation speed)
+    '''
+
+    def __init__(self, host="127.0.0.1", port=0, object_storage_port=0, reply_tokens=40, token_delay=0.0):
+        self.host = host
+        self.reply_tokens = reply_tokens
+        self.token_delay = token_delay
+        self.calls = collections.Counter()
+        self._faults = {None: Faults(0.0, 0.0, 0.0, 0.0)}
+        self._lock = threading.RLock()
+        self._retry_tokens = {}
+        self._routes = []
+        self._servers = []
+        self._key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self._tempdir = tempfile.mkdtemp(prefix="oci_fake_server_")
+        self.reset()
+        self._add_routes()
+
+        self._http = _HTTPServer((host, port), _Handler)
+        self._http.fake = self
+        self._servers.append(self._http)
+        self.port = self._http.server_address[1]
+        self.url = "http://" + host + ":" + str(self.port)
+
+        self.cert_bundle = None
+        self.object_storage_url = None
+        if object_storage_port is not None:
+            self.cert_bundle = self._write_certificate()
+            self._https = _HTTPServer((host, object_storage_port), _Handler)
+            self._https.fake = self
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(self.cert_bundle, os.path.join(self._tempdir, "key.pem"))
+            self._https.socket = context.wrap_socket(self._https.socket, server_side=True)
+            self._servers.append(self._https)
+            self.object_storage_url = "https://localhost:" + str(self._https.server_address[1])
+
+    ###################################################
+    #### Setup
+    ###################################################
+    def reset(self):
+        '''
+        Forgets every resource and call count
+        '''
+        with self._lock:
+            self.vaults = {}
+            self.keys = {}
+            self.secrets = {}
+            self.agent_endpoints = {}
+            self.sessions = {}
+            self.buckets = collections.defaultdict(dict)
+            self.uploads = {}
+            self._retry_tokens = {}
+            self.calls.clear()
+
+    def config(self, region="us-chicago-1"):
+        '''
+        Returns an OCI config that signs requests with a generated key (the server does not check signatures)
+        '''
+        return {
+            "user": "ocid1.user.oc1..fake",
+            "tenancy": "ocid1.tenancy.oc1..fake",
+            "fingerprint": "00:11:22:33:44:55:66:77:88:99:aa:bb:cc:dd:ee:ff",
+            "key_content": _private_key_pem(self._key),
+            "region": region,
+        }
+
+    def set_faults(self, operation=None, latency=None, jitter=None, throttle_rate=None, error_rate=None):
+        '''
+        Sets the faults injected in every operation, or in one operation
+        KWARGS:
+          operation(str) - SDK operation name (for example "chat", "export_key"), None for every operation
+          latency(float) - seconds added to every call
+          jitter(float) - up to this many seconds are added at random on top of latency
+          throttle_rate(float) - share of the calls answered with 429
+          error_rate(float) - share of the calls answered with 500
+        '''
+        with self._lock:
+            current = self._faults.get(operation) or self._faults[None]
+            self._faults[operation] = Faults(
+                current.latency if latency is None else latency,
+                current.jitter if jitter is None else jitter,
+                current.throttle_rate if throttle_rate is None else throttle_rate,
+                current.error_rate if error_rate is None else error_rate,
+            )
+
+    def add_vault(self, compartment_id, vault_id=None):
+        '''
+        Adds a vault, its endpoints are the server
+        RETURNS:
+          str - the vault id
+        '''
+        vault_id = vault_id or _ocid("vault")
+        with self._lock:
+            self.vaults[vault_id] = {"id": vault_id, "compartmentId": compartment_id, "displayName": vault_id,
+                                     "managementEndpoint": self.url, "cryptoEndpoint": self.url,
+                                     "lifecycleState": "ACTIVE", "vaultType": "DEFAULT", "timeCreated": _now()}
+        return vault_id
+
+    def add_key(self, compartment_id, vault_id, display_name=None, protection_mode="SOFTWARE", algorithm="AES", length=32, key_id=None):
+        '''
+        Adds a key with one key version
+        RETURNS:
+          str - the key id
+        '''
+        key_id = key_id or _ocid("key")
+        with self._lock:
+            self.keys[key_id] = {"id": key_id, "compartmentId": compartment_id, "vaultId": vault_id,
+                                 "displayName": display_name or key_id, "protectionMode": protection_mode,
+                                 "keyShape": {"algorithm": algorithm, "length": length}, "algorithm": algorithm,
+                                 "lifecycleState": "ENABLED", "timeCreated": _now(), "freeformTags": {},
+                                 "isAutoRotationEnabled": False, "currentKeyVersion": _ocid("keyversion")}
+        return key_id
+
+    def rotate_key(self, key_id):
+        '''
+        Gives a key a new current key version
+        '''
+        with self._lock:
+            self.keys[key_id]["currentKeyVersion"] = _ocid("keyversion")
+
+    def add_secret(self, compartment_id, vault_id, secret_name, content, key_id=None, secret_id=None):
+        '''
+        Adds a secret, content is the base64 content of its first version
+        RETURNS:
+          str - the secret id
+        '''
+        secret_id = secret_id or _ocid("vaultsecret")
+        with self._lock:
+            self.secrets[secret_id] = {"id": secret_id, "compartmentId": compartment_id, "vaultId": vault_id,
+                                       "keyId": key_id, "secretName": secret_name, "description": secret_name,
+                                       "lifecycleState": "ACTIVE", "timeCreated": _now(), "freeformTags": {},
+                                       "versionNumber": 1, "content": content}
+        return secret_id
+
+    def add_agent_endpoint(self, agent_endpoint_id=None, should_enable_session=True, idle_timeout_in_seconds=3600):
+        '''
+        Adds an agent endpoint
+        RETURNS:
+          str - the agent endpoint id
+        '''
+        agent_endpoint_id = agent_endpoint_id or _ocid("genaiagentendpoint")
+        with self._lock:
+            self.agent_endpoints[agent_endpoint_id] = {
+                "id": agent_endpoint_id, "agentId": _ocid("genaiagent"), "compartmentId": "ocid1.compartment.oc1..fake",
+                "displayName": agent_endpoint_id, "lifecycleState": "ACTIVE", "timeCreated": _now(),
+                "shouldEnableSession": should_enable_session,
+                "sessionConfig": {"idleTimeoutInSeconds": idle_timeout_in_seconds},
+            }
+        return agent_endpoint_id
+
+    ###################################################
+    #### Lifecycle
+    ###################################################
+    def start(self):
+        '''
+        Serves the requests on background threads
+        '''
+        for server in self._servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        '''
+        Stops serving and closes the ports
+        '''
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _write_certificate(self):
+        ## self-signed certificate for localhost, used as the cert bundle of the clients
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        certificate = (
+            x509.CertificateBuilder()
+            .subject_name(name).issuer_name(name)
+            .public_key(self._key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=30))
+            .add_extension(x509.SubjectAlternativeName([x509.DNSName("localhost"),
+                                                        x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]), critical=False)
+            .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+            .sign(self._key, hashes.SHA256())
+        )
+        with open(os.path.join(self._tempdir, "key.pem"), "w") as key_file:
+            key_file.write(_private_key_pem(self._key))
+        cert_bundle = os.path.join(self._tempdir, "bundle.pem")
+        with open(cert_bundle, "wb") as cert_file:
+            cert_file.write(certificate.public_bytes(serialization.Encoding.PEM))
+        return cert_bundle
+
+    ###################################################
+    #### Dispatch
+    ###################################################
+    def _route(self, method, pattern, operation, function):
+        ## path parameters are matched on the quoted path and unquoted afterwards
+        regex = "^" + re.sub(r"\{(\w+)\}", lambda match: "(?P<" + match.group(1) + ">" + (".+" if match.group(1) == "objectName" else "[^/]+") + ")", pattern) + "$"
+        self._routes.append((method, re.compile(regex), operation, function))
+
+    def _read_body(self, handler):
+        if handler.headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(handler.rfile.readline().split(b";")[0].strip(), 16)
+                if size == 0:
+                    handler.rfile.readline()
+                    break
+                chunks.append(handler.rfile.read(size))
+                handler.rfile.readline()
+            body = b"".join(chunks)
+        else:
+            length = int(handler.headers.get("content-length") or 0)
+            body = handler.rfile.read(length) if length else b""
+        ## compressed request bodies, see chat_request_builder.py
+        if handler.headers.get("content-encoding", "").lower() == "gzip":
+            body = gzip.decompress(body)
+        return body
+
+    def _inject_faults(self, operation):
+        with self._lock:
+            faults = self._faults.get(operation) or self._faults[None]
+        delay = faults.latency + (random.uniform(0, faults.jitter) if faults.jitter else 0)
+        if delay:
+            time.sleep(delay)
+        if faults.throttle_rate and random.random() < faults.throttle_rate:
+            raise ServiceException(429, "TooManyRequests", "Too many requests for the tenancy")
+        if faults.error_rate and random.random() < faults.error_rate:
+            raise ServiceException(500, "InternalServerError", "Injected failure of " + operation)
+
+    def _dispatch(self, handler):
+        parsed = urllib.parse.urlsplit(handler.path)
+        query = {name: values[0] for name, values in urllib.parse.parse_qs(parsed.query).items()}
+        body = self._read_body(handler)
+        request_id = uuid.uuid4().hex.upper()
+        operation = None
+        try:
+            for method, regex, route_operation, function in self._routes:
+                match = regex.match(parsed.path)
+                if match and method == handler.command:
+                    operation = route_operation
+                    break
+            else:
+                raise ServiceException(404, "NotAuthorizedOrNotFound", handler.command + " " + parsed.path + " is not served")
+            ## Counter updates are not atomic, the handler threads would lose counts
+            with self._lock:
+                self.calls[operation] += 1
+            self._inject_faults(operation)
+            params = {name: urllib.parse.unquote(value) for name, value in match.groupdict().items()}
+            headers = {name.lower(): value for name, value in handler.headers.items()}
+            reply = function(_Request(handler.command, params, query, headers, body))
+        except ServiceException as e:
+            reply = Reply({"code": e.code, "message": e.message}, status=e.status)
+        except Exception as e:
+            reply = Reply({"code": "InternalServerError", "message": str(e)}, status=500)
+        reply.headers["opc-request-id"] = request_id
+        self._send(handler, reply)
+
+    def _send(self, handler, reply):
+        if reply.events is not None:
+            handler.send_response(reply.status)
+            handler.send_header("content-type", "text/event-stream")
+            handler.send_header("transfer-encoding", "chunked")
+            for name, value in reply.headers.items():
+                handler.send_header(name, value)
+            handler.end_headers()
+            for event in reply.events:
+                data = ("data: " + json.dumps(event) + "\n\n").encode("utf-8")
+                handler.wfile.write(("%x\r\n" % len(data)).encode("ascii") + data + b"\r\n")
+                handler.wfile.flush()
+            handler.wfile.write(b"0\r\n\r\n")
+            return
+
+        if reply.body is None:
+            data = b""
+        elif isinstance(reply.body, bytes):
+            data = reply.body
+            reply.headers.setdefault("content-type", "application/octet-stream")
+        else:
+            data = json.dumps(reply.body).encode("utf-8")
+            reply.headers.setdefault("content-type", "application/json")
+        handler.send_response(reply.status)
+        reply.headers.setdefault("content-length", str(len(data)))
+        for name, value in reply.headers.items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        if handler.command != "HEAD" and data:
+            handler.wfile.write(data)
+
+    def _page(self, request, items):
+        ## list calls page with limit and page (opc-next-page)
+        limit = int(request.query.get("limit") or DEFAULT_PAGE_SIZE)
+        offset = int(request.query.get("page") or 0)
+        headers = {}
+        if offset + limit < len(items):
+            headers["opc-next-page"] = str(offset + limit)
+        return Reply(items[offset:offset + limit], headers=headers)
+
+    def _retried(self, request, create):
+        ## a create with a retry token that was already used returns the first result
+        token = request.headers.get("opc-retry-token")
+        with self._lock:
+            if token and token in self._retry_tokens:
+                return self._retry_tokens[token]
+            result = create()
+            if token:
+                self._retry_tokens[token] = result
+            return result
+
+    def _add_routes(self):
+        route = self._route
+        route("POST", "/20231130/actions/chat", "chat", self._chat)
+        route("GET", "/20240531/agentEndpoints/{agentEndpointId}", "get_agent_endpoint", self._get_agent_endpoint)
+        route("POST", "/20240531/agentEndpoints/{agentEndpointId}/sessions", "create_session", self._create_session)
+        route("DELETE", "/20240531/agentEndpoints/{agentEndpointId}/sessions/{sessionId}", "delete_session", self._delete_session)
+        route("POST", "/20240531/agentEndpoints/{agentEndpointId}/actions/chat", "agent_chat", self._agent_chat)
+        route("GET", "/20180608/vaults/{vaultId}", "get_vault", self._get_vault)
+        route("GET", "/20180608/keys", "list_keys", self._list_keys)
+        route("POST", "/20180608/keys/import", "import_key", self._import_key)
+        route("GET", "/20180608/keys/{keyId}", "get_key", self._get_key)
+        route("POST", "/20180608/keys/{keyId}/keyVersions/import", "import_key_version", self._import_key_version)
+        route("GET", "/20180608/wrappingKeys", "get_wrapping_key", self._get_wrapping_key)
+        route("POST", "/20180608/exportKey", "export_key", self._export_key)
+        route("GET", "/20180608/secrets", "list_secrets", self._list_secrets)
+        route("POST", "/20180608/secrets", "create_secret", self._create_secret)
+        route("PUT", "/20180608/secrets/{secretId}", "update_secret", self._update_secret)
+        route("GET", "/20190301/secretbundles/{secretId}", "get_secret_bundle", self._get_secret_bundle)
+        route("GET", "/n", "get_namespace", self._get_namespace)
+        route("GET", "/n/", "get_namespace", self._get_namespace)
+        route("GET", "/n/{namespaceName}/b", "list_buckets", self._list_buckets)
+        route("GET", "/n/{namespaceName}/b/{bucketName}/o", "list_objects", self._list_objects)
+        route("PUT", "/n/{namespaceName}/b/{bucketName}/o/{objectName}", "put_object", self._put_object)
+        route("GET", "/n/{namespaceName}/b/{bucketName}/o/{objectName}", "get_object", self._get_object)
+        route("HEAD", "/n/{namespaceName}/b/{bucketName}/o/{objectName}", "head_object", self._head_object)
+        route("DELETE", "/n/{namespaceName}/b/{bucketName}/o/{objectName}", "delete_object", self._delete_object)
+        route("POST", "/n/{namespaceName}/b/{bucketName}/u", "create_multipart_upload", self._create_multipart_upload)
+        route("GET", "/n/{namespaceName}/b/{bucketName}/u", "list_multipart_uploads", self._list_multipart_uploads)
+        route("PUT", "/n/{namespaceName}/b/{bucketName}/u/{objectName}", "upload_part", self._upload_part)
+        route("GET", "/n/{namespaceName}/b/{bucketName}/u/{objectName}", "list_multipart_upload_parts", self._list_multipart_upload_parts)
+        route("POST", "/n/{namespaceName}/b/{bucketName}/u/{objectName}", "commit_multipart_upload", self._commit_multipart_upload)
+        route("DELETE", "/n/{namespaceName}/b/{bucketName}/u/{objectName}", "abort_multipart_upload", self._abort_multipart_upload)
+
+    ###################################################
+    #### Generative AI
+    ###################################################
+    def _reply_words(self, prompt):
+        words = ("This is a fake reply to: " + (prompt or "")).split()
+        return [words[index % len(words)] for index in range(self.reply_tokens)]
+
+    def _chat(self, request):
+        details = request.json()
+        chat_request = details.get("chatRequest") or {}
+        is_cohere = chat_request.get("apiFormat") == "COHERE"
+        if is_cohere:
+            prompt = chat_request.get("message")
+        else:
+            prompt = ""
+            for message in chat_request.get("messages") or []:
+                if message.get("role") == "USER":
+                    prompt = " ".join(content.get("text", "") for content in message.get("content") or [])
+        words = self._reply_words(prompt)
+
+        if chat_request.get("isStream"):
+            def events():
+                for index, word in enumerate(words):
+                    if self.token_delay:
+                        time.sleep(self.token_delay)
+                    text = word if index == 0 else " " + word
+                    if is_cohere:
+                        yield {"apiFormat": "COHERE", "text": text}
+                    else:
+                        yield {"index": 0, "message": {"role": "ASSISTANT", "content": [{"type": "TEXT", "text": text}]}}
+                yield {"apiFormat": "COHERE", "finishReason": "COMPLETE"} if is_cohere else {"index": 0, "finishReason": "stop"}
+            return Reply(events=events())
+
+        if self.token_delay:
+            time.sleep(self.token_delay * len(words))
+        text = " ".join(words)
+        if is_cohere:
+            chat_response = {"apiFormat": "COHERE", "text": text, "finishReason": "COMPLETE"}
+        else:
+            chat_response = {"apiFormat": "GENERIC", "timeCreated": _now(), "choices": [{
+                "index": 0, "finishReason": "stop",
+                "message": {"role": "ASSISTANT", "content": [{"type": "TEXT", "text": text}]}}]}
+        model_id = (details.get("servingMode") or {}).get("modelId") or (details.get("servingMode") or {}).get("endpointId")
+        return Reply({"modelId": model_id, "modelVersion": "1.0", "chatResponse": chat_response})
+
+    def _endpoint(self, request):
+        endpoint = self.agent_endpoints.get(request.params["agentEndpointId"])
+        if endpoint is None:
+            raise ServiceException(404, "NotAuthorizedOrNotFound", "agent endpoint " + request.params["agentEndpointId"] + " not found")
+        return endpoint
+
+    def _get_agent_endpoint(self, request):
+        return Reply(self._endpoint(request))
+
+    def _create_session(self, request):
+        self._endpoint(request)
+        details = request.json()
+        session = {"id": _ocid("genaiagentsession"), "displayName": details.get("displayName"),
+                   "description": details.get("description"), "timeCreated": _now(), "timeUpdated": _now()}
+        with self._lock:
+            self.sessions[session["id"]] = session
+        return Reply(session)
+
+    def _delete_session(self, request):
+        with self._lock:
+            if self.sessions.pop(request.params["sessionId"], None) is None:
+                raise ServiceException(404, "NotAuthorizedOrNotFound", "session not found")
+        return Reply(status=204)
+
+    def _agent_chat(self, request):
+        self._endpoint(request)
+        details = request.json()
+        if details.get("sessionId") and details["sessionId"] not in self.sessions:
+            raise ServiceException(404, "NotAuthorizedOrNotFound", "session not found")
+        words = self._reply_words(details.get("userMessage"))
+        citations = [{"sourceText": "fake source", "title": "fake.pdf", "sourceLocation": {"sourceLocationType": "OCI_OBJECT_STORAGE",
+                                                                      "url": "https://objectstorage.example/fake.pdf"}}]
+
+        if details.get("shouldStream"):
+            def events():
+                for index, word in enumerate(words):
+                    if self.token_delay:
+                        time.sleep(self.token_delay)
+                    yield {"message": {"role": "AGENT", "content": {"text": word if index == 0 else " " + word}}}
+                yield {"message": {"role": "AGENT", "content": {"text": "", "citations": citations}}}
+            return Reply(events=events())
+
+        if self.token_delay:
+            time.sleep(self.token_delay * len(words))
+        return Reply({"message": {"role": "AGENT", "timeCreated": _now(),
+                                  "content": {"text": " ".join(words), "citations": citations}}})
+
+    ###################################################
+    #### Key management
+    ###################################################
+    def _get_vault(self, request):
+        vault = self.vaults.get(request.params["vaultId"])
+        if vault is None:
+            raise ServiceException(404, "NotAuthorizedOrNotFound", "vault not found")
+        return Reply(vault)
+
+    def _find_key(self, key_id):
+        key = self.keys.get(key_id)
+        if key is None:
+            raise ServiceException(404, "NotAuthorizedOrNotFound", "key " + str(key_id) + " not found")
+        return key
+
+    def _list_keys(self, request):
+        with self._lock:
+            keys = [dict((name, key[name]) for name in ("id", "compartmentId", "vaultId", "displayName", "protectionMode",
+                                                        "algorithm", "lifecycleState", "timeCreated", "freeformTags",
+                                                        "isAutoRotationEnabled"))
+                    for key in self.keys.values() if key["compartmentId"] == request.query.get("compartmentId")]
+        keys.sort(key=lambda key: key["timeCreated"], reverse=request.query.get("sortOrder") != "ASC")
+        return self._page(request, keys)
+
+    def _get_key(self, request):
+        return Reply(self._find_key(request.params["keyId"]))
+
+    def _get_wrapping_key(self, request):
+        public_key = self._key.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+        return Reply({"id": "ocid1.wrappingkey.oc1..fake", "compartmentId": "ocid1.compartment.oc1..fake",
+                      "publicKey": public_key.decode("ascii"), "lifecycleState": "ENABLED", "timeCreated": _now(),
+                      "vaultId": "ocid1.vault.oc1..fake"})
+
+    def _export_key(self, request):
+        details = request.json()
+        key = self._find_key(details.get("keyId"))
+        ## stands in for the key material wrapped with the public key
+        material = hashlib.sha256((key["id"] + details.get("keyVersionId", "")).encode("utf-8")).digest()
+        return Reply({"keyId": key["id"], "keyVersionId": details.get("keyVersionId"), "vaultId": key["vaultId"],
+                      "algorithm": details.get("algorithm"), "encryptedKey": base64.b64encode(material).decode("ascii"),
+                      "timeCreated": _now()})
+
+    def _import_key(self, request):
+        details = request.json()
+
+        def create():
+            ## the endpoint does not say which vault, take the vault of the compartment
+            vault_id = next((vault["id"] for vault in self.vaults.values() if vault["compartmentId"] == details["compartmentId"]), None)
+            key_id = self.add_key(details["compartmentId"], vault_id, display_name=details.get("displayName"),
+                                  protection_mode=details.get("protectionMode") or "SOFTWARE",
+                                  algorithm=details["keyShape"]["algorithm"], length=details["keyShape"]["length"])
+            self.keys[key_id]["freeformTags"] = details.get("freeformTags") or {}
+            return dict(self.keys[key_id])
+        return Reply(self._retried(request, create))
+
+    def _import_key_version(self, request):
+        key = self._find_key(request.params["keyId"])
+
+        def create():
+            self.rotate_key(key["id"])
+            return {"id": key["currentKeyVersion"], "keyId": key["id"], "vaultId": key["vaultId"],
+                    "compartmentId": key["compartmentId"], "timeCreated": _now(), "origin": "EXTERNAL"}
+        return Reply(self._retried(request, create))
+
+    ###################################################
+    #### Vault and secrets
+    ###################################################
+    def _secret(self, secret_id):
+        secret = self.secrets.get(secret_id)
+        if secret is None:
+            raise ServiceException(404, "NotAuthorizedOrNotFound", "secret " + str(secret_id) + " not found")
+        return secret
+
+    def _secret_model(self, secret):
+        model = dict((name, value) for name, value in secret.items() if name not in ("content", "versionNumber"))
+        model["currentVersionNumber"] = secret["versionNumber"]
+        return model
+
+    def _list_secrets(self, request):
+        with self._lock:
+            secrets = [self._secret_model(secret) for secret in self.secrets.values()
+                       if secret["compartmentId"] == request.query.get("compartmentId")
+                       and request.query.get("vaultId") in (None, secret["vaultId"])
+                       and request.query.get("lifecycleState") in (None, secret["lifecycleState"])]
+        return self._page(request, secrets)
+
+    def _create_secret(self, request):
+        details = request.json()
+
+        def create():
+            with self._lock:
+                if any(secret["secretName"] == details["secretName"] and secret["vaultId"] == details["vaultId"]
+                       for secret in self.secrets.values()):
+                    raise ServiceException(409, "Conflict", "secret " + details["secretName"] + " already exists")
+                secret_id = self.add_secret(details["compartmentId"], details["vaultId"], details["secretName"],
+                                            details["secretContent"]["content"], key_id=details.get("keyId"))
+                secret = self.secrets[secret_id]
+                secret["description"] = details.get("description")
+                secret["freeformTags"] = details.get("freeformTags") or {}
+                return self._secret_model(secret)
+        return Reply(self._retried(request, create))
+
+    def _update_secret(self, request):
+        details = request.json()
+        with self._lock:
+            secret = self._secret(request.params["secretId"])
+            if details.get("secretContent"):
+                secret["content"] = details["secretContent"]["content"]
+                secret["versionNumber"] += 1
+            if details.get("freeformTags") is not None:
+                secret["freeformTags"] = details["freeformTags"]
+            if details.get("description") is not None:
+                secret["description"] = details["description"]
+            return Reply(self._secret_model(secret))
+
+    def _get_secret_bundle(self, request):
+        secret = self._secret(request.params["secretId"])
+        return Reply({"secretId": secret["id"], "versionNumber": secret["versionNumber"], "stages": ["CURRENT", "LATEST"],
+                      "timeCreated": secret["timeCreated"],
+                      "secretBundleContent": {"contentType": "BASE64", "content": secret["content"]}})
+
+    ###################################################
+    #### Object storage
+    ###################################################
+    def _get_namespace(self, request):
+        return Reply(NAMESPACE)
+
+    def _object(self, request):
+        stored = self.buckets[request.params["bucketName"]].get(request.params["objectName"])
+        if stored is None:
+            raise ServiceException(404, "ObjectNotFound", "object " + request.params["objectName"] + " not found")
+        return stored
+
+    def _object_headers(self, stored):
+        headers = {"etag": stored["etag"], "last-modified": stored["timeModified"]}
+        headers["opc-multipart-md5" if "-" in stored["md5"] else "content-md5"] = stored["md5"]
+        return headers
+
+    def _store_object(self, bucket_name, object_name, data, md5):
+        stored = {"name": object_name, "data": data, "size": len(data), "md5": md5,
+                  "etag": uuid.uuid4().hex, "timeCreated": _now(), "timeModified": _now()}
+        with self._lock:
+            self.buckets[bucket_name][object_name] = stored
+        return stored
+
+    def _list_buckets(self, request):
+        ## buckets exist once an object is put in them, in every compartment
+        with self._lock:
+            buckets = [{"namespace": NAMESPACE, "name": name, "compartmentId": request.query.get("compartmentId"),
+                        "createdBy": "ocid1.user.oc1..fake", "timeCreated": _now(), "etag": name}
+                       for name in sorted(self.buckets) if self.buckets[name]]
+        return self._page(request, buckets)
+
+    def _list_objects(self, request):
+        prefix = request.query.get("prefix") or ""
+        start = request.query.get("start") or ""
+        limit = int(request.query.get("limit") or 1000)
+        with self._lock:
+            names = sorted(name for name in self.buckets[request.params["bucketName"]] if name.startswith(prefix) and name >= start)
+            objects = self.buckets[request.params["bucketName"]]
+            summaries = [dict((field, objects[name][field]) for field in ("name", "size", "md5", "etag", "timeCreated", "timeModified"))
+                         for name in names[:limit]]
+        for summary in summaries:
+            ## like object storage, multipart objects list no md5
+            if "-" in summary["md5"]:
+                summary["md5"] = None
+        body = {"objects": summaries, "prefixes": []}
+        if len(names) > limit:
+            body["nextStartWith"] = names[limit]
+        return Reply(body)
+
+    def _put_object(self, request):
+        md5 = _b64_md5(request.body)
+        if request.headers.get("content-md5") and request.headers["content-md5"] != md5:
+            raise ServiceException(400, "InvalidContentMD5", "content-md5 does not match the body")
+        stored = self._store_object(request.params["bucketName"], request.params["objectName"], request.body, md5)
+        return Reply(headers={"etag": stored["etag"], "opc-content-md5": md5, "last-modified": stored["timeModified"]})
+
+    def _get_object(self, request):
+        stored = self._object(request)
+        if request.headers.get("if-match") and request.headers["if-match"] != stored["etag"]:
+            raise ServiceException(412, "IfMatchFailed", "the object etag changed")
+        headers = self._object_headers(stored)
+        byte_range = request.headers.get("range")
+        if byte_range:
+            first, last = byte_range.replace("bytes=", "").split("-")
+            first = int(first)
+            last = min(int(last) if last else stored["size"] - 1, stored["size"] - 1)
+            headers["content-range"] = "bytes " + str(first) + "-" + str(last) + "/" + str(stored["size"])
+            return Reply(stored["data"][first:last + 1], status=206, headers=headers)
+        return Reply(stored["data"], headers=headers)
+
+    def _head_object(self, request):
+        stored = self._object(request)
+        headers = self._object_headers(stored)
+        headers["content-length"] = str(stored["size"])
+        return Reply(headers=headers)
+
+    def _delete_object(self, request):
+        self._object(request)
+        with self._lock:
+            del self.buckets[request.params["bucketName"]][request.params["objectName"]]
+        return Reply(status=204)
+
+    def _upload(self, request):
+        upload = self.uploads.get(request.query.get("uploadId"))
+        if upload is None or upload["object"] != request.params["objectName"]:
+            raise ServiceException(404, "NoSuchUpload", "upload " + str(request.query.get("uploadId")) + " not found")
+        return upload
+
+    def _create_multipart_upload(self, request):
+        details = request.json()
+        upload = {"namespace": NAMESPACE, "bucket": request.params["bucketName"], "object": details["object"],
+                  "uploadId": uuid.uuid4().hex, "timeCreated": _now(), "parts": {}}
+        with self._lock:
+            self.uploads[upload["uploadId"]] = upload
+        return Reply(dict((name, value) for name, value in upload.items() if name != "parts"))
+
+    def _list_multipart_uploads(self, request):
+        with self._lock:
+            uploads = [dict((name, value) for name, value in upload.items() if name != "parts")
+                       for upload in self.uploads.values() if upload["bucket"] == request.params["bucketName"]]
+        return self._page(request, uploads)
+
+    def _upload_part(self, request):
+        upload = self._upload(request)
+        md5 = _b64_md5(request.body)
+        if request.headers.get("content-md5") and request.headers["content-md5"] != md5:
+            raise ServiceException(400, "InvalidContentMD5", "content-md5 does not match the body")
+        part = {"partNumber": int(request.query["uploadPartNum"]), "etag": uuid.uuid4().hex, "md5": md5,
+                "size": len(request.body), "data": request.body}
+        with self._lock:
+            upload["parts"][part["partNumber"]] = part
+        return Reply(headers={"etag": part["etag"], "opc-content-md5": md5})
+
+    def _list_multipart_upload_parts(self, request):
+        upload = self._upload(request)
+        with self._lock:
+            parts = [dict((name, value) for name, value in part.items() if name != "data")
+                     for _, part in sorted(upload["parts"].items())]
+        return self._page(request, parts)
+
+    def _commit_multipart_upload(self, request):
+        upload = self._upload(request)
+        details = request.json()
+        parts = []
+        for commit in sorted(details.get("partsToCommit") or [], key=lambda commit: commit["partNum"]):
+            part = upload["parts"].get(commit["partNum"])
+            if part is None or part["etag"] != commit["etag"]:
+                raise ServiceException(400, "InvalidPart", "part " + str(commit["partNum"]) + " does not match")
+            parts.append(part)
+        md5 = _b64_md5(b"".join(base64.b64decode(part["md5"]) for part in parts)) + "-" + str(len(parts))
+        stored = self._store_object(upload["bucket"], upload["object"], b"".join(part["data"] for part in parts), md5)
+        with self._lock:
+            self.uploads.pop(upload["uploadId"], None)
+        return Reply(headers={"etag": stored["etag"], "opc-multipart-md5": md5, "last-modified": stored["timeModified"]})
+
+    def _abort_multipart_upload(self, request):
+        upload = self._upload(request)
+        with self._lock:
+            self.uploads.pop(upload["uploadId"], None)
+        return Reply(status=204)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Serve in-memory stand-ins of the OCI services used by these scripts")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080, help="http port of every service")
+    parser.add_argument("--object-storage-port", type=int, default=ROVER_OBJECT_STORAGE_PORT, help="https port of Roving Edge object storage")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every call")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random seconds added on top of latency")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of the calls answered with 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of the calls answered with 500")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="seconds between streamed chat tokens")
+    args = parser.parse_args()
+
+    server = FakeOCIServer(args.host, args.port, args.object_storage_port, token_delay=args.token_delay)
+    server.set_faults(latency=args.latency, jitter=args.jitter, throttle_rate=args.throttle_rate, error_rate=args.error_rate)
+    server.start()
+    print("Serving OCI services on " + server.url)
+    print("Serving Roving Edge object storage on " + str(server.object_storage_url) + " (cert bundle " + str(server.cert_bundle) + ")")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,456 @@
+#######################################################################
+## The following code is free to use for the general public.
+## The author makes no promises and provides no warranty.
+## This code is meant to be a starting point for others to use.
+#######################################################################
+'''
+Per-call timing of the OCI clients built by these scripts.
+
+instrument_client(client) wraps every operation of a client and records one
+entry per call (a call includes the retries the SDK makes inside it):
+  serialize    building the request and serializing the body
+  sign         preparing and signing the request
+  connect      DNS lookup and TCP connect of new connections
+  tls          TLS handshake of new connections
+  server       sending the request until the response headers arrive
+               (request upload and service time)
+  body_read    reading the response body
+  deserialize  turning the body into the response models
+  retry_wait   time between the attempts of the SDK retry strategy
+plus the status, error, opc-request-id, request and response bytes, the
+attempts made by the SDK, the call_with_backoff attempt the call belongs to
+and the connections opened.  Bodies the caller reads after the call returns
+(server-sent events, downloads) are not timed, their response_bytes is the
+announced Content-Length.
+
+Nothing is recorded until instrumentation is enabled, either in code:
+  oci_instrumentation.enable(trace_file="calls.jsonl", metrics_file="calls.prom")
+or, without changing the scripts, with environment variables:
+  OCI_CALL_TRACE=calls.jsonl    one JSON line per call
+  OCI_CALL_METRICS=calls.prom   Prometheus text format histograms, rewritten every
+                                OCI_CALL_METRICS_INTERVAL seconds (default 15) and at exit,
+                                for the node exporter textfile collector
+The scripts pass their clients through instrument_client where they are
+built, which does nothing while instrumentation is disabled.
+'''
+import atexit
+import datetime
+import functools
+import json
+import os
+import threading
+import time
+
+import oci
+
+from oci_retry import current_attempt
+
+
+## phases of a call, in order
+PHASES = ("serialize", "sign", "connect", "tls", "server", "body_read", "deserialize", "retry_wait")
+
+## upper bounds in seconds of the histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+## call being timed on this thread and the marks of its current attempt
+_state = threading.local()
+
+_recorder = None
+_recorder_lock = threading.Lock()
+_from_environment = False
+
+
+def _current():
+    return getattr(_state, "call", None)
+
+
+def _labels(**labels):
+    return ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                    for name, value in labels.items())
+
+
+class _Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield "%s_bucket{%s,le=\"%g\"} %d" % (name, labels, bound, cumulative)
+        yield "%s_bucket{%s,le=\"+Inf\"} %d" % (name, labels, self.count)
+        yield "%s_sum{%s} %.6f" % (name, labels, self.sum)
+        yield "%s_count{%s} %d" % (name, labels, self.count)
+
+
+class CallRecorder(object):
+    '''
+    Collects the timed calls, writes them to a JSONL trace and keeps Prometheus histograms
+    KWARGS:
+      trace_file(str) - append one JSON line per call to this file
+      metrics_file(str) - write the Prometheus text format metrics to this file
+      metrics_interval(float) - seconds between rewrites of metrics_file
+      buckets(tuple) - upper bounds in seconds of the histogram buckets
+    '''
+
+    def __init__(self, trace_file=None, metrics_file=None, metrics_interval=15, buckets=DEFAULT_BUCKETS):
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
+        self.buckets = buckets
+        self._trace = open(trace_file, "a") if trace_file else None
+        self._seconds = {}
+        self._phases = {}
+        self._counters = {}
+        self._last_write = time.monotonic()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def _count(self, name, labels, value=1):
+        key = (name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def record(self, call):
+        '''
+        Adds one call
+        REQUIRES:
+          call(dict) - the call, as built by the instrumented clients
+        '''
+        labels = _labels(service=call["service"], operation=call["operation"])
+        with self._lock:
+            if self._trace:
+                self._trace.write(json.dumps(call, default=str) + "\n")
+                self._trace.flush()
+            self._seconds.setdefault(labels, _Histogram(self.buckets)).observe(call["seconds"])
+            for phase in PHASES:
+                if call[phase]:
+                    phase_labels = labels + "," + _labels(phase=phase)
+                    self._phases.setdefault(phase_labels, _Histogram(self.buckets)).observe(call[phase])
+            self._count("oci_calls_total", labels + "," + _labels(status=call["status"] or call["error"] or "none"))
+            self._count("oci_call_attempts_total", labels, call["attempts"])
+            self._count("oci_call_connections_total", labels, call["connections"])
+            self._count("oci_call_request_bytes_total", labels, call["request_bytes"] or 0)
+            self._count("oci_call_response_bytes_total", labels, call["response_bytes"] or 0)
+            write = self.metrics_file and time.monotonic() - self._last_write >= self.metrics_interval
+        if write:
+            self.write_metrics()
+
+    def prometheus_text(self):
+        '''
+        RETURNS:
+          str - the metrics in the Prometheus text exposition format
+        '''
+        with self._lock:
+            lines = ["# HELP oci_call_seconds Duration of the OCI calls, SDK retries included",
+                     "# TYPE oci_call_seconds histogram"]
+            for labels, histogram in sorted(self._seconds.items()):
+                lines.extend(histogram.lines("oci_call_seconds", labels))
+            lines.extend(["# HELP oci_call_phase_seconds Time spent in each phase of the OCI calls",
+                          "# TYPE oci_call_phase_seconds histogram"])
+            for labels, histogram in sorted(self._phases.items()):
+                lines.extend(histogram.lines("oci_call_phase_seconds", labels))
+            for name in sorted(set(name for name, _ in self._counters)):
+                lines.append("# TYPE %s counter" % name)
+                for (counter, labels), value in sorted(self._counters.items()):
+                    if counter == name:
+                        lines.append("%s{%s} %d" % (name, labels, value))
+        return "\n".join(lines) + "\n"
+
+    def write_metrics(self):
+        '''
+        Rewrites metrics_file, replacing it at once so a scraper never reads half a file
+        '''
+        if not self.metrics_file:
+            return
+        with self._write_lock:
+            text = self.prometheus_text()
+            temporary_file = self.metrics_file + ".tmp"
+            with open(temporary_file, "w") as f:
+                f.write(text)
+            os.replace(temporary_file, self.metrics_file)
+            with self._lock:
+                self._last_write = time.monotonic()
+
+    def close(self):
+        '''
+        Writes the metrics one last time and closes the trace
+        '''
+        self.write_metrics()
+        with self._lock:
+            if self._trace:
+                self._trace.close()
+                self._trace = None
+
+
+def enable(trace_file=None, metrics_file=None, metrics_interval=15):
+    '''
+    Turns the instrumentation on for the clients instrumented from now on
+    KWARGS:
+      trace_file(str) - append one JSON line per call to this file
+      metrics_file(str) - write Prometheus text format metrics to this file
+      metrics_interval(float) - seconds between rewrites of metrics_file
+    RETURNS:
+      CallRecorder - the recorder of every call, closed at exit
+    '''
+    global _recorder
+    recorder = CallRecorder(trace_file, metrics_file, metrics_interval)
+    with _recorder_lock:
+        previous, _recorder = _recorder, recorder
+    if previous:
+        previous.close()
+    atexit.register(recorder.close)
+    return recorder
+
+
+def get_recorder():
+    '''
+    Returns the recorder set with enable(), or built from OCI_CALL_TRACE and OCI_CALL_METRICS
+    on first use. None while instrumentation is disabled.
+    '''
+    global _from_environment
+    if _recorder is None and not _from_environment:
+        _from_environment = True
+        trace_file = os.environ.get("OCI_CALL_TRACE")
+        metrics_file = os.environ.get("OCI_CALL_METRICS")
+        if trace_file or metrics_file:
+            enable(trace_file, metrics_file, float(os.environ.get("OCI_CALL_METRICS_INTERVAL", 15)))
+    return _recorder
+
+
+#################################################################
+## CONNECTIONS
+##   the connection pools of an instrumented session build
+##   subclasses of their usual connection class, so the OCI
+##   specific connection behavior is kept and new connections
+##   are timed
+#################################################################
+class _TimedConnection(object):
+
+    def _new_conn(self):
+        start = time.perf_counter()
+        try:
+            return super(_TimedConnection, self)._new_conn()
+        finally:
+            call = _current()
+            if call is not None:
+                call["connect"] += time.perf_counter() - start
+
+    def connect(self):
+        call = _current()
+        if call is None:
+            return super(_TimedConnection, self).connect()
+        start = time.perf_counter()
+        connect_before = call["connect"]
+        try:
+            return super(_TimedConnection, self).connect()
+        finally:
+            ## whatever connect() did besides opening the socket is the TLS handshake
+            call["tls"] += max(0.0, time.perf_counter() - start - (call["connect"] - connect_before))
+            call["connections"] += 1
+
+
+_timed_pool_classes = {}
+
+
+def _timed_pool_class(pool_class):
+    if issubclass(pool_class.ConnectionCls, _TimedConnection):
+        return pool_class
+    timed = _timed_pool_classes.get(pool_class)
+    if timed is None:
+        connection_class = type("Timed" + pool_class.ConnectionCls.__name__, (_TimedConnection, pool_class.ConnectionCls), {})
+        timed = type("Timed" + pool_class.__name__, (pool_class,), {"ConnectionCls": connection_class})
+        _timed_pool_classes[pool_class] = timed
+    return timed
+
+
+def _time_pools(pool_manager):
+    pool_manager.pool_classes_by_scheme = dict((scheme, _timed_pool_class(pool_class))
+                                               for scheme, pool_class in pool_manager.pool_classes_by_scheme.items())
+    ## pools built before this keep their untimed connections
+    pool_manager.clear()
+
+
+def _instrument_adapter(adapter):
+    if getattr(adapter, "_oci_instrumented", False) or not hasattr(adapter, "poolmanager"):
+        return
+    adapter._oci_instrumented = True
+    _time_pools(adapter.poolmanager)
+
+    ## oci_transport.configure_connection_pool builds a new pool manager
+    init_poolmanager = adapter.init_poolmanager
+
+    def timed_init_poolmanager(*args, **kwargs):
+        init_poolmanager(*args, **kwargs)
+        _time_pools(adapter.poolmanager)
+    adapter.init_poolmanager = timed_init_poolmanager
+
+    send = adapter.send
+
+    def timed_send(request, **kwargs):
+        call = _current()
+        if call is None:
+            return send(request, **kwargs)
+        opened_before = call["connect"] + call["tls"]
+        start = time.perf_counter()
+        try:
+            return send(request, **kwargs)
+        finally:
+            end = time.perf_counter()
+            _state.marks["adapter_end"] = end
+            call["server"] += max(0.0, end - start - (call["connect"] + call["tls"] - opened_before))
+    adapter.send = timed_send
+
+
+def _timed_body(call, iter_content):
+    ## the SDK reads some bodies (JSON answers of calls that accept server-sent events)
+    ## after the session returns, only reads that end inside the call are its body read
+    def timed_iter_content(*args, **kwargs):
+        start = time.perf_counter()
+        size = 0
+        for chunk in iter_content(*args, **kwargs):
+            size += len(chunk)
+            yield chunk
+        if _current() is call:
+            seconds = time.perf_counter() - start
+            call["body_read"] += seconds
+            _state.marks["body_read"] = _state.marks.get("body_read", 0.0) + seconds
+            call["response_bytes"] += size
+            call["streamed"] = False
+    return timed_iter_content
+
+
+def _instrument_session(session):
+    if getattr(session, "_oci_instrumented", False):
+        return
+    session._oci_instrumented = True
+    for adapter in session.adapters.values():
+        _instrument_adapter(adapter)
+
+    send = session.send
+
+    def timed_send(request, **kwargs):
+        call = _current()
+        if call is None:
+            return send(request, **kwargs)
+        marks = _state.marks
+        start = time.perf_counter()
+        if "send_end" not in marks:
+            call["sign"] += start - marks.get("request", start)
+        response = send(request, **kwargs)
+        end = time.perf_counter()
+        marks["send_end"] = end
+        call["status"] = response.status_code
+        call["opc_request_id"] = response.headers.get("opc-request-id")
+        call["request_bytes"] += int(request.headers.get("Content-Length") or 0)
+        if response._content_consumed:
+            call["body_read"] += end - marks.get("adapter_end", end)
+            call["response_bytes"] += len(response.content or b"")
+        else:
+            call["streamed"] = True
+            call["_content_length"] = int(response.headers.get("Content-Length") or 0)
+            response.iter_content = _timed_body(call, response.iter_content)
+        return response
+    session.send = timed_send
+
+
+#################################################################
+## CLIENTS
+#################################################################
+def _instrument_base_client(base_client):
+    call_api = base_client.call_api
+    request = base_client.request
+
+    def timed_call_api(*args, **kwargs):
+        call = _current()
+        if call is None:
+            return call_api(*args, **kwargs)
+        ## the session is replaced after some errors, time the new one too
+        _instrument_session(base_client.session)
+        call["attempts"] += 1
+        _state.marks = {}
+        start = time.perf_counter()
+        try:
+            return call_api(*args, **kwargs)
+        finally:
+            end = time.perf_counter()
+            marks = _state.marks
+            call["_attempt_seconds"] += end - start
+            call["serialize"] += marks.get("request", end) - start
+            if "send_end" in marks:
+                call["deserialize"] += end - marks["send_end"] - marks.get("body_read", 0.0)
+
+    def timed_request(*args, **kwargs):
+        if _current() is not None:
+            _state.marks["request"] = time.perf_counter()
+        return request(*args, **kwargs)
+
+    base_client.call_api = timed_call_api
+    base_client.request = timed_request
+
+
+def _wrap_operation(client, operation, function, recorder):
+
+    @functools.wraps(function)
+    def timed_operation(*args, **kwargs):
+        ## operations built on other operations are timed once, as the outer operation
+        if _current() is not None:
+            return function(*args, **kwargs)
+        call = {"time": datetime.datetime.now(datetime.timezone.utc).isoformat(), "service": client.base_client.service,
+                "operation": operation, "status": None, "error": None, "opc_request_id": None, "seconds": 0.0,
+                "attempts": 0, "backoff_attempt": current_attempt(), "connections": 0, "streamed": False,
+                "request_bytes": 0, "response_bytes": 0, "_attempt_seconds": 0.0, "_content_length": 0}
+        call.update((phase, 0.0) for phase in PHASES)
+        _state.call = call
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        except Exception as e:
+            call["error"] = type(e).__name__
+            if isinstance(e, oci.exceptions.ServiceError):
+                call["status"] = e.status
+                call["opc_request_id"] = e.request_id
+            raise
+        finally:
+            _state.call = None
+            call["seconds"] = time.perf_counter() - start
+            call["retry_wait"] = max(0.0, call["seconds"] - call.pop("_attempt_seconds"))
+            ## the caller reads streamed bodies, only their announced size is known
+            content_length = call.pop("_content_length")
+            if call["streamed"]:
+                call["response_bytes"] = content_length
+            recorder.record(call)
+    return timed_operation
+
+
+def instrument_client(client, recorder=None):
+    '''
+    Times every operation of an OCI client, does nothing while instrumentation is disabled
+    REQUIRES:
+      client(oci client) - any OCI service client
+    KWARGS:
+      recorder(CallRecorder) - where the calls go. If not provided, the recorder of enable()
+                               or of the environment variables is used
+    RETURNS:
+      the client
+    '''
+    recorder = recorder or get_recorder()
+    if recorder is None or getattr(client, "_oci_instrumented", False):
+        return client
+    client._oci_instrumented = True
+    _instrument_base_client(client.base_client)
+    _instrument_session(client.base_client.session)
+    for name, value in vars(type(client)).items():
+        if not name.startswith("_") and callable(value):
+            setattr(client, name, _wrap_operation(client, name, getattr(client, name), recorder))
+    return client
@@ -0,0 +1,192 @@
+#######################################################################
+## The following code is free to use for the general public.
+## The author makes no promises and provides no warranty.
+## This code is meant to be a starting point for others to use.
+#######################################################################
+'''
+Retry and rate limiting helpers shared by the batch scripts.
+
+The clients in these scripts are created with NoneRetryStrategy so that a
+slow or throttled call is not silently repeated inside the SDK.  Bulk jobs
+use call_with_backoff instead, which retries throttling (429), server errors
+(5xx) and connection problems with jittered exponential backoff,
+RateLimiter to keep the request rate under the service limits, and
+AdaptiveConcurrencyLimiter to lower the calls in flight when throttled.
+'''
+import random
+import threading
+import time
+
+import oci
+import requests
+
+
+## HTTP status codes that are worth retrying
+RETRYABLE_STATUS_CODES = (409, 429, 500, 502, 503, 504)
+
+## attempt of the call_with_backoff running on this thread, see current_attempt
+_attempt = threading.local()
+
+
+def is_throttled(error):
+    '''
+    Returns True if the error is the service asking us to slow down (HTTP 429)
+    '''
+    return isinstance(error, oci.exceptions.ServiceError) and error.status == 429
+
+
+def is_retryable(error):
+    '''
+    Returns True if the error is transient and the call can be retried
+    REQUIRES:
+      error(Exception) - error raised by an OCI client call
+    '''
+    if isinstance(error, oci.exceptions.ServiceError):
+        ## 409 is only transient when the resource is busy, not on real conflicts
+        if error.status == 409:
+            return error.code == "IncorrectState"
+        return error.status in RETRYABLE_STATUS_CODES
+    return isinstance(error, (
+        oci.exceptions.RequestException,
+        oci.exceptions.ConnectTimeout,
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+    ))
+
+
+def backoff_delay(attempt, base_delay=1.0, max_delay=30.0):
+    '''
+    Returns a "full jitter" delay for the given attempt number (starting at 1)
+    '''
+    return random.uniform(0, min(max_delay, base_delay * (2 ** (attempt - 1))))
+
+
+def call_with_backoff(function, *args, max_attempts=6, base_delay=1.0, max_delay=30.0, on_retry=None, **kwargs):
+    '''
+    Calls function(*args, **kwargs), retrying transient errors with jittered backoff
+    REQUIRES:
+      function(callable) - the OCI client call to make
+    KWARGS:
+      max_attempts(int) - total number of attempts before giving up
+      base_delay(float) - delay in seconds of the first retry, doubled on each attempt
+      max_delay(float) - ceiling of the delay in seconds
+      on_retry(callable) - on_retry(error, attempt, delay) is called before sleeping
+    RETURNS:
+      (result, attempts) - the value returned by function and the number of attempts made
+    '''
+    attempt = 0
+    outer_attempt = getattr(_attempt, "number", None)
+    try:
+        while True:
+            attempt += 1
+            _attempt.number = attempt
+            try:
+                return function(*args, **kwargs), attempt
+            except Exception as e:
+                if attempt >= max_attempts or not is_retryable(e):
+                    raise
+                delay = backoff_delay(attempt, base_delay, max_delay)
+                if on_retry:
+                    on_retry(e, attempt, delay)
+                time.sleep(delay)
+    finally:
+        _attempt.number = outer_attempt
+
+
+def current_attempt():
+    '''
+    Returns the attempt number of the call_with_backoff running on this thread (1 for the first
+    attempt), or None outside of call_with_backoff. Used to tag the calls of retried attempts.
+    '''
+    return getattr(_attempt, "number", None)
+
+
+class RateLimiter(object):
+    '''
+    Thread-safe token bucket limiting calls to a number per second
+    REQUIRES:
+      rate(float) - calls allowed per second (0 or None disables the limit)
+    KWARGS:
+      burst(int) - calls that can be made back to back before the limit applies
+    '''
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        Blocks until a call is allowed
+        '''
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveConcurrencyLimiter(object):
+    '''
+    Thread-safe limit on calls in flight that backs off when the service throttles.
+    The limit is halved on every throttled call and grows back by one after a
+    full window of successful calls (additive increase, multiplicative decrease).
+    REQUIRES:
+      max_limit(int) - highest number of calls in flight (usually the worker count)
+    KWARGS:
+      initial_limit(int) - starting limit. If not provided, max_limit is used
+      min_limit(int) - lowest limit the backoff goes down to
+    '''
+
+    def __init__(self, max_limit, initial_limit=None, min_limit=1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = initial_limit or max_limit
+        self.in_flight = 0
+        self.throttled = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        '''
+        Blocks until a call can start
+        '''
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        '''
+        Ends a call and adjusts the limit
+        KWARGS:
+          throttled(bool) - the call was throttled by the service
+        '''
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.on_throttle()
+            else:
+                self._successes += 1
+                if self._successes >= self.limit and self.limit < self.max_limit:
+                    self.limit += 1
+                    self._successes = 0
+            self._condition.notify_all()
+
+    def on_throttle(self):
+        '''
+        Halves the limit, called for every throttled attempt
+        '''
+        with self._condition:
+            self.throttled += 1
+            self.limit = max(self.min_limit, self.limit // 2)
+            self._successes = 0
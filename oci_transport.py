@@ -0,0 +1,36 @@
+#######################################################################
+## The following code is free to use for the general public.
+## The author makes no promises and provides no warranty.
+## This code is meant to be a starting point for others to use.
+#######################################################################
+'''
+HTTP transport helpers for OCI clients.
+
+Every OCI client owns a requests session whose HTTPS adapter keeps a pool of
+10 connections.  When one client is shared by many threads, calls beyond that
+open throw-away connections (a new TLS handshake each time).  These helpers
+resize the pool of the adapter the SDK already mounted, so the OCI-specific
+adapter behavior is kept.
+'''
+
+
+def configure_connection_pool(client, pool_maxsize, pool_connections=4, pool_block=False):
+    '''
+    Resizes the HTTPS connection pool of an OCI client
+    REQUIRES:
+      client(oci client) - any OCI service client
+      pool_maxsize(int) - connections kept open per host
+    KWARGS:
+      pool_connections(int) - number of hosts to keep pools for
+      pool_block(bool) - wait for a free connection instead of opening an extra one
+    RETURNS:
+      the client
+    '''
+    session = client.base_client.session
+    adapter = session.get_adapter("https://")
+    adapter._pool_connections = pool_connections
+    adapter._pool_maxsize = pool_maxsize
+    adapter._pool_block = pool_block
+    adapter.init_poolmanager(pool_connections, pool_maxsize, block=pool_block)
+    return client
+
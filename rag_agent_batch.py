@@ -0,0 +1,297 @@
+#########################################################################
+## The following code is free to use for the general public.
+## The author makes no promises and provides no warranty.
+## This code is meant to be a starting point for others to use.
+#########################################################################
+
+
+'''
+This script sends a file of questions to a generative AI agent endpoint in parallel, for knowledge base QA evaluation.
+It uses chat_with_ai from rag_agent_chat.py over a bounded pool of worker threads.
+Questions file:
+    Either plain text with one question per line, or JSONL with {"id": "q1", "question": "..."} per line.
+Sessions:
+    none   - every question is asked without a session
+    shared - every question uses one session (questions share the conversation context)
+    worker - every worker thread creates and reuses its own session
+Concurrency:
+    The calls in flight start at the worker count, are halved whenever the service throttles (429)
+    and grow back one at a time while calls succeed. Throttling and server errors are retried with backoff.
+Output:
+    One row per question with the answer, citations (JSON), latency, attempts and error, written in completion order.
+    CSV by default, Parquet when the output file ends in .parquet (requires pyarrow).
+Usage:
+    python rag_agent_batch.py questions.jsonl answers.csv --agent-endpoint-id ocid1.genaiagentendpoint... --workers 16
+'''
+
+import argparse
+import concurrent.futures
+import csv
+import json
+import threading
+import time
+
+import oci
+
+from oci_instrumentation import instrument_client
+from oci_retry import AdaptiveConcurrencyLimiter, call_with_backoff, is_throttled
+from oci_transport import configure_connection_pool
+from rag_agent_chat import get_session, stream_chat_with_ai
+
+
+# columns of the output file
+OUTPUT_COLUMNS = ["id", "question", "answer", "citations", "latency_seconds", "attempts", "session_id", "error"]
+
+
+def read_questions(questions_path):
+    """
+    Reads the questions file.
+
+    Args:
+        questions_path (str): Location of a text file (one question per line) or a JSONL file.
+
+    Yields:
+        dict: {"id": str, "question": str}
+    """
+    with open(questions_path) as questions_file:
+        for line_number, line in enumerate(questions_file, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                record = json.loads(line)
+                yield {"id": str(record.get("id", line_number)), "question": record["question"]}
+            else:
+                yield {"id": str(line_number), "question": line}
+
+
+def ask_question(question, agent_endpoint_id, generative_ai_agent_runtime_client, session_id=None):
+    """
+    Asks one question and collects the full answer and its citations.
+
+    Args:
+        question (str): The question to ask.
+        agent_endpoint_id (str): The OCID of the agent endpoint.
+        generative_ai_agent_runtime_client (oci.generative_ai_agent_runtime.GenerativeAiAgentRuntimeClient): The runtime client.
+        session_id (str, optional): The session to ask the question in. Defaults to None.
+
+    Returns:
+        tuple: (answer text, list of citation dicts)
+    """
+    answer = []
+    citations = []
+    for piece_type, piece in stream_chat_with_ai(question, agent_endpoint_id, generative_ai_agent_runtime_client, session_id):
+        if piece_type == "text":
+            answer.append(piece)
+        else:
+            citations.append(piece)
+    return "".join(answer), citations
+
+
+class CsvWriter:
+    """
+    Writes output rows to a CSV file.
+    """
+
+    def __init__(self, output_path):
+        self._file = open(output_path, "w", newline="")
+        self._writer = csv.DictWriter(self._file, fieldnames=OUTPUT_COLUMNS)
+        self._writer.writeheader()
+
+    def write(self, row):
+        self._writer.writerow(row)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetWriter:
+    """
+    Writes output rows to a Parquet file in row groups of batch_size rows.
+    """
+
+    def __init__(self, output_path, batch_size=1000):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("pyarrow is required to write Parquet output: pip install pyarrow")
+        self._pyarrow = pyarrow
+        self._schema = pyarrow.schema([
+            ("id", pyarrow.string()),
+            ("question", pyarrow.string()),
+            ("answer", pyarrow.string()),
+            ("citations", pyarrow.string()),
+            ("latency_seconds", pyarrow.float64()),
+            ("attempts", pyarrow.int64()),
+            ("session_id", pyarrow.string()),
+            ("error", pyarrow.string()),
+        ])
+        self._writer = pyarrow.parquet.ParquetWriter(output_path, self._schema)
+        self._batch_size = batch_size
+        self._rows = []
+
+    def write(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= self._batch_size:
+            self._flush()
+
+    def _flush(self):
+        if self._rows:
+            self._writer.write_table(self._pyarrow.Table.from_pylist(self._rows, schema=self._schema))
+            self._rows = []
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+
+def run_batch(questions_path, output_path, agent_endpoint_id, generative_ai_agent_runtime_client,
+              generative_ai_agent_client=None, workers=8, session_mode="worker", max_attempts=6):
+    """
+    Asks every question of the questions file and writes the answers.
+
+    Args:
+        questions_path (str): Location of the questions file.
+        output_path (str): Location of the CSV or Parquet output file.
+        agent_endpoint_id (str): The OCID of the agent endpoint.
+        generative_ai_agent_runtime_client (oci.generative_ai_agent_runtime.GenerativeAiAgentRuntimeClient): The runtime client, shared by the workers.
+        generative_ai_agent_client (oci.generative_ai_agent.GenerativeAiAgentClient, optional): Needed to create sessions.
+        workers (int, optional): Number of worker threads. Defaults to 8.
+        session_mode (str, optional): "none", "shared" or "worker". Defaults to "worker".
+        max_attempts (int, optional): Attempts per question on throttling and server errors. Defaults to 6.
+
+    Returns:
+        dict: Counts of answered and failed questions, throttled calls and the elapsed seconds.
+    """
+    if session_mode != "none" and generative_ai_agent_client is None:
+        raise ValueError("generative_ai_agent_client is required to create sessions")
+
+    # one connection per worker, so the workers do not queue on the default pool of 10
+    configure_connection_pool(generative_ai_agent_runtime_client, workers)
+    limiter = AdaptiveConcurrencyLimiter(workers)
+    worker_state = threading.local()
+
+    # every session the batch creates is deleted once the batch is done
+    created_sessions = []
+    created_sessions_lock = threading.Lock()
+
+    def create_session():
+        session_id = get_session(agent_endpoint_id, generative_ai_agent_runtime_client, generative_ai_agent_client)
+        # endpoints without sessions enabled give None, there is nothing to delete
+        if session_id is not None:
+            with created_sessions_lock:
+                created_sessions.append(session_id)
+        return session_id
+
+    shared_session_id = None
+
+    def get_session_id():
+        if session_mode == "shared":
+            return shared_session_id
+        if session_mode == "worker":
+            if not hasattr(worker_state, "session_id"):
+                worker_state.session_id = create_session()
+            return worker_state.session_id
+        return None
+
+    def answer(record):
+        row = {"id": record["id"], "question": record["question"], "answer": None, "citations": None,
+               "latency_seconds": None, "attempts": None, "session_id": None, "error": None}
+        start = time.perf_counter()
+        try:
+            row["session_id"] = get_session_id()
+
+            def attempt():
+                limiter.acquire()
+                throttled = False
+                try:
+                    return ask_question(record["question"], agent_endpoint_id, generative_ai_agent_runtime_client, row["session_id"])
+                except Exception as e:
+                    throttled = is_throttled(e)
+                    raise
+                finally:
+                    limiter.release(throttled=throttled)
+
+            (text, citations), row["attempts"] = call_with_backoff(attempt, max_attempts=max_attempts)
+            row["answer"] = text
+            row["citations"] = json.dumps(citations)
+        except Exception as e:
+            row["error"] = str(e)
+        row["latency_seconds"] = time.perf_counter() - start
+        return row
+
+    writer = ParquetWriter(output_path) if output_path.endswith(".parquet") else CsvWriter(output_path)
+    summary = {"answered": 0, "failed": 0}
+    start = time.perf_counter()
+    try:
+        if session_mode == "shared":
+            shared_session_id = create_session()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = set()
+
+            def write_rows(futures):
+                for future in futures:
+                    row = future.result()
+                    writer.write(row)
+                    summary["failed" if row["error"] else "answered"] += 1
+
+            for record in read_questions(questions_path):
+                # keep a short queue ahead of the workers so large files are streamed
+                if len(pending) >= workers * 2:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    write_rows(done)
+                pending.add(pool.submit(answer, record))
+
+            for future in concurrent.futures.as_completed(pending):
+                write_rows([future])
+    finally:
+        writer.close()
+        # do not leave the sessions open on the endpoint until they time out
+        for session_id in created_sessions:
+            try:
+                generative_ai_agent_runtime_client.delete_session(agent_endpoint_id, session_id)
+            except Exception as e:
+                print("Failed to delete agent session " + str(session_id) + ": " + str(e))
+
+    summary["throttled"] = limiter.throttled
+    summary["seconds"] = time.perf_counter() - start
+    return summary
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Ask a file of questions to a generative AI agent endpoint in parallel")
+    parser.add_argument("questions", help="text file with one question per line, or JSONL with id/question")
+    parser.add_argument("output", help="CSV output file, or .parquet for Parquet")
+    parser.add_argument("--agent-endpoint-id", required=True, help="OCID of the agent endpoint")
+    parser.add_argument("--region", default="us-chicago-1", help="region of the agent endpoint")
+    parser.add_argument("--workers", type=int, default=8, help="maximum concurrent calls")
+    parser.add_argument("--session", choices=["none", "shared", "worker"], default="worker", help="how agent sessions are used")
+    parser.add_argument("--max-attempts", type=int, default=6, help="attempts per question on throttling and server errors")
+    parser.add_argument("--config-file", default="~/.oci/config", help="OCI config file")
+    parser.add_argument("--profile", default="DEFAULT", help="OCI config profile")
+    args = parser.parse_args()
+
+    # get the configuration details for authentication
+    config = oci.config.from_file(file_location=args.config_file, profile_name=args.profile)
+
+    # get the clients used for asking questions
+    # per-call timings are recorded when OCI_CALL_TRACE or OCI_CALL_METRICS is set (see oci_instrumentation.py)
+    generative_ai_agent_runtime_client = instrument_client(oci.generative_ai_agent_runtime.GenerativeAiAgentRuntimeClient(
+        config,
+        service_endpoint="https://agent-runtime.generativeai." + args.region + ".oci.oraclecloud.com",
+        retry_strategy=oci.retry.NoneRetryStrategy()
+    ))
+
+    generative_ai_agent_client = instrument_client(oci.generative_ai_agent.GenerativeAiAgentClient(
+        config,
+        service_endpoint="https://agent.generativeai." + args.region + ".oci.oraclecloud.com"
+    ))
+
+    summary = run_batch(args.questions, args.output, args.agent_endpoint_id, generative_ai_agent_runtime_client,
+                        generative_ai_agent_client, workers=args.workers, session_mode=args.session,
+                        max_attempts=args.max_attempts)
+    print("answered: %(answered)d, failed: %(failed)d, throttled calls: %(throttled)d in %(seconds).1fs" % summary)
@@ -14,16 +14,58 @@
 This script interacts with a generative AI agent using Oracle Cloud Infrastructure (OCI) services. It includes functions to create a session for the AI agent and to chat with the AI agent using user input.
 Functions:
     get_session(agent_endpoint_id, generative_ai_agent_runtime_client, generative_ai_agent_client, display_name=None, description=None):
+    get_session_settings(agent_endpoint_id, generative_ai_agent_client):
+            Returns the (cached) session settings of the agent endpoint.
+    stream_chat_with_ai(user_input, agent_endpoint_id, generative_ai_agent_runtime_client, session_id=None):
+            Yields ("text", str) and ("citation", dict) pieces of the response as they arrive.
     chat_with_ai(user_input, agent_endpoint_id, generative_ai_agent_runtime_client, session_id=None):
             generative_ai_agent_runtime_client (oci.generative_ai_agent_runtime.GenerativeAiAgentRuntimeClient): The client instance used to communicate with the generative AI agent.
             session_id (str, optional): An optional session ID to maintain context across multiple interactions. Defaults to None.
             str: The AI agent's response message content.
+Classes:
+    AgentSessionPool: keeps pre-created agent sessions per agent endpoint so new conversations start instantly.
 Usage:
     The script is executed as a standalone program. It authenticates using OCI configuration, sets up the necessary clients, and enters a loop to interact with the AI agent based on user input.
 '''
 
 import oci
+import collections
 import datetime
+import json
+import threading
+import time
+
+from oci_instrumentation import instrument_client
+
+
+# session settings of each agent endpoint, looked up once per process
+_session_settings = {}
+_session_settings_lock = threading.Lock()
+
+
+def get_session_settings(agent_endpoint_id, generative_ai_agent_client):
+    """
+    Returns the session settings of an agent endpoint, calling get_agent_endpoint only the first time.
+
+    Args:
+        agent_endpoint_id (str): The OCID of the agent endpoint.
+        generative_ai_agent_client (oci.generative_ai_agent.GenerativeAiAgentClient): The client to interact with the generative AI agent.
+
+    Returns:
+        dict: should_enable_session (bool) and idle_timeout_in_seconds (int or None).
+    """
+    with _session_settings_lock:
+        settings = _session_settings.get(agent_endpoint_id)
+    if settings is None:
+        # Get the agent endpoint information
+        agent_endpoint_info: oci.generative_ai_agent.models.AgentEndpoint = generative_ai_agent_client.get_agent_endpoint(agent_endpoint_id).data
+        settings = {
+            "should_enable_session": bool(agent_endpoint_info.should_enable_session),
+            "idle_timeout_in_seconds": getattr(agent_endpoint_info.session_config, "idle_timeout_in_seconds", None),
+        }
+        with _session_settings_lock:
+            _session_settings[agent_endpoint_id] = settings
+    return settings
 
 
 def get_session(agent_endpoint_id, generative_ai_agent_runtime_client, generative_ai_agent_client, display_name=None, description=None):
@@ -53,11 +95,8 @@ def get_session(agent_endpoint_id, generative_ai_agent_runtime_client, generativ
     # Set agent OCID and endpoint
     session_id = None
 
-    # Get the agent endpoint information
-    agent_endpoint_info: oci.generative_ai_agent.models.AgentEndpoint = generative_ai_agent_client.get_agent_endpoint(agent_endpoint_id).data
-
     # if this agent expects to use a session, then create one
-    if agent_endpoint_info.should_enable_session:
+    if get_session_settings(agent_endpoint_id, generative_ai_agent_client)["should_enable_session"]:
         # Create a session
         create_session_response = generative_ai_agent_runtime_client.create_session(
             oci.generative_ai_agent_runtime.models.CreateSessionDetails(
@@ -102,6 +141,206 @@ def chat_with_ai(user_input, agent_endpoint_id, generative_ai_agent_runtime_clie
     return chat_response.message.content.text
 
 
+def _citation_to_dict(citation):
+    """
+    Converts a citation from the stream (dict) or from a response model to a dict.
+    """
+    if isinstance(citation, dict):
+        return citation
+    return {
+        "sourceText": citation.source_text,
+        "sourceLocation": oci.util.to_dict(citation.source_location),
+        "title": citation.title,
+        "docId": citation.doc_id,
+        "pageNumbers": citation.page_numbers,
+    }
+
+
+def stream_chat_with_ai(user_input, agent_endpoint_id, generative_ai_agent_runtime_client, session_id=None):
+    """
+    Interacts with a generative AI agent and yields the response as it is generated.
+
+    Args:
+        user_input (str): The message or query from the user to be sent to the AI agent.
+        agent_endpoint_id (str): The endpoint ID of the AI agent to interact with.
+        generative_ai_agent_runtime_client (oci.generative_ai_agent_runtime.GenerativeAiAgentRuntimeClient): 
+            The client instance used to communicate with the generative AI agent.
+        session_id (str, optional): An optional session ID to maintain context across multiple interactions. 
+            Defaults to None.
+
+    Yields:
+        tuple: ("text", str) for each new piece of the response message and
+            ("citation", dict) for each citation the first time it is seen.
+    """
+
+    # Chat with the AI, asking for server-sent events
+    response = generative_ai_agent_runtime_client.chat(
+                                agent_endpoint_id=agent_endpoint_id,
+                                chat_details=oci.generative_ai_agent_runtime.models.ChatDetails(
+                                                                        user_message=user_input,
+                                                                        should_stream=True,
+                                                                        session_id=session_id
+                                                                        ),
+                                allow_control_chars=True
+                                )
+
+    # if the endpoint answered with a regular response, hand it back in one piece
+    if not hasattr(response.data, "events"):
+        content = response.data.message.content
+        yield ("text", content.text)
+        for citation in content.citations or []:
+            yield ("citation", _citation_to_dict(citation))
+        return
+
+    text_so_far = ""
+    # events carry either the new text only or the full text so far; which one is settled once,
+    # by the first two events with text, and applied to every event after that
+    cumulative = None
+    seen_citations = set()
+    for event in response.data.events():
+        if not event.data or not event.data.strip().startswith("{"):
+            continue
+        content = ((json.loads(event.data).get("message") or {}).get("content")) or {}
+
+        text = content.get("text") or ""
+        if text:
+            if cumulative is None and text_so_far:
+                # a second event that repeats or extends the first is the full text so far
+                cumulative = text.startswith(text_so_far) and len(text) >= len(text_so_far)
+            if cumulative:
+                text, text_so_far = (text[len(text_so_far):] if text.startswith(text_so_far) else ""), text
+            else:
+                text_so_far += text
+        if text:
+            yield ("text", text)
+
+        for citation in content.get("citations") or []:
+            citation_key = json.dumps(citation, sort_keys=True)
+            if citation_key not in seen_citations:
+                seen_citations.add(citation_key)
+                yield ("citation", citation)
+
+
+class AgentSessionPool:
+    """
+    Keeps pre-created agent sessions for each agent endpoint so a new conversation gets a session
+    without the get_agent_endpoint and create_session round trips.
+
+    Sessions are handed out once (each conversation owns its session) and the pool is refilled
+    in the background. Pooled sessions older than the endpoint idle timeout are discarded.
+
+    Args:
+        generative_ai_agent_runtime_client (oci.generative_ai_agent_runtime.GenerativeAiAgentRuntimeClient): The client to interact with the generative AI agent runtime.
+        generative_ai_agent_client (oci.generative_ai_agent.GenerativeAiAgentClient): The client to interact with the generative AI agent.
+        size (int, optional): Number of sessions to keep ready per agent endpoint. Defaults to 2.
+        max_idle_seconds (int, optional): Age after which a pooled session is not handed out.
+            Defaults to the idle timeout of the endpoint, or one hour.
+    """
+
+    def __init__(self, generative_ai_agent_runtime_client, generative_ai_agent_client, size=2, max_idle_seconds=None):
+        self.generative_ai_agent_runtime_client = generative_ai_agent_runtime_client
+        self.generative_ai_agent_client = generative_ai_agent_client
+        self.size = size
+        self.max_idle_seconds = max_idle_seconds
+
+        # agent_endpoint_id -> deque of (created time, session id)
+        self._sessions = collections.defaultdict(collections.deque)
+        self._refilling = set()
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _max_age(self, agent_endpoint_id):
+        if self.max_idle_seconds is not None:
+            return self.max_idle_seconds
+        idle_timeout = get_session_settings(agent_endpoint_id, self.generative_ai_agent_client)["idle_timeout_in_seconds"]
+        # leave a margin so the session does not expire right after it is handed out
+        return (idle_timeout or 3600) * 0.8
+
+    def _create_session(self, agent_endpoint_id):
+        return get_session(agent_endpoint_id, self.generative_ai_agent_runtime_client, self.generative_ai_agent_client)
+
+    def _refill(self, agent_endpoint_id):
+        try:
+            while not self._closed:
+                with self._lock:
+                    if len(self._sessions[agent_endpoint_id]) >= self.size:
+                        return
+                session_id = self._create_session(agent_endpoint_id)
+                with self._lock:
+                    if not self._closed:
+                        self._sessions[agent_endpoint_id].append((time.monotonic(), session_id))
+                        continue
+                # the pool was closed while the session was being created
+                self.generative_ai_agent_runtime_client.delete_session(agent_endpoint_id, session_id)
+        except Exception as e:
+            print("Failed to pre-create agent session: " + str(e))
+        finally:
+            with self._lock:
+                self._refilling.discard(agent_endpoint_id)
+
+    def warm(self, agent_endpoint_id, wait=False):
+        """
+        Starts filling the pool for an agent endpoint.
+
+        Args:
+            agent_endpoint_id (str): The OCID of the agent endpoint.
+            wait (bool, optional): Block until the pool is full. Defaults to False.
+        """
+        with self._lock:
+            if agent_endpoint_id in self._refilling:
+                return
+            self._refilling.add(agent_endpoint_id)
+        if wait:
+            self._refill(agent_endpoint_id)
+        else:
+            threading.Thread(target=self._refill, args=(agent_endpoint_id,), daemon=True).start()
+
+    def acquire(self, agent_endpoint_id):
+        """
+        Returns a session for a new conversation, from the pool when one is ready.
+
+        Args:
+            agent_endpoint_id (str): The OCID of the agent endpoint.
+
+        Returns:
+            str: The session ID, or None if the agent endpoint does not use sessions.
+        """
+        if not get_session_settings(agent_endpoint_id, self.generative_ai_agent_client)["should_enable_session"]:
+            return None
+
+        max_age = self._max_age(agent_endpoint_id)
+        session_id = None
+        with self._lock:
+            sessions = self._sessions[agent_endpoint_id]
+            while sessions:
+                created, pooled_session_id = sessions.popleft()
+                if time.monotonic() - created < max_age:
+                    session_id = pooled_session_id
+                    break
+
+        # top the pool back up for the next conversation
+        self.warm(agent_endpoint_id)
+        if session_id is None:
+            session_id = self._create_session(agent_endpoint_id)
+        return session_id
+
+    def close(self):
+        """
+        Stops refilling and deletes the sessions that were never handed out.
+        """
+        self._closed = True
+        with self._lock:
+            pooled = [(agent_endpoint_id, session_id)
+                      for agent_endpoint_id, sessions in self._sessions.items()
+                      for _, session_id in sessions]
+            self._sessions.clear()
+        for agent_endpoint_id, session_id in pooled:
+            try:
+                self.generative_ai_agent_runtime_client.delete_session(agent_endpoint_id, session_id)
+            except Exception as e:
+                print("Failed to delete agent session " + str(session_id) + ": " + str(e))
+
+
 
     
 
@@ -118,15 +357,19 @@ if __name__ == "__main__":
     agent_endpoint_id = "ocid1.genaiagentendpoint.oc1........"
 
     # get the clients used for asking questions
-    generative_ai_agent_runtime_client = oci.generative_ai_agent_runtime.GenerativeAiAgentRuntimeClient(
+    # per-call timings are recorded when OCI_CALL_TRACE or OCI_CALL_METRICS is set (see oci_instrumentation.py)
+    generative_ai_agent_runtime_client = instrument_client(oci.generative_ai_agent_runtime.GenerativeAiAgentRuntimeClient(
         config,
         service_endpoint=agent_runtime_endpoint
-    )
+    ))
 
-    generative_ai_agent_client = oci.generative_ai_agent.GenerativeAiAgentClient(
+    generative_ai_agent_client = instrument_client(oci.generative_ai_agent.GenerativeAiAgentClient(
         config,
         service_endpoint=agent_endpoint
-    )
+    ))
+
+    # stream the response as it is generated, set to False to wait for the full answer
+    stream = True
 
     # get the session id
     session_id=get_session(agent_endpoint_id, generative_ai_agent_runtime_client, generative_ai_agent_client)
@@ -138,5 +381,16 @@ if __name__ == "__main__":
         print("-"*72)
 
         # return the response
-        print(chat_with_ai(user_input, agent_endpoint_id, generative_ai_agent_runtime_client, session_id))
+        if stream:
+            citations = []
+            for piece_type, piece in stream_chat_with_ai(user_input, agent_endpoint_id, generative_ai_agent_runtime_client, session_id):
+                if piece_type == "text":
+                    print(piece, end="", flush=True)
+                else:
+                    citations.append(piece)
+            print()
+            for number, citation in enumerate(citations, start=1):
+                print("[" + str(number) + "] " + str(citation.get("title") or citation.get("sourceLocation")))
+        else:
+            print(chat_with_ai(user_input, agent_endpoint_id, generative_ai_agent_runtime_client, session_id))
         print()
\ No newline at end of file
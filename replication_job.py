@@ -0,0 +1,241 @@
+#######################################################################
+## The following code is free to use for the general public.
+## The author makes no promises and provides no warranty.
+## This code is meant to be a starting point for others to use.
+#######################################################################
+'''
+Plan, journal and resume support shared by the vault replication scripts
+(simple_key_backup.py and simple_secret_backup.py).
+
+A job first records its plan: one item per key or secret with the action
+decided from the listings (create, update or skip) and the estimated number
+of API calls.  As the items finish, their outcome is appended to a journal
+file and flushed to disk, so an interrupted run (expired signer token,
+network blip) can be started again and only works on the items that did not
+finish.  Once a run gets to the end, failed items or not, the journal is moved
+aside and the next run starts from scratch, so keys and secrets that changed
+since are always checked again.
+
+Every entry carries the run id of the journal header, and only the entries of
+the interrupted run are resumed.  A journal older than max_age_seconds, or
+any journal with fresh=True, is moved aside instead of resumed.
+
+With dry_run the plan and the estimated API calls are printed and nothing is
+written.
+
+Usage:
+  job = ReplicationJob("keys phx->iad", "key_backup_journal.jsonl")
+  job.add(key.id, key.display_name, "create", estimated_calls=3)
+  if job.print_plan(dry_run): sys.exit(0)
+  for item in job.pending():
+    ...
+    job.record(item.item_id, "succeeded")
+  job.finish()
+'''
+import collections
+import datetime
+import json
+import os
+import threading
+import uuid
+
+# actions of a plan
+CREATE="create"
+UPDATE="update"
+SKIP="skip"
+
+# outcomes recorded in the journal, failed items are attempted again on resume
+SUCCEEDED="succeeded"
+SKIPPED="skipped"
+FAILED="failed"
+
+# journals older than this are not resumed
+max_age_seconds=24*3600
+
+PlanItem=collections.namedtuple("PlanItem", ["item_id", "name", "action", "reason", "estimated_calls"])
+
+
+class ReplicationJob(object):
+  '''
+  Plan and journal of one replication run
+  REQUIRES:
+    job_name(str) - identifies the job (for example the source and target vaults);
+                    a journal written by a different job is not resumed
+    journal_file(str) - location of the journal
+  KWARGS
+    fresh(bool) - move an existing journal aside instead of resuming it
+    max_age_seconds(float) - a journal started longer ago than this is not resumed
+  '''
+
+  def __init__(self, job_name, journal_file, fresh=False, max_age_seconds=max_age_seconds):
+    self.job_name=job_name
+    self.journal_file=journal_file
+    self.fresh=fresh
+    self.max_age_seconds=max_age_seconds
+    # a resumed run keeps the run id (and start) of the run it continues
+    self.run_id=str(uuid.uuid4())
+    self.started_at=datetime.datetime.now(datetime.timezone.utc)
+    self.plan=[]
+    self._names={}
+    self.outcomes=collections.OrderedDict()
+    self._completed=set()
+    self._lock=threading.Lock()
+    self._journal=None
+    self._load_journal()
+    # items finished by the interrupted run, the plan is printed against these
+    self._resumed_ids=frozenset(self._completed)
+
+  def _load_journal(self):
+    if not os.path.exists(self.journal_file):
+      return
+    with open(self.journal_file) as f:
+      lines=f.readlines()
+    try:
+      header=json.loads(lines[0]) if lines else {}
+    except ValueError:
+      header={}
+    try:
+      started_at=datetime.datetime.fromisoformat(header["started_at"])
+    except (KeyError, TypeError, ValueError):
+      started_at=None
+    if self.fresh or header.get("job")!=self.job_name or not header.get("run_id") or started_at is None \
+        or (self.started_at - started_at).total_seconds() > self.max_age_seconds:
+      # asked to start over, left over from another job, or too old to trust
+      self._archive()
+      return
+    self.run_id=header["run_id"]
+    self.started_at=started_at
+    for line in lines[1:]:
+      try:
+        entry=json.loads(line)
+      except ValueError:
+        # partially written line from the interrupted run
+        continue
+      if entry.get("run_id")==self.run_id and entry.get("outcome")!=FAILED:
+        self._completed.add(entry["item_id"])
+
+  @property
+  def resumed(self):
+    '''
+    True if this run continues an interrupted one
+    '''
+    return bool(self._resumed_ids)
+
+  def add(self, item_id, name, action, reason=None, estimated_calls=0):
+    '''
+    Adds a key or secret to the plan
+    REQUIRES:
+      item_id(str) - OCID of the key or secret
+      name(str) - display name or secret name
+      action(str) - CREATE, UPDATE or SKIP
+    KWARGS
+      reason(str) - why the action was chosen
+      estimated_calls(int) - API calls the action needs at most
+    RETURNS:
+      the PlanItem
+    '''
+    self.plan.append(PlanItem(item_id, name, action, reason, estimated_calls))
+    self._names[item_id]=name
+    if action==SKIP:
+      self.outcomes[item_id]=(name, SKIPPED, reason)
+    return self.plan[-1]
+
+  def is_pending(self, item):
+    '''
+    True if a plan item still needs work, so items can be started while the plan is being built
+    '''
+    return item.action!=SKIP and item.item_id not in self._completed
+
+  def pending(self):
+    '''
+    Returns the plan items that still need work (not skipped, not finished by an earlier run)
+    '''
+    return [item for item in self.plan if self.is_pending(item)]
+
+  def estimated_calls(self):
+    '''
+    Returns the API calls the pending items need at most
+    '''
+    return sum(item.estimated_calls for item in self.pending())
+
+  def print_plan(self, dry_run=False):
+    '''
+    Prints the number of items per action and the estimated API calls
+    KWARGS
+      dry_run(bool) - also list every item
+    RETURNS:
+      dry_run, so a script can stop with: if job.print_plan(dry_run): sys.exit(0)
+    '''
+    # a plan printed while its items already run still counts them as pending
+    pending=[item for item in self.plan if item.action!=SKIP and item.item_id not in self._resumed_ids]
+    counts=collections.Counter(item.action for item in self.plan)
+    print("Plan for " + self.job_name + ": " + str(counts[CREATE]) + " to create, " + str(counts[UPDATE]) + " to update, " + str(counts[SKIP]) + " to skip")
+    if self.resumed:
+      print("Resuming from " + self.journal_file + ": " + str(len(self._resumed_ids)) + " already done")
+    print(str(len(pending)) + " items pending, at most " + str(sum(item.estimated_calls for item in pending)) + " API calls")
+    if dry_run:
+      for item in self.plan:
+        done=" (done)" if item.item_id in self._resumed_ids else ""
+        print("  " + item.action.ljust(6) + " " + str(item.name) + " " + item.item_id + done + (": " + item.reason if item.reason else ""))
+    return dry_run
+
+  def record(self, item_id, outcome, reason=None, name=None):
+    '''
+    Records the outcome of an item and appends it to the journal (thread-safe)
+    REQUIRES:
+      item_id(str) - OCID of the key or secret
+      outcome(str) - SUCCEEDED, SKIPPED or FAILED, or any other label of a finished item
+    KWARGS
+      reason(str) - detail of the outcome
+      name(str) - name of the item, looked up in the plan if not provided
+    '''
+    if name is None:
+      name=self._names.get(item_id)
+    entry={"run_id":self.run_id, "item_id":item_id, "outcome":outcome, "reason":reason,
+           "time":datetime.datetime.now(datetime.timezone.utc).isoformat()}
+    with self._lock:
+      self.outcomes[item_id]=(name, outcome, reason)
+      if self._journal is None:
+        new_journal=not os.path.exists(self.journal_file)
+        self._journal=open(self.journal_file, "a")
+        if new_journal:
+          self._journal.write(json.dumps({"job":self.job_name, "run_id":self.run_id, "started_at":self.started_at.isoformat()}) + "\n")
+      self._journal.write(json.dumps(entry) + "\n")
+      self._journal.flush()
+      os.fsync(self._journal.fileno())
+      if outcome!=FAILED:
+        self._completed.add(item_id)
+
+  def summary(self):
+    '''
+    Returns the outcomes grouped by outcome: {outcome: [(item_id, name, reason), ...]}
+    '''
+    grouped=collections.OrderedDict()
+    with self._lock:
+      for item_id, (name, outcome, reason) in self.outcomes.items():
+        grouped.setdefault(outcome, []).append((item_id, name, reason))
+    return grouped
+
+  def _archive(self):
+    os.replace(self.journal_file, self.journal_file + ".done")
+
+  def close(self):
+    '''
+    Closes the journal and keeps it, for a run that stopped before its plan was complete
+    '''
+    with self._lock:
+      if self._journal is not None:
+        self._journal.close()
+        self._journal=None
+
+  def finish(self):
+    '''
+    Closes the journal and moves it aside, the run got to the end and the next one starts over
+    (failed items are attempted again then, along with the items that changed)
+    RETURNS:
+      True if every item is done
+    '''
+    self.close()
+    if os.path.exists(self.journal_file):
+      self._archive()
+    return not self.pending()
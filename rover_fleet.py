@@ -0,0 +1,343 @@
+'''
+Health and inventory of a fleet of roving edge devices.
+
+probe      - opens a TCP connection to every service port of every device at the
+             same time, with a short timeout, so a fleet is checked in about one
+             timeout instead of one per device and port
+inventory  - lists the instances, volumes, VCNs and buckets of a device, only on
+             the devices whose service port answered the probe
+snapshot   - probe and inventory of the whole fleet, every (device, resource,
+             compartment) list running in parallel, each list paging through
+             its results with the largest page size
+
+Probes and lists are cached for ttl_seconds, so later queries are answered from
+memory; two threads asking for the same list at the same time share one scan.
+The fleet builds its own clients (rover_get_clients.get_client with cache=False),
+one per device and service, so the short list_timeout never reaches the clients
+shared with RoverTransfer and the other scripts.
+
+Devices are host names, or dicts with "host_name" and an optional "cert_bundle_file".
+
+Usage:
+  fleet = RoverFleet(config, ["192.168.1.10", {"host_name": "rover-2", "cert_bundle_file": "/certs/rover-2.pem"}])
+  print(fleet.probe())
+  snapshot = fleet.snapshot(compartments=["ocid1.compartment.oc1.."])
+  python rover_fleet.py devices.json --compartment ocid1.compartment.oc1.. --output snapshot.json
+'''
+
+import oci
+import argparse
+import concurrent.futures
+import datetime
+import json
+import socket
+import sys
+import threading
+import time
+
+from oci_retry import call_with_backoff
+import rover_get_clients
+
+# client type serving each inventory list, the ports come from rover_get_clients.CLIENT_TYPES
+INVENTORY_CLIENTS = {
+  "instances": "compute",
+  "volumes": "storage",
+  "vcns": "network",
+  "buckets": "object_storage",
+}
+
+###################################################
+#### Setup Required Config
+###################################################
+# seconds a probe waits for a service port to accept the connection
+probe_timeout=2.0
+
+# seconds probe and inventory results are served from the cache
+ttl_seconds=300
+probe_ttl_seconds=30
+
+# probes and lists running at the same time across the fleet
+max_workers=32
+
+# (connect, read) timeouts of the inventory calls
+list_timeout=(3, 30)
+
+# items asked for per page of the inventory lists
+page_size=1000
+
+
+def _now():
+  return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def _device(device):
+  if isinstance(device, str):
+    return {"host_name": device, "cert_bundle_file": None}
+  return {"host_name": device["host_name"], "cert_bundle_file": device.get("cert_bundle_file")}
+
+
+def probe_port(host_name, port, timeout=probe_timeout):
+  '''
+  Opens and closes a TCP connection to a service port
+  REQUIRES:
+    host_name(str) - the hostname or IP address of the roving edge device
+    port(int) - service port
+  KWARGS
+    timeout(float) - seconds to wait for the connection, DNS lookup included
+  RETURNS:
+    {"up": bool, "seconds": time to connect, "error": reason it is down}
+  '''
+  start=time.perf_counter()
+  try:
+    with socket.create_connection((host_name, port), timeout=timeout):
+      pass
+    return {"up": True, "seconds": round(time.perf_counter() - start, 4), "error": None}
+  except OSError as e:
+    return {"up": False, "seconds": round(time.perf_counter() - start, 4), "error": str(e) or type(e).__name__}
+
+
+class RoverFleet(object):
+  '''
+  Concurrent health checks and cached inventory of roving edge devices
+  REQUIRES:
+    config(dict) - valid OCI configuration, used for every device
+    devices(list) - host names, or dicts with "host_name" and "cert_bundle_file"
+  KWARGS
+    probe_timeout(float) - seconds a probe waits for a service port
+    ttl_seconds(float) - seconds inventory results are cached
+    probe_ttl_seconds(float) - seconds probe results are cached
+    max_workers(int) - probes and lists running at the same time
+    list_timeout(tuple) - (connect, read) timeouts of the inventory calls
+    page_size(int) - items asked for per page of the inventory lists
+  '''
+
+  def __init__(self, config, devices, probe_timeout=probe_timeout, ttl_seconds=ttl_seconds, probe_ttl_seconds=probe_ttl_seconds,
+               max_workers=max_workers, list_timeout=list_timeout, page_size=page_size):
+    self.config = config
+    self.devices = [_device(device) for device in devices]
+    self.probe_timeout = probe_timeout
+    self.ttl_seconds = ttl_seconds
+    self.probe_ttl_seconds = probe_ttl_seconds
+    self.list_timeout = list_timeout
+    self.page_size = page_size
+    self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="rover-fleet")
+    # key -> (expires_at, future), a future still running is shared by every caller
+    self._cache = {}
+    self._lock = threading.Lock()
+    # (host_name, client_type) -> client of the inventory calls
+    self._clients = {}
+
+  def close(self):
+    self._pool.shutdown()
+    with self._lock:
+      for client in self._clients.values():
+        client.base_client.session.close()
+      self._clients.clear()
+
+  def _cached(self, key, ttl, function, *args):
+    with self._lock:
+      entry = self._cache.get(key)
+      if entry and (not entry[1].done() or entry[0] > time.monotonic()):
+        return entry[1]
+      future = concurrent.futures.Future()
+      self._cache[key] = (float("inf"), future)
+    try:
+      result = function(*args)
+    except Exception as e:
+      # failures are not cached, the next query tries again
+      with self._lock:
+        self._cache.pop(key, None)
+      future.set_exception(e)
+      return future
+    with self._lock:
+      self._cache[key] = (time.monotonic() + ttl, future)
+    future.set_result(result)
+    return future
+
+  def invalidate(self, host_name=None):
+    '''
+    Drops the cached probes and lists
+    KWARGS
+      host_name(str) - only drop the results of this device
+    '''
+    with self._lock:
+      for key in [key for key in self._cache if host_name is None or key[1]==host_name]:
+        del self._cache[key]
+
+  ###################################################
+  #### Health
+  ###################################################
+  def _probe_port(self, host_name, port):
+    return self._cached(("probe", host_name, port), self.probe_ttl_seconds, probe_port, host_name, port, self.probe_timeout)
+
+  def probe(self, refresh=False):
+    '''
+    Probes every service port of every device at the same time
+    KWARGS
+      refresh(bool) - ignore the cached probes
+    RETURNS:
+      {host_name: {client_type: {"up", "seconds", "error"}}}
+    '''
+    if refresh:
+      with self._lock:
+        for key in [key for key in self._cache if key[0]=="probe"]:
+          del self._cache[key]
+    futures = {}
+    for device in self.devices:
+      for client_type, (_, port) in rover_get_clients.CLIENT_TYPES.items():
+        futures[(device["host_name"], client_type)] = self._pool.submit(self._probe_port, device["host_name"], port)
+    health = {}
+    for (host_name, client_type), future in futures.items():
+      health.setdefault(host_name, {})[client_type] = future.result().result()
+    return health
+
+  ###################################################
+  #### Inventory
+  ###################################################
+  def _client(self, device, client_type):
+    key = (device["host_name"], client_type)
+    with self._lock:
+      client = self._clients.get(key)
+      if client is None:
+        # not the cached client of rover_get_clients, the timeout only applies to the fleet calls
+        client = rover_get_clients.get_client(self.config, client_type, device["host_name"], device["cert_bundle_file"], cache=False)
+        if self.list_timeout:
+          client.base_client.timeout = self.list_timeout
+        self._clients[key] = client
+    return client
+
+  def _list_all(self, function, *args, **kwargs):
+    # pages follow each other, the parallelism is across devices, resources and compartments
+    items = []
+    page = None
+    while True:
+      response = call_with_backoff(function, *args, page=page, limit=self.page_size, max_attempts=3,
+                                   retry_strategy=oci.retry.NoneRetryStrategy(), **kwargs)[0]
+      items.extend(oci.util.to_dict(response.data))
+      page = response.next_page
+      if not page:
+        return items
+
+  def _scan(self, device, resource, compartment_id):
+    client = self._client(device, INVENTORY_CLIENTS[resource])
+    if resource == "instances":
+      return self._list_all(client.list_instances, compartment_id)
+    if resource == "volumes":
+      return self._list_all(client.list_volumes, compartment_id=compartment_id)
+    if resource == "vcns":
+      return self._list_all(client.list_vcns, compartment_id=compartment_id)
+    namespace = self._cached(("namespace", device["host_name"]), self.ttl_seconds,
+                             lambda: call_with_backoff(client.get_namespace, max_attempts=3)[0].data).result()
+    return self._list_all(client.list_buckets, namespace, compartment_id)
+
+  def _inventory(self, device, resource, compartment_id):
+    port = rover_get_clients.CLIENT_TYPES[INVENTORY_CLIENTS[resource]][1]
+    if not self._probe_port(device["host_name"], port).result()["up"]:
+      raise Exception(INVENTORY_CLIENTS[resource] + " port " + str(port) + " is not reachable")
+    return self._cached(("inventory", device["host_name"], resource, compartment_id), self.ttl_seconds,
+                        self._scan, device, resource, compartment_id).result()
+
+  def inventory(self, host_name, resource, compartment_id=None, refresh=False):
+    '''
+    Lists one resource of one device, from the cache when fresh
+    REQUIRES:
+      host_name(str) - a device of the fleet
+      resource(str) - instances, volumes, vcns or buckets
+    KWARGS
+      compartment_id(str) - compartment to list. If not provided, the tenancy of the config
+      refresh(bool) - ignore the cached list
+    RETURNS:
+      list of dicts, one per resource
+    '''
+    if resource not in INVENTORY_CLIENTS:
+      raise Exception(str(resource) + " is not a valid resource")
+    device = next((device for device in self.devices if device["host_name"]==host_name), None)
+    if device is None:
+      raise Exception(str(host_name) + " is not in the fleet")
+    compartment_id = compartment_id or self.config["tenancy"]
+    if refresh:
+      with self._lock:
+        self._cache.pop(("inventory", host_name, resource, compartment_id), None)
+    return self._inventory(device, resource, compartment_id)
+
+  def snapshot(self, compartments=None, resources=None, refresh=False):
+    '''
+    Health and inventory of the whole fleet, every list running in parallel
+    KWARGS
+      compartments(list) - compartments to list. If not provided, the tenancy of the config
+      resources(list) - resources to list. If not provided, all of INVENTORY_CLIENTS
+      refresh(bool) - ignore the cached probes and lists
+    RETURNS:
+      {"taken_at", "seconds", "devices": {host_name: {"health", "inventory", "errors"}}}
+      inventory and errors are keyed by resource, then compartment
+    '''
+    start = time.perf_counter()
+    if refresh:
+      self.invalidate()
+    compartments = compartments or [self.config["tenancy"]]
+    resources = resources or list(INVENTORY_CLIENTS)
+    health = self.probe()
+
+    futures = {}
+    for device in self.devices:
+      for resource in resources:
+        for compartment_id in compartments:
+          futures[(device["host_name"], resource, compartment_id)] = self._pool.submit(self._inventory, device, resource, compartment_id)
+
+    devices = dict((host_name, {"health": device_health, "inventory": {}, "errors": {}}) for host_name, device_health in health.items())
+    for (host_name, resource, compartment_id), future in futures.items():
+      try:
+        devices[host_name]["inventory"].setdefault(resource, {})[compartment_id] = future.result()
+      except Exception as e:
+        devices[host_name]["errors"].setdefault(resource, {})[compartment_id] = str(e)
+    return {"taken_at": _now(), "seconds": round(time.perf_counter() - start, 3), "devices": devices}
+
+
+###################################################
+#### Report
+###################################################
+def print_snapshot(snapshot):
+  for host_name, device in snapshot["devices"].items():
+    up = [client_type for client_type, probe in device["health"].items() if probe["up"]]
+    print(host_name + ": " + str(len(up)) + "/" + str(len(device["health"])) + " service ports up" + (" (" + ", ".join(sorted(up)) + ")" if up else ""))
+    for resource, compartments in sorted(device["inventory"].items()):
+      print("  " + resource + ": " + str(sum(len(items) for items in compartments.values())))
+    for resource, compartments in sorted(device["errors"].items()):
+      for compartment_id, error in compartments.items():
+        print("  " + resource + " failed in " + compartment_id + ": " + error)
+  print("Snapshot of " + str(len(snapshot["devices"])) + " devices in " + str(snapshot["seconds"]) + "s")
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Probe and inventory a fleet of roving edge devices")
+  parser.add_argument("devices", help="JSON file with the list of devices (host names or {\"host_name\", \"cert_bundle_file\"})")
+  parser.add_argument("--compartment", action="append", help="compartment to list, can be repeated (default: the tenancy)")
+  parser.add_argument("--resource", action="append", choices=sorted(INVENTORY_CLIENTS), help="resource to list, can be repeated (default: all)")
+  parser.add_argument("--probe-only", action="store_true", help="only check the service ports")
+  parser.add_argument("--probe-timeout", type=float, default=probe_timeout, help="seconds a probe waits for a service port")
+  parser.add_argument("--output", help="also write the snapshot to this JSON file")
+  parser.add_argument("--config-file", default="~/.oci/config", help="OCI config file")
+  parser.add_argument("--profile", default="DEFAULT", help="OCI config profile")
+  args = parser.parse_args(argv)
+
+  with open(args.devices) as f:
+    devices = json.load(f)
+  config = oci.config.from_file(file_location=args.config_file, profile_name=args.profile)
+  fleet = RoverFleet(config, devices, probe_timeout=args.probe_timeout)
+  try:
+    if args.probe_only:
+      health = fleet.probe()
+      print(json.dumps(health, indent=1))
+      return 0 if all(probe["up"] for ports in health.values() for probe in ports.values()) else 1
+    snapshot = fleet.snapshot(compartments=args.compartment, resources=args.resource)
+  finally:
+    fleet.close()
+  print_snapshot(snapshot)
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump(snapshot, f, indent=1, default=str)
+  return 1 if any(device["errors"] for device in snapshot["devices"].values()) else 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
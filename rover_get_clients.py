@@ -1,8 +1,93 @@
 import oci
 import ocifs
 import os
+import hashlib
+import json
+import threading
 
-def get_client(config, client_type, host_name=None, cert_bundle_file=None):
+from oci_instrumentation import instrument_client
+from oci_transport import configure_connection_pool
+
+
+# client class and service port of each client type on the roving edge device
+CLIENT_TYPES = {
+  "object_storage": (oci.object_storage.ObjectStorageClient, 8019),
+  "iam": (oci.identity.IdentityClient, 12050),
+  "compute": (oci.core.ComputeClient, 19060),
+  "storage": (oci.core.BlockstorageClient, 5012),
+  "network": (oci.core.VirtualNetworkClient, 18336),
+}
+
+# connections kept open per device port, shared by every client of that port
+pool_maxsize = 32
+
+# cached clients and the shared http sessions (one per device port)
+_clients = {}
+_sessions = {}
+_lock = threading.RLock()
+
+
+def _config_identity(config):
+  '''
+  Returns a hash identifying the config (user, tenancy, key, region, ...)
+  '''
+  return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _defaults(host_name, cert_bundle_file):
+  if not host_name:
+    host_name="otec-console-local"
+
+  if not cert_bundle_file:
+    cert_bundle_file=os.path.expanduser("~") + '/.oci/bundle.pem'
+
+  return host_name, cert_bundle_file
+
+
+def _use_shared_session(client, host_name, port, cert_bundle_file):
+  '''
+  Points the client at the shared http session of the device port, creating it from this
+  client's session the first time. Must be called with _lock held.
+  '''
+  session_key = (host_name, port, cert_bundle_file)
+  session = _sessions.get(session_key)
+  if session is None:
+    client.base_client.session.verify = cert_bundle_file
+    configure_connection_pool(client, pool_maxsize)
+    _sessions[session_key] = client.base_client.session
+  elif client.base_client.session is not session:
+    client.base_client.session.close()
+    client.base_client.session = session
+
+
+def _build_client(config, client_type, host_name, cert_bundle_file, cache):
+  if client_type=="ocifs":
+      os_client=get_client(config, 'object_storage', host_name=host_name, cert_bundle_file=cert_bundle_file, cache=cache)
+      client = ocifs.OCIFileSystem(config=config)
+      # setup the ocifs client using the os_client
+      client.oci_client = os_client
+      return client
+
+  if client_type not in CLIENT_TYPES:
+    raise Exception(str(client_type) + " is not a valid client type")
+
+  client_class, port = CLIENT_TYPES[client_type]
+  # setup the client
+  client = client_class(config=config)
+  # set the rover endpoint for the client
+  client.base_client.endpoint = 'https://' + host_name + ':' + str(port)
+
+  if cache:
+    # reuse the connections (and TLS sessions) to this device port
+    _use_shared_session(client, host_name, port, cert_bundle_file)
+  else:
+    client.base_client.session.verify = cert_bundle_file
+
+  # per-call timings are recorded when OCI_CALL_TRACE or OCI_CALL_METRICS is set (see oci_instrumentation.py)
+  return instrument_client(client)
+
+
+def get_client(config, client_type, host_name=None, cert_bundle_file=None, cache=True):
   '''
   Gets the OCI client
   REQUIRES:
@@ -21,62 +106,57 @@ def get_client(config, client_type, host_name=None, cert_bundle_file=None):
                      If not provided, "otec-console-local" will be used
     cert_bundle_file(str) - location of the cert bundle to use for rover
                             If not provided, will use ~/.oci/bundle.pem
+    cache(bool) - return the client already built for the same client type, host,
+                  cert bundle and config, instead of building a new one.
+                  Cached clients of the same device port share one connection pool.
+                  Defaults to True, safe to use from multiple threads.
   RETURNS:
     specified OCI client
   '''
 
-  if not host_name:
-    host_name="otec-console-local"
+  host_name, cert_bundle_file = _defaults(host_name, cert_bundle_file)
+  client_type = client_type.lower()
 
-  if not cert_bundle_file:
-    cert_bundle_file=os.path.expanduser("~") + '/.oci/bundle.pem'
-
-
-  if client_type.lower()=="object_storage":
-      # setup the object storage client
-      client = oci.object_storage.ObjectStorageClient(config=config)
-      # set the rover endpoint for the object storage client
-      client.base_client.endpoint = 'https://' + host_name + ':8019'
-      client.base_client.session.verify = cert_bundle_file   
-
-
-  elif client_type.lower()=="ocifs":
-      os_client=get_client(config, 'object_storage', host_name=host_name, cert_bundle_file=cert_bundle_file)
-      client = ocifs.OCIFileSystem(config=config)
-      # setup the ocifs client using the os_client
-      client.oci_client = os_client
+  if not cache:
+    return _build_client(config, client_type, host_name, cert_bundle_file, cache=False)
 
+  key = (client_type, host_name, cert_bundle_file, _config_identity(config))
+  with _lock:
+    client = _clients.get(key)
+    if client is None:
+      client = _build_client(config, client_type, host_name, cert_bundle_file, cache=True)
+      _clients[key] = client
 
-  elif client_type.lower()=="iam":
-      # setup the object storage client
-      client = oci.identity.IdentityClient(config=config)
-      # set the rover endpoint for the object storage client
-      client.base_client.endpoint = 'https://' + host_name + ':12050'
-      client.base_client.session.verify = cert_bundle_file
-
+  return client
 
-  elif client_type.lower()=="compute":
-      # setup the object storage client
-      client = oci.core.ComputeClient(config=config)
-      # set the rover endpoint for the object storage client
-      client.base_client.endpoint = 'https://' + host_name + ':19060'
-      client.base_client.session.verify = cert_bundle_file
 
-  elif client_type.lower()=="storage":
-      # setup the object storage client
-      client = oci.core.BlockstorageClient(config=config)
-      # set the rover endpoint for the object storage client
-      client.base_client.endpoint = 'https://' + host_name + ':5012'
-      client.base_client.session.verify = cert_bundle_file
+def evict_client(config, client_type, host_name=None, cert_bundle_file=None):
+  '''
+  Removes a client from the cache so the next get_client builds a new one
+  REQUIRES:
+    config(dict) - the config the client was built with
+    client_type(str) - type of OCI client
+  KWARGS
+    host_name(str) - the hostname or IP address of the roving edge device
+    cert_bundle_file(str) - location of the cert bundle
+  RETURNS:
+    True if a client was evicted
+  '''
+  host_name, cert_bundle_file = _defaults(host_name, cert_bundle_file)
+  key = (client_type.lower(), host_name, cert_bundle_file, _config_identity(config))
+  with _lock:
+    return _clients.pop(key, None) is not None
 
-  elif client_type.lower()=="network":
-      # setup the object storage client
-      client = oci.core.VirtualNetworkClient(config=config)
-      # set the rover endpoint for the object storage client
-      client.base_client.endpoint = 'https://' + host_name + ':18336'
-      client.base_client.session.verify = cert_bundle_file
 
-  else:
-    raise Exception(str(client_type) + " is not a valid client type")
-  
-  return client
+def close_clients(host_name=None):
+  '''
+  Evicts the cached clients and closes their connection pools
+  KWARGS
+    host_name(str) - only close the clients of this device
+                     If not provided, all cached clients are closed
+  '''
+  with _lock:
+    for key in [key for key in _clients if host_name is None or key[1]==host_name]:
+      del _clients[key]
+    for session_key in [key for key in _sessions if host_name is None or key[0]==host_name]:
+      _sessions.pop(session_key).close()
@@ -0,0 +1,419 @@
+'''
+Parallel bulk transfers to and from the object storage of a roving edge device.
+
+Uses the object_storage client from rover_get_clients.get_client:
+  upload_file   - multipart upload with the parts sent in parallel, resuming an
+                  unfinished upload of the same object after a link drop
+  download_file - ranged parallel download into a preallocated file
+  sync_up       - uploads a directory tree, skipping objects with the same size and md5
+  sync_down     - downloads a prefix, skipping files with the same size and etag as
+                  recorded in the local .rover_sync.json manifest
+Transfer rates are reported per worker thread and in aggregate (see TransferStats).
+
+Usage:
+  transfer = RoverTransfer(config, "sensor-data", host_name="192.168.1.10", concurrency=16)
+  transfer.sync_up("/data/run42", prefix="run42/")
+  print(transfer.stats.report())
+'''
+
+import oci
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+import concurrent.futures
+
+from oci_retry import call_with_backoff
+from oci_transport import configure_connection_pool
+import rover_get_clients
+
+MB = 1024 * 1024
+
+# name of the manifest sync_down keeps in the local directory
+SYNC_MANIFEST = ".rover_sync.json"
+
+
+def _b64_md5(data):
+  return base64.b64encode(hashlib.md5(data).digest()).decode("ascii")
+
+
+def _read_range(local_path, offset, length):
+  with open(local_path, "rb") as local_file:
+    local_file.seek(offset)
+    return local_file.read(length)
+
+
+def _parts(size, part_size):
+  '''
+  Returns (part number, offset, length) of every part of a file of the given size
+  '''
+  return [(number, offset, min(part_size, size - offset))
+          for number, offset in enumerate(range(0, max(size, 1), part_size), start=1)]
+
+
+def local_md5(local_path, part_size):
+  '''
+  Computes the md5 object storage reports for a file uploaded with the given part size
+  REQUIRES:
+    local_path(str) - file to hash
+    part_size(int) - part size of the upload
+  RETURNS:
+    str - base64 md5 for single part objects, "<base64 md5 of part md5s>-<parts>" for multipart
+  '''
+  size = os.path.getsize(local_path)
+  if size <= part_size:
+    return _b64_md5(_read_range(local_path, 0, size))
+  part_digests = b"".join(hashlib.md5(_read_range(local_path, offset, length)).digest()
+                          for _, offset, length in _parts(size, part_size))
+  return _b64_md5(part_digests) + "-" + str(len(_parts(size, part_size)))
+
+
+class TransferStats(object):
+  '''
+  Thread-safe byte and time counters per worker thread
+  '''
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._workers = {}
+    self.started = None
+    self.finished = None
+
+  def record(self, byte_count, seconds):
+    '''
+    Records a transfer of byte_count bytes that took seconds on the current thread
+    '''
+    worker = threading.current_thread().name
+    now = time.perf_counter()
+    with self._lock:
+      if self.started is None:
+        self.started = now - seconds
+      self.finished = now
+      totals = self._workers.setdefault(worker, [0, 0.0])
+      totals[0] += byte_count
+      totals[1] += seconds
+
+  def report(self):
+    '''
+    RETURNS:
+      dict - total bytes, aggregate MB/s over the wall clock, and MB/s of each worker while busy
+    '''
+    with self._lock:
+      total_bytes = sum(totals[0] for totals in self._workers.values())
+      elapsed = (self.finished - self.started) if self.started is not None else 0
+      return {
+        "bytes": total_bytes,
+        "seconds": elapsed,
+        "aggregate_mb_per_second": (total_bytes / MB / elapsed) if elapsed else None,
+        "workers": {
+          worker: (totals[0] / MB / totals[1]) if totals[1] else None
+          for worker, totals in sorted(self._workers.items())
+        },
+      }
+
+
+class RoverTransfer(object):
+  '''
+  Parallel uploads, downloads and directory syncs against one bucket of a roving edge device
+  REQUIRES:
+    config(dict) - valid OCI configuration
+    bucket_name(str) - bucket on the device
+  KWARGS
+    host_name(str) - the hostname or IP address of the roving edge device
+    cert_bundle_file(str) - location of the cert bundle to use for rover
+    part_size(int) - bytes per part of multipart uploads and ranged downloads
+    concurrency(int) - parts transferred at the same time
+    file_concurrency(int) - files of a sync processed at the same time
+    max_attempts(int) - attempts per part before the transfer fails
+  '''
+
+  def __init__(self, config, bucket_name, host_name=None, cert_bundle_file=None,
+               part_size=64 * MB, concurrency=8, file_concurrency=4, max_attempts=5):
+    self.bucket_name = bucket_name
+    self.part_size = part_size
+    self.concurrency = concurrency
+    self.file_concurrency = file_concurrency
+    self.max_attempts = max_attempts
+    self.stats = TransferStats()
+
+    self.client = rover_get_clients.get_client(config, "object_storage", host_name=host_name, cert_bundle_file=cert_bundle_file)
+    if concurrency > rover_get_clients.pool_maxsize:
+      configure_connection_pool(self.client, concurrency)
+    self._namespace = None
+    self._part_pool = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="rover-part")
+
+  @property
+  def namespace(self):
+    if self._namespace is None:
+      self._namespace = self.client.get_namespace().data
+    return self._namespace
+
+  def _call(self, function, *args, **kwargs):
+    # the retries are done here, so the SDK should not retry as well
+    kwargs["retry_strategy"] = oci.retry.NoneRetryStrategy()
+    return call_with_backoff(function, *args, max_attempts=self.max_attempts, **kwargs)[0]
+
+  def close(self):
+    self._part_pool.shutdown()
+
+  def _wait_parts(self, futures):
+    '''
+    Yields the results of the part futures as they finish, cancelling the parts not
+    started yet as soon as one part fails
+    '''
+    try:
+      for future in concurrent.futures.as_completed(futures):
+        yield future.result()
+    except Exception:
+      for future in futures:
+        future.cancel()
+      raise
+
+  ###################################################
+  #### Upload
+  ###################################################
+  def _find_upload(self, object_name):
+    '''
+    Returns the newest unfinished multipart upload of the object, or None
+    '''
+    uploads = oci.pagination.list_call_get_all_results(
+      self.client.list_multipart_uploads, self.namespace, self.bucket_name
+    ).data
+    uploads = [upload for upload in uploads if upload.object == object_name]
+    if not uploads:
+      return None
+    return max(uploads, key=lambda upload: upload.time_created)
+
+  def _upload_part(self, local_path, object_name, upload_id, number, offset, length):
+    start = time.perf_counter()
+    data = _read_range(local_path, offset, length)
+    response = self._call(self.client.upload_part, self.namespace, self.bucket_name, object_name,
+                          upload_id, number, data, content_md5=_b64_md5(data))
+    self.stats.record(length, time.perf_counter() - start)
+    return number, response.headers["etag"]
+
+  def upload_file(self, local_path, object_name):
+    '''
+    Uploads a file, in parallel parts if it is larger than the part size.
+    An unfinished multipart upload of the same object is resumed: parts already
+    on the device with the same md5 are not sent again.
+    REQUIRES:
+      local_path(str) - file to upload
+      object_name(str) - name of the object in the bucket
+    RETURNS:
+      dict - object_name, bytes, parts and parts_resumed
+    '''
+    size = os.path.getsize(local_path)
+
+    if size <= self.part_size:
+      start = time.perf_counter()
+      data = _read_range(local_path, 0, size)
+      self._call(self.client.put_object, self.namespace, self.bucket_name, object_name, data, content_md5=_b64_md5(data))
+      self.stats.record(size, time.perf_counter() - start)
+      return {"object_name": object_name, "bytes": size, "parts": 1, "parts_resumed": 0}
+
+    parts = _parts(size, self.part_size)
+    done = {}
+    upload = self._find_upload(object_name)
+    if upload is not None:
+      upload_id = upload.upload_id
+      uploaded = oci.pagination.list_call_get_all_results(
+        self.client.list_multipart_upload_parts, self.namespace, self.bucket_name, object_name, upload_id
+      ).data
+      uploaded = {part.part_number: part for part in uploaded}
+      for number, offset, length in parts:
+        part = uploaded.get(number)
+        if part is not None and part.size == length and part.md5 == _b64_md5(_read_range(local_path, offset, length)):
+          done[number] = part.etag
+    else:
+      upload_id = self._call(
+        self.client.create_multipart_upload, self.namespace, self.bucket_name,
+        oci.object_storage.models.CreateMultipartUploadDetails(object=object_name)
+      ).data.upload_id
+    resumed = len(done)
+
+    futures = [self._part_pool.submit(self._upload_part, local_path, object_name, upload_id, number, offset, length)
+               for number, offset, length in parts if number not in done]
+    for number, etag in self._wait_parts(futures):
+      done[number] = etag
+
+    commit_details = oci.object_storage.models.CommitMultipartUploadDetails(
+      parts_to_commit=[oci.object_storage.models.CommitMultipartUploadPartDetails(part_num=number, etag=done[number])
+                       for number in sorted(done)]
+    )
+    self._call(self.client.commit_multipart_upload, self.namespace, self.bucket_name, object_name, upload_id, commit_details)
+    return {"object_name": object_name, "bytes": size, "parts": len(parts), "parts_resumed": resumed}
+
+  ###################################################
+  #### Download
+  ###################################################
+  def _download_range(self, object_name, local_path, offset, length, etag):
+    start = time.perf_counter()
+    # if_match fails the part if the object is replaced during the download
+    response = self._call(self.client.get_object, self.namespace, self.bucket_name, object_name,
+                          range="bytes=" + str(offset) + "-" + str(offset + length - 1), if_match=etag)
+    position = offset
+    with open(local_path, "r+b") as local_file:
+      for chunk in response.data.raw.stream(MB, decode_content=False):
+        local_file.seek(position)
+        local_file.write(chunk)
+        position += len(chunk)
+    if position - offset != length:
+      raise IOError("short read of " + object_name + " at offset " + str(offset))
+    self.stats.record(length, time.perf_counter() - start)
+
+  def download_file(self, object_name, local_path):
+    '''
+    Downloads an object with parallel ranged reads
+    REQUIRES:
+      object_name(str) - name of the object in the bucket
+      local_path(str) - file to write, replaced if it exists
+    RETURNS:
+      dict - object_name, bytes, parts and etag
+    '''
+    headers = self._call(self.client.head_object, self.namespace, self.bucket_name, object_name).headers
+    size = int(headers["content-length"])
+
+    directory = os.path.dirname(local_path)
+    if directory:
+      os.makedirs(directory, exist_ok=True)
+    # write to a temporary file so an interrupted download never looks complete
+    partial_path = local_path + ".part"
+    with open(partial_path, "wb") as local_file:
+      local_file.truncate(size)
+
+    parts = _parts(size, self.part_size) if size else []
+    futures = [self._part_pool.submit(self._download_range, object_name, partial_path, offset, length, headers.get("etag"))
+               for _, offset, length in parts]
+    for _ in self._wait_parts(futures):
+      pass
+
+    os.replace(partial_path, local_path)
+    return {"object_name": object_name, "bytes": size, "parts": len(parts), "etag": headers.get("etag")}
+
+  ###################################################
+  #### Sync
+  ###################################################
+  def list_objects(self, prefix=""):
+    '''
+    Lists the objects under a prefix
+    RETURNS:
+      dict - object name to ObjectSummary (name, size, md5, etag)
+    '''
+    objects = {}
+    start = None
+    while True:
+      data = self._call(self.client.list_objects, self.namespace, self.bucket_name,
+                        prefix=prefix or None, start=start, fields="name,size,md5,etag").data
+      for summary in data.objects:
+        objects[summary.name] = summary
+      start = data.next_start_with
+      if not start:
+        return objects
+
+  def _remote_md5(self, summary):
+    # multipart objects are listed without an md5, it is in the opc-multipart-md5 header
+    if summary.md5:
+      return summary.md5
+    headers = self._call(self.client.head_object, self.namespace, self.bucket_name, summary.name).headers
+    return headers.get("opc-multipart-md5") or headers.get("content-md5")
+
+  def _run_files(self, function, items):
+    results = {"transferred": [], "skipped": [], "failed": {}}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=self.file_concurrency, thread_name_prefix="rover-file") as pool:
+      futures = {pool.submit(function, *item): item[0] for item in items}
+      for future in concurrent.futures.as_completed(futures):
+        try:
+          future.result()
+          results["transferred"].append(futures[future])
+        except Exception as e:
+          results["failed"][futures[future]] = str(e)
+    return results
+
+  def sync_up(self, local_dir, prefix=""):
+    '''
+    Uploads a directory tree, skipping files whose object has the same size and md5
+    REQUIRES:
+      local_dir(str) - directory to upload
+    KWARGS
+      prefix(str) - prefix of the object names
+    RETURNS:
+      dict - lists of transferred and skipped paths, and the failed paths with their error
+    '''
+    remote = self.list_objects(prefix)
+    to_upload = []
+    skipped = []
+    for root, _, files in os.walk(local_dir):
+      for file_name in files:
+        local_path = os.path.join(root, file_name)
+        object_name = prefix + os.path.relpath(local_path, local_dir).replace(os.sep, "/")
+        summary = remote.get(object_name)
+        if (summary is not None and summary.size == os.path.getsize(local_path)
+                and self._remote_md5(summary) == local_md5(local_path, self.part_size)):
+          skipped.append(local_path)
+        else:
+          to_upload.append((local_path, object_name))
+
+    results = self._run_files(self.upload_file, to_upload)
+    results["skipped"] = skipped
+    return results
+
+  def sync_down(self, prefix, local_dir):
+    '''
+    Downloads the objects under a prefix, skipping files already downloaded with the same
+    size and etag (recorded in the .rover_sync.json manifest of local_dir).
+    Object names that would resolve outside local_dir (".." segments) are reported as failed.
+    REQUIRES:
+      prefix(str) - prefix of the objects to download
+      local_dir(str) - directory to download into
+    RETURNS:
+      dict - lists of transferred and skipped object names, and the failed names with their error
+    '''
+    manifest_path = os.path.join(local_dir, SYNC_MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_path):
+      with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+
+    to_download = []
+    skipped = []
+    unsafe = []
+    root = os.path.abspath(local_dir)
+    for object_name, summary in self.list_objects(prefix).items():
+      relative_name = object_name[len(prefix):]
+      # the prefix itself and folder markers have no file to download
+      if not relative_name.strip("/") or relative_name.endswith("/"):
+        skipped.append(object_name)
+        continue
+      # ".." segments and absolute names must not write outside local_dir
+      local_path = os.path.normpath(os.path.join(root, *relative_name.split("/")))
+      if os.path.commonpath([root, local_path]) != root or local_path == root:
+        unsafe.append(object_name)
+        continue
+      if (manifest.get(object_name) == summary.etag and os.path.exists(local_path)
+              and os.path.getsize(local_path) == summary.size):
+        skipped.append(object_name)
+      else:
+        to_download.append((object_name, local_path, summary.etag))
+
+    # the downloads record their etag from the file worker threads
+    manifest_lock = threading.Lock()
+
+    def download(object_name, local_path, etag):
+      self.download_file(object_name, local_path)
+      with manifest_lock:
+        manifest[object_name] = etag
+
+    os.makedirs(local_dir, exist_ok=True)
+    try:
+      results = self._run_files(download, to_download)
+    finally:
+      with manifest_lock:
+        with open(manifest_path, "w") as manifest_file:
+          json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    for object_name in unsafe:
+      results["failed"][object_name] = "object name resolves outside " + local_dir
+    results["skipped"] = skipped
+    return results
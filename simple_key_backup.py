@@ -1,4 +1,22 @@
+'''
+Backs up the software keys of a vault to a vault in another region (export and import with a wrapping key).
+Run it as a script, the config below holds the defaults and can be overridden on the command line:
+  python simple_key_backup.py --source-vault ocid1.vault.oc1.phx... --target-vault ocid1.vault.oc1.iad... --dry-run
+or import it and run KeyBackup(...).run()
+'''
 import oci
+import argparse
+import datetime
+import json
+import os
+import sys
+import threading
+import uuid
+import concurrent.futures
+
+import vault_clients
+from oci_retry import RateLimiter, call_with_backoff
+from replication_job import ReplicationJob, CREATE, UPDATE, SKIP, SUCCEEDED, SKIPPED, FAILED
 
 ###################################################
 #### Setup Required Config
@@ -16,87 +34,390 @@ target_vault="ocid1.vault.oc1.iad.."
 # the algorithm to use for the wrapping key
 wrapping_algorithm="RSA_OAEP_AES_SHA256"
 
-###################################################
-#### Define OCI Config and Clients
-###################################################
-# define the signer
-signer = oci.auth.signers.InstancePrincipalsSecurityTokenSigner()
+# concurrency and rate limits of each stage of the pipeline, keep these
+# under the KMS limits of the vaults (requests per second)
+export_workers=4
+export_rate=10
+import_workers=2
+import_rate=5
 
-# define source region config
-source_config={'region':source_region}
+# incremental mode only replicates keys that are new or have a new key version:
+#   the target compartment is listed once and its keys are matched to the source
+#   keys by their "source_key" tag, and the replicated key versions are kept in
+#   state_file so unchanged keys need no call beyond the listings.
+#   Keys with auto rotation enabled are always checked with get_key; set
+#   verify_key_versions to check every replicated key (catches manual rotations).
+incremental=True
+state_file="key_backup_state.json"
+verify_key_versions=False
 
-# define source clients
-source_kms_vault_client = oci.key_management.KmsVaultClient(source_config, signer=signer)
-source_vault_data=source_kms_vault_client.get_vault(source_vault).data
-source_service_endpoint=source_vault_data.management_endpoint
-source_crypto_endpoint=source_vault_data.crypto_endpoint
-source_kms_management_client = oci.key_management.KmsManagementClient(source_config, service_endpoint=source_service_endpoint, signer=signer)
-source_crypto_client = oci.key_management.KmsCryptoClient(source_config, service_endpoint=source_crypto_endpoint, signer=signer)
+# progress of the run is journaled to journal_file after every key, so an
+# interrupted run started again only works on the keys that did not finish.
+# dry_run prints the plan (create, update or skip per key) and the estimated
+# API calls without exporting or importing anything.
+journal_file="key_backup_journal.jsonl"
+dry_run=False
 
-# define target region config
-target_config={"region":target_region}
+# a journal is only resumed by the run that was interrupted: once a run gets
+# to the end it is moved aside, failures or not. fresh moves an interrupted
+# journal aside too, and one older than journal_max_age_hours is never resumed
+fresh=False
+journal_max_age_hours=24
 
-# define target clients
-target_kms_vault_client = oci.key_management.KmsVaultClient(target_config, signer=signer)
-target_service_endpoint=target_kms_vault_client.get_vault(target_vault).data.management_endpoint
-target_kms_management_client = oci.key_management.KmsManagementClient(target_config, service_endpoint=target_service_endpoint, signer=signer)
+# the source keys are listed one page at a time and go through the pipeline as
+# they are listed; the listing waits while max_in_flight keys are in the
+# stages, so memory stays flat and the first export starts after the first
+# page however big the vault is
+max_in_flight=100
 
 
-###################################################
-#### Get wrapping key from target vault
-###################################################
-wrapping_key_raw=target_kms_management_client.get_wrapping_key().data.public_key
-# strip new line characters from the key
-wrapping_key=wrapping_key_raw.replace("\n","")
+def limited_call(limiter, function, *args, **kwargs):
+  # every attempt, including retries, counts against the stage rate limit
+  def attempt():
+    limiter.acquire()
+    return function(*args, **kwargs)
+  return call_with_backoff(attempt)[0]
 
-###################################################
-#### Get keys from source
-###################################################
-# get keys
-source_keys=oci.pagination.list_call_get_all_results(
-  source_kms_management_client.list_keys,
-  source_compartment,
-  sort_by="TIMECREATED", 
-  sort_order="DESC"
-).data
-
-# loop through each key in the source to attempt a backup
-for key in source_keys:
-  # only attempt a backup if this is a software key, 
-  # HSM keys cannot be backed up using the export method
-  if key.protection_mode=="SOFTWARE":
+
+class KeyBackup(object):
+  '''
+  Backs up the keys of one source vault to one target vault
+  REQUIRES:
+    source_region(str), source_compartment(str), source_vault(str) - where the keys are
+    target_region(str), target_compartment(str), target_vault(str) - where the keys are copied to
+  KWARGS
+    the settings of the config section above, with the same names and defaults
+    export_limiter, import_limiter(RateLimiter) - limits shared with other backups (for example one
+                                                  per region), used instead of export_rate and import_rate
+  The clients, the vault endpoints and the wrapping key are only looked up when first needed
+  (see vault_clients.py), a dry run never builds the crypto client or gets the wrapping key.
+  '''
+
+  def __init__(self, source_region, source_compartment, source_vault, target_region, target_compartment, target_vault,
+               wrapping_algorithm=wrapping_algorithm, export_workers=export_workers, export_rate=export_rate,
+               import_workers=import_workers, import_rate=import_rate, incremental=incremental,
+               state_file=state_file, verify_key_versions=verify_key_versions, journal_file=journal_file,
+               max_in_flight=max_in_flight, fresh=fresh, journal_max_age_hours=journal_max_age_hours,
+               export_limiter=None, import_limiter=None):
+    self.source_region=source_region
+    self.source_compartment=source_compartment
+    self.source_vault=source_vault
+    self.target_region=target_region
+    self.target_compartment=target_compartment
+    self.target_vault=target_vault
+    self.wrapping_algorithm=wrapping_algorithm
+    self.export_workers=export_workers
+    self.import_workers=import_workers
+    self.incremental=incremental
+    self.state_file=state_file
+    self.verify_key_versions=verify_key_versions
+    self.journal_file=journal_file
+    self.fresh=fresh
+    self.journal_max_age_hours=journal_max_age_hours
+    self.max_in_flight=max_in_flight
+    self.export_limiter=export_limiter or RateLimiter(export_rate)
+    self.import_limiter=import_limiter or RateLimiter(import_rate)
+    self._wrapping_key=None
+    self._wrapping_key_lock=threading.Lock()
+    self._state_lock=threading.Lock()
+    self.replication_state={}
+    self.target_index={}
+    self.job=None
+
+  ###################################################
+  #### OCI Clients
+  ###################################################
+  @property
+  def source_kms_management_client(self):
+    return vault_clients.get_kms_management_client(self.source_region, self.source_vault)
+
+  @property
+  def source_crypto_client(self):
+    return vault_clients.get_kms_crypto_client(self.source_region, self.source_vault)
+
+  @property
+  def target_kms_management_client(self):
+    return vault_clients.get_kms_management_client(self.target_region, self.target_vault)
+
+  ###################################################
+  #### Get wrapping key from target vault
+  ###################################################
+  @property
+  def wrapping_key(self):
+    with self._wrapping_key_lock:
+      if self._wrapping_key is None:
+        wrapping_key_raw=limited_call(self.import_limiter, self.target_kms_management_client.get_wrapping_key).data.public_key
+        # strip new line characters from the key
+        self._wrapping_key=wrapping_key_raw.replace("\n","")
+    return self._wrapping_key
+
+  ###################################################
+  #### Incremental state
+  ###################################################
+  def load_state(self):
+    # source key id -> {"target_key": id, "key_version": id, "time_replicated": iso time}
+    if self.incremental and os.path.exists(self.state_file):
+      with open(self.state_file) as f:
+        self.replication_state=json.load(f)
+
+    # source key id -> id of its copy in the target compartment, only the ids
+    # are kept from each page of key summaries
+    if self.incremental:
+      target_keys=oci.pagination.list_call_get_all_results_generator(
+        self.target_kms_management_client.list_keys,
+        "record",
+        self.target_compartment
+      )
+      for target_key_summary in target_keys:
+        tags=target_key_summary.freeform_tags or {}
+        if tags.get("source_vault")==self.source_vault and "source_key" in tags \
+            and target_key_summary.lifecycle_state not in ("DELETED", "DELETING", "PENDING_DELETION", "SCHEDULING_DELETION"):
+          self.target_index[tags["source_key"]]=target_key_summary.id
+
+  def save_state(self):
+    # save the replicated versions for the next incremental run
+    if self.incremental:
+      with open(self.state_file + ".tmp", "w") as f:
+        json.dump(self.replication_state, f, indent=1, sort_keys=True)
+      os.replace(self.state_file + ".tmp", self.state_file)
+
+  ###################################################
+  #### Backup pipeline
+  ###################################################
+  # the keys flow through two stages that overlap:
+  #   export - get_key and export_key against the source vault
+  #   import - import_key (new keys) or import_key_version (rotated keys)
+  #            against the target vault
+  # each stage has its own worker pool and rate limit, and throttled or
+  # failed calls are retried with backoff
+  def record(self, outcome, key, reason=None):
+    self.job.record(key.id, outcome, reason, name=key.display_name)
+
+  def record_replicated(self, key, target_key_id, key_version):
+    with self._state_lock:
+      self.replication_state[key.id]={
+        "target_key":target_key_id,
+        "key_version":key_version,
+        "time_replicated":datetime.datetime.now(datetime.timezone.utc).isoformat()
+      }
+
+  def export_stage(self, key, target_key_id, known_version):
     # get details of the key
-    current_key_data=source_kms_management_client.get_key(key.id).data
+    current_key_data=limited_call(self.export_limiter, self.source_kms_management_client.get_key, key.id).data
+    key_version=current_key_data.current_key_version
+    # the target already has this version, nothing to export
+    if target_key_id and (known_version is None or known_version==key_version):
+      return current_key_data, None
     # export the key using the wrapping key from the target vault
-    export_key_details = oci.key_management.models.ExportKeyDetails(key_id=key.id, algorithm=wrapping_algorithm, public_key=wrapping_key)
-    exported_key=source_crypto_client.export_key(export_key_details).data.encrypted_key
+    export_key_details = oci.key_management.models.ExportKeyDetails(key_id=key.id, key_version_id=key_version, algorithm=self.wrapping_algorithm, public_key=self.wrapping_key)
+    exported_key=limited_call(self.export_limiter, self.source_crypto_client.export_key, export_key_details).data.encrypted_key
+    return current_key_data, exported_key
+
+  def import_stage(self, key, target_key_id, current_key_data, exported_key):
+    wrapped_import_key = oci.key_management.models.WrappedImportKey(
+      key_material=exported_key,
+      wrapping_algorithm=self.wrapping_algorithm
+    )
+
+    # a rotated key gets the new version added to its existing copy
+    if target_key_id:
+      import_key_version_details=oci.key_management.models.ImportKeyVersionDetails(wrapped_import_key=wrapped_import_key)
+      limited_call(self.import_limiter, self.target_kms_management_client.import_key_version, target_key_id, import_key_version_details, opc_retry_token=str(uuid.uuid4()))
+      return target_key_id
 
+    key_shape=oci.key_management.models.KeyShape(
+      algorithm=key.algorithm,
+      length=int(current_key_data.key_shape.length)
+    )
+
+    import_key_details=oci.key_management.models.ImportKeyDetails(
+      compartment_id=self.target_compartment,
+      display_name=key.display_name,
+      key_shape=key_shape,
+      protection_mode=key.protection_mode,
+      wrapped_import_key=wrapped_import_key,
+      freeform_tags={"source_vault":self.source_vault, "source_key":key.id}
+    )
+
+    # the retry token makes a retried import (after a timeout or 5xx) return the
+    # key created by the first attempt instead of a duplicate
+    return limited_call(self.import_limiter, self.target_kms_management_client.import_key, import_key_details, opc_retry_token=str(uuid.uuid4())).data.id
+
+  ###################################################
+  #### Get keys from source and run the pipeline
+  ###################################################
+  def start_job(self):
+    # plan and outcome of every key, journaled as the keys finish and printed at the end
+    self.job=ReplicationJob("keys " + self.source_vault + " " + self.source_compartment + " -> " + self.target_vault + " " + self.target_compartment, self.journal_file,
+                         fresh=self.fresh, max_age_seconds=self.journal_max_age_hours*3600)
+    self.load_state()
+
+  def source_keys(self):
+    # get keys, one page at a time as they are consumed
+    return oci.pagination.list_call_get_all_results_generator(
+      self.source_kms_management_client.list_keys,
+      "record",
+      self.source_compartment,
+      sort_by="TIMECREATED",
+      sort_order="DESC"
+    )
+
+  def plan_key(self, key):
+    # plan a key from the listings: get_key, export_key and import_key for a
+    # new key; get_key and, if the version changed, export_key and
+    # import_key_version for a key that was replicated before
+    target_key_id=self.target_index.get(key.id)
+    state=self.replication_state.get(key.id) or {}
+    # only attempt a backup if this is a software key,
+    # HSM keys cannot be backed up using the export method
+    if key.protection_mode!="SOFTWARE":
+      return self.job.add(key.id, key.display_name, SKIP, "not a SOFTWARE key")
     # only backup enabled keys
-    if key.lifecycle_state=="ENABLED":
+    if key.lifecycle_state!="ENABLED":
+      return self.job.add(key.id, key.display_name, SKIP, "key is " + str(key.lifecycle_state))
+    # the copy exists and its version is known, trust the state file
+    if target_key_id and state.get("target_key")==target_key_id and not self.verify_key_versions \
+        and not getattr(key, "is_auto_rotation_enabled", False):
+      return self.job.add(key.id, key.display_name, SKIP, "unchanged since " + str(state.get("time_replicated")))
+    if target_key_id:
+      return self.job.add(key.id, key.display_name, UPDATE, "check for a new key version", estimated_calls=3)
+    return self.job.add(key.id, key.display_name, CREATE, estimated_calls=3)
 
-      key_shape=oci.key_management.models.KeyShape(
-        algorithm=key.algorithm,
-        length=int(current_key_data.key_shape.length)
-      )
+  def plan(self):
+    '''
+    Lists the source keys and plans each of them, without running anything
+    RETURNS:
+      the ReplicationJob with the plan
+    '''
+    self.start_job()
+    for key in self.source_keys():
+      self.plan_key(key)
+    return self.job
 
-      wrapped_import_key = oci.key_management.models.WrappedImportKey(
-        key_material=exported_key,
-        wrapping_algorithm=wrapping_algorithm
-      )
+  def run(self, dry_run=False):
+    '''
+    Plans the keys and, unless dry_run, backs up the pending ones as they are listed
+    KWARGS
+      dry_run(bool) - only print the plan
+    RETURNS:
+      the ReplicationJob with the plan and the outcome of every key
+    '''
+    if dry_run:
+      self.plan().print_plan(dry_run)
+      return self.job
 
-      import_key_details=oci.key_management.models.ImportKeyDetails(
-        compartment_id=target_compartment,
-        display_name=key.display_name,
-        key_shape=key_shape,
-        protection_mode=key.protection_mode,
-        wrapped_import_key=wrapped_import_key,
-        freeform_tags={"source_vault":source_vault, "source_key":key.id}
-      )
+    self.start_job()
+    export_pool=concurrent.futures.ThreadPoolExecutor(max_workers=self.export_workers)
+    import_pool=concurrent.futures.ThreadPoolExecutor(max_workers=self.import_workers)
+    in_flight=threading.BoundedSemaphore(self.max_in_flight)
+
+    def run_import(key, target_key_id, current_key_data, exported_key):
+      try:
+        target_key_id=self.import_stage(key, target_key_id, current_key_data, exported_key)
+        self.record_replicated(key, target_key_id, current_key_data.current_key_version)
+        self.record(SUCCEEDED, key)
+      except Exception as e:
+        self.record(FAILED, key, "import: " + str(e))
+      finally:
+        in_flight.release()
 
+    def hand_off(key, target_key_id, export_future):
+      # called when the export finishes, queues the import of the key
       try:
-        response=target_kms_management_client.import_key(import_key_details)
+        current_key_data, exported_key=export_future.result()
       except Exception as e:
-        print("Failed to backup key " + key.id + ": " + str(e))
+        self.record(FAILED, key, "export: " + str(e))
+        in_flight.release()
+        return
+      if exported_key is None:
+        self.record_replicated(key, target_key_id, current_key_data.current_key_version)
+        self.record(SKIPPED, key, "key version already replicated")
+        in_flight.release()
+        return
+      import_pool.submit(run_import, key, target_key_id, current_key_data, exported_key)
+
+    # plan the keys as the pages arrive and run the ones that are pending right
+    # away, keys finished by an interrupted run are left out
+    listed=False
+    try:
+      for key in self.source_keys():
+        item=self.plan_key(key)
+        if not self.job.is_pending(item):
+          continue
+        in_flight.acquire()
+        target_key_id=self.target_index.get(key.id)
+        state=self.replication_state.get(key.id) or {}
+        # a copy without a recorded version is taken as current and recorded
+        known_version=state.get("key_version") if state.get("target_key")==target_key_id else None
+        export_future=export_pool.submit(self.export_stage, key, target_key_id, known_version)
+        export_future.add_done_callback(lambda future, key=key, target_key_id=target_key_id: hand_off(key, target_key_id, future))
+
+      # the listing is done, the plan is complete while the last keys go through
+      self.job.print_plan()
+      listed=True
+    finally:
+      # wait for the exports (and the hand off callbacks, which run on the export
+      # workers), then for the imports they queued; the keys started before a
+      # failed listing are journaled, and the journal is kept for the next run
+      export_pool.shutdown(wait=True)
+      import_pool.shutdown(wait=True)
+      if listed:
+        self.job.finish()
+      else:
+        self.job.close()
+      self.save_state()
+    return self.job
+
+
+###################################################
+#### Summary
+###################################################
+def print_summary(job):
+  summary=job.summary()
+  print("Backed up " + str(len(summary.get(SUCCEEDED, []))) + " keys, skipped " + str(len(summary.get(SKIPPED, []))) + ", failed " + str(len(summary.get(FAILED, []))))
+  for key_id, display_name, reason in summary.get(SKIPPED, []):
+    print("Skipped " + key_id + " (" + str(display_name) + "): " + reason)
+  for key_id, display_name, reason in summary.get(FAILED, []):
+    print("Failed to backup key " + key_id + " (" + str(display_name) + "): " + reason)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Back up the software keys of a vault to a vault in another region")
+  parser.add_argument("--source-region", default=source_region)
+  parser.add_argument("--source-compartment", default=source_compartment)
+  parser.add_argument("--source-vault", default=source_vault)
+  parser.add_argument("--target-region", default=target_region)
+  parser.add_argument("--target-compartment", default=target_compartment)
+  parser.add_argument("--target-vault", default=target_vault)
+  parser.add_argument("--wrapping-algorithm", default=wrapping_algorithm)
+  parser.add_argument("--export-workers", type=int, default=export_workers)
+  parser.add_argument("--export-rate", type=float, default=export_rate, help="export calls per second")
+  parser.add_argument("--import-workers", type=int, default=import_workers)
+  parser.add_argument("--import-rate", type=float, default=import_rate, help="import calls per second")
+  parser.add_argument("--full", dest="incremental", action="store_false", default=incremental, help="check every key, ignore the state file")
+  parser.add_argument("--state-file", default=state_file)
+  parser.add_argument("--verify-key-versions", action="store_true", default=verify_key_versions, help="check the version of every replicated key")
+  parser.add_argument("--journal-file", default=journal_file)
+  parser.add_argument("--fresh", action="store_true", default=fresh, help="start over instead of resuming an interrupted run")
+  parser.add_argument("--journal-max-age-hours", type=float, default=journal_max_age_hours, help="do not resume a journal older than this")
+  parser.add_argument("--max-in-flight", type=int, default=max_in_flight, help="keys listed ahead of the pipeline")
+  parser.add_argument("--dry-run", action="store_true", default=dry_run, help="print the plan and the estimated API calls only")
+  args = parser.parse_args(argv)
+
+  backup=KeyBackup(args.source_region, args.source_compartment, args.source_vault,
+                   args.target_region, args.target_compartment, args.target_vault,
+                   wrapping_algorithm=args.wrapping_algorithm,
+                   export_workers=args.export_workers, export_rate=args.export_rate,
+                   import_workers=args.import_workers, import_rate=args.import_rate,
+                   incremental=args.incremental, state_file=args.state_file,
+                   verify_key_versions=args.verify_key_versions, journal_file=args.journal_file,
+                   fresh=args.fresh, journal_max_age_hours=args.journal_max_age_hours,
+                   max_in_flight=args.max_in_flight)
+  job=backup.run(dry_run=args.dry_run)
+  if not args.dry_run:
+    print_summary(job)
+  return 1 if job.summary().get(FAILED) else 0
+
 
-  else:
-    print("Could not backup key " + key.id + " because it's not a SOFTWARE key")
\ No newline at end of file
+if __name__ == "__main__":
+  sys.exit(main())
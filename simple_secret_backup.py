@@ -1,4 +1,21 @@
+'''
+Backs up the secrets of a vault to a vault in another region.
+Run it as a script, the config below holds the defaults and can be overridden on the command line:
+  python simple_secret_backup.py --source-vault ocid1.vault.oc1.phx... --target-vault ocid1.vault.oc1.iad... --target-key ocid1.key.oc1.iad...
+or import it and run SecretBackup(...).run()
+'''
 import oci
+import argparse
+import collections
+import hashlib
+import sys
+import threading
+import uuid
+import concurrent.futures
+
+import vault_clients
+from oci_retry import RateLimiter, call_with_backoff
+from replication_job import ReplicationJob, CREATE, UPDATE, FAILED
 
 ###################################################
 #### Setup Required Config
@@ -14,84 +31,349 @@ target_compartment="ocid1.compartment.oc1.."
 target_vault="ocid1.vault.oc1.iad.."
 target_key="ocid1.key.oc1.iad.."
 
-###################################################
-#### Define OCI Config and Clients
-###################################################
-# define the signer
-signer = oci.auth.signers.InstancePrincipalsSecurityTokenSigner()
+# concurrency and rate limits (requests per second) of the reads from each
+# region and of the writes to the target vault
+read_workers=8
+source_read_rate=20
+target_read_rate=20
+write_workers=4
+write_rate=5
 
-# define source region config
-source_config={'region':source_region}
+# progress of the run is journaled to journal_file after every secret, so an
+# interrupted run started again only works on the secrets that did not finish.
+# dry_run prints the plan (create or update per secret) and the estimated API
+# calls without reading secret contents or writing anything.
+journal_file="secret_backup_journal.jsonl"
+dry_run=False
 
-# define source clients
-source_vaults_client = oci.vault.VaultsClient(source_config, signer=signer)
-source_secrets_client= oci.secrets.SecretsClient(source_config, signer=signer)
+# a journal is only resumed by the run that was interrupted: once a run gets
+# to the end it is moved aside, failures or not. fresh moves an interrupted
+# journal aside too, and one older than journal_max_age_hours is never resumed
+fresh=False
+journal_max_age_hours=24
 
-# define target region config
-target_config={"region":target_region}
+# the source secrets are listed one page at a time and go through the sync as
+# they are listed; the listing waits while max_in_flight secrets are being
+# read or written, so memory stays flat and the first copy starts after the
+# first page however big the vault is
+max_in_flight=100
 
-# define target clients
-target_vaults_client = oci.vault.VaultsClient(target_config, signer=signer)
-target_secrets_client= oci.secrets.SecretsClient(target_config, signer=signer)
+# what is kept of each target secret summary: its id and the tags that record what was copied
+TargetSecret=collections.namedtuple("TargetSecret", ["id", "freeform_tags"])
 
-###################################################
-#### Get list of existing Target Secrets
-###################################################
-# get secrets from the target
-target_secrets = oci.pagination.list_call_get_all_results(
-    target_vaults_client.list_secrets,
-    target_compartment,
-    vault_id=target_vault,
-    # lifecycle_state="ACTIVE"
-).data
 
-# load screts into list
-target_secrets_list={}
-for secret in target_secrets:
-  target_secrets_list[secret.secret_name]=secret.id
+def limited_call(limiter, function, *args, **kwargs):
+  # every attempt, including retries, counts against the rate limit
+  def attempt():
+    limiter.acquire()
+    return function(*args, **kwargs)
+  return call_with_backoff(attempt)[0]
+
+def content_digest(content):
+  return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class SecretBackup(object):
+  '''
+  Backs up the secrets of one source vault to one target vault
+  REQUIRES:
+    source_region(str), source_compartment(str), source_vault(str) - where the secrets are
+    target_region(str), target_compartment(str), target_vault(str) - where the secrets are copied to
+    target_key(str) - key of the target vault that encrypts the copies
+  KWARGS
+    the settings of the config section above, with the same names and defaults
+    source_read_limiter, target_read_limiter, write_limiter(RateLimiter) - limits shared with other backups
+                         (for example one per region), used instead of the matching rates
+  The clients are only built when first needed (see vault_clients.py), a dry run never
+  builds the secrets clients.
+  '''
+
+  def __init__(self, source_region, source_compartment, source_vault, target_region, target_compartment, target_vault, target_key,
+               read_workers=read_workers, source_read_rate=source_read_rate, target_read_rate=target_read_rate,
+               write_workers=write_workers, write_rate=write_rate, journal_file=journal_file, max_in_flight=max_in_flight,
+               fresh=fresh, journal_max_age_hours=journal_max_age_hours,
+               source_read_limiter=None, target_read_limiter=None, write_limiter=None):
+    self.source_region=source_region
+    self.source_compartment=source_compartment
+    self.source_vault=source_vault
+    self.target_region=target_region
+    self.target_compartment=target_compartment
+    self.target_vault=target_vault
+    self.target_key=target_key
+    self.read_workers=read_workers
+    self.write_workers=write_workers
+    self.journal_file=journal_file
+    self.fresh=fresh
+    self.journal_max_age_hours=journal_max_age_hours
+    self.max_in_flight=max_in_flight
+    self.source_read_limiter=source_read_limiter or RateLimiter(source_read_rate)
+    self.target_read_limiter=target_read_limiter or RateLimiter(target_read_rate)
+    self.write_limiter=write_limiter or RateLimiter(write_rate)
+    self.target_secrets_list={}
+    self.job=None
+
+  ###################################################
+  #### OCI Clients
+  ###################################################
+  @property
+  def source_vaults_client(self):
+    return vault_clients.get_client("vaults", self.source_region)
+
+  @property
+  def source_secrets_client(self):
+    return vault_clients.get_client("secrets", self.source_region)
+
+  @property
+  def target_vaults_client(self):
+    return vault_clients.get_client("vaults", self.target_region)
+
+  @property
+  def target_secrets_client(self):
+    return vault_clients.get_client("secrets", self.target_region)
+
+  ###################################################
+  #### Get list of existing Target Secrets
+  ###################################################
+  def load_target_secrets(self):
+    # get secrets from the target, one page at a time
+    target_secrets = oci.pagination.list_call_get_all_results_generator(
+        self.target_vaults_client.list_secrets,
+        "record",
+        self.target_compartment,
+        vault_id=self.target_vault,
+        # lifecycle_state="ACTIVE"
+    )
+
+    # load secrets into list by name, keeping only the id and the tags that record what was copied
+    for secret in target_secrets:
+      self.target_secrets_list[secret.secret_name]=TargetSecret(secret.id, secret.freeform_tags)
+
+  ###################################################
+  #### Sync engine
+  ###################################################
+  # every secret goes through a read stage and, only if it changed, a write stage:
+  #   read  - get the source bundle; the copy is up to date if its "source_version"
+  #           tag matches. Otherwise the target bundle is read as well (at the same
+  #           time as the source when the copy has no tag) and the contents compared
+  #   write - create the secret, update its content, or only record the source
+  #           version in the tags when the content was already the same
+  # writes therefore only create a new secret version when the content changed
+  def record(self, outcome, secret, reason=None):
+    self.job.record(secret.id, outcome, reason, name=secret.secret_name)
+
+  def get_source_bundle(self, secret):
+    return limited_call(self.source_read_limiter, self.source_secrets_client.get_secret_bundle, secret.id).data
+
+  def get_target_content(self, target_secret):
+    return limited_call(self.target_read_limiter, self.target_secrets_client.get_secret_bundle, target_secret.id).data.secret_bundle_content.content
+
+  def read_stage(self, secret, target_read_pool):
+    target_secret=self.target_secrets_list.get(secret.secret_name)
+    if target_secret is None:
+      return "create", self.get_source_bundle(secret)
+
+    tags=target_secret.freeform_tags or {}
+    if "source_version" in tags:
+      source_bundle=self.get_source_bundle(secret)
+      if tags["source_version"]==str(source_bundle.version_number):
+        return "unchanged", source_bundle
+      target_content=self.get_target_content(target_secret)
+    else:
+      # nothing recorded on the copy yet, read both sides at the same time
+      target_future=target_read_pool.submit(self.get_target_content, target_secret)
+      source_bundle=self.get_source_bundle(secret)
+      target_content=target_future.result()
+
+    if content_digest(target_content)==content_digest(source_bundle.secret_bundle_content.content):
+      return "tag", source_bundle
+    return "update", source_bundle
+
+  def sync_tags(self, secret, source_bundle, existing_tags=None):
+    tags=dict(existing_tags or {})
+    tags.update({"source_vault":self.source_vault, "source_secret":secret.id, "source_version":str(source_bundle.version_number)})
+    return tags
+
+  def write_stage(self, secret, action, source_bundle):
+    secret_content=source_bundle.secret_bundle_content.content
+    target_secret=self.target_secrets_list.get(secret.secret_name)
+    if action=="tag":
+      # content is already the same, only record the source version (no new secret version)
+      secrets_details = oci.vault.models.UpdateSecretDetails(freeform_tags=self.sync_tags(secret, source_bundle, target_secret.freeform_tags))
+      limited_call(self.write_limiter, self.target_vaults_client.update_secret, target_secret.id, secrets_details)
+    elif action=="update":
+      # if it exists, update the existing secret
+      secret_content_details = oci.vault.models.Base64SecretContentDetails(content_type=oci.vault.models.SecretContentDetails.CONTENT_TYPE_BASE64,
+                                                                           stage="CURRENT",
+                                                                           content=secret_content)
+      secrets_details = oci.vault.models.UpdateSecretDetails(secret_content=secret_content_details,
+                                                             freeform_tags=self.sync_tags(secret, source_bundle, target_secret.freeform_tags))
+      limited_call(self.write_limiter, self.target_vaults_client.update_secret, target_secret.id, secrets_details)
+    else:
+      # it doesn't exist, so add a new secret
+      secret_content_details = oci.vault.models.Base64SecretContentDetails(content_type=oci.vault.models.SecretContentDetails.CONTENT_TYPE_BASE64,
+                                                                           name=secret.secret_name,
+                                                                           stage="CURRENT",
+                                                                           content=secret_content)
+      secrets_details = oci.vault.models.CreateSecretDetails(compartment_id=self.target_compartment,
+                                                             description=secret.description,
+                                                             secret_content=secret_content_details,
+                                                             secret_name=secret.secret_name,
+                                                             vault_id=self.target_vault,
+                                                             key_id=self.target_key,
+                                                             freeform_tags=self.sync_tags(secret, source_bundle))
+      # the retry token keeps a retried create from failing on the secret it already created
+      limited_call(self.write_limiter, self.target_vaults_client.create_secret, secrets_details, opc_retry_token=str(uuid.uuid4()))
+
+  ###################################################
+  #### Get the source secrets and sync them
+  ###################################################
+  def start_job(self):
+    # plan and outcome of every secret, journaled as the secrets finish and printed at the end
+    self.job=ReplicationJob("secrets " + self.source_vault + " " + self.source_compartment + " -> " + self.target_vault + " " + self.target_compartment, self.journal_file,
+                         fresh=self.fresh, max_age_seconds=self.journal_max_age_hours*3600)
+    self.load_target_secrets()
+
+  def source_secrets(self):
+    # get secrets from the source, one page at a time as they are consumed
+    return oci.pagination.list_call_get_all_results_generator(
+        self.source_vaults_client.list_secrets,
+        "record",
+        self.source_compartment,
+        vault_id=self.source_vault,
+        lifecycle_state="ACTIVE"
+    )
+
+  def plan_secret(self, secret):
+    # plan a secret from the listings: get_secret_bundle and create_secret for a
+    # new secret; up to both bundles and update_secret for one that was copied before
+    if secret.secret_name in self.target_secrets_list:
+      return self.job.add(secret.id, secret.secret_name, UPDATE, "update if changed", estimated_calls=3)
+    return self.job.add(secret.id, secret.secret_name, CREATE, estimated_calls=2)
+
+  def plan(self):
+    '''
+    Lists the source and target secrets and plans each source secret, without running anything
+    RETURNS:
+      the ReplicationJob with the plan
+    '''
+    self.start_job()
+    for secret in self.source_secrets():
+      self.plan_secret(secret)
+    return self.job
+
+  def run(self, dry_run=False):
+    '''
+    Plans the secrets and, unless dry_run, syncs the pending ones as they are listed
+    KWARGS
+      dry_run(bool) - only print the plan
+    RETURNS:
+      the ReplicationJob with the plan and the outcome of every secret
+    '''
+    if dry_run:
+      self.plan().print_plan(dry_run)
+      return self.job
+
+    self.start_job()
+    read_pool=concurrent.futures.ThreadPoolExecutor(max_workers=self.read_workers)
+    target_read_pool=concurrent.futures.ThreadPoolExecutor(max_workers=self.read_workers)
+    write_pool=concurrent.futures.ThreadPoolExecutor(max_workers=self.write_workers)
+    in_flight=threading.BoundedSemaphore(self.max_in_flight)
+
+    def run_write(secret, action, source_bundle):
+      try:
+        self.write_stage(secret, action, source_bundle)
+        self.record("created" if action=="create" else "updated" if action=="update" else "unchanged", secret)
+      except Exception as e:
+        self.record(FAILED, secret, "write: " + str(e))
+      finally:
+        in_flight.release()
+
+    def hand_off(secret, read_future):
+      # called when the read finishes, queues the write if the secret changed
+      try:
+        action, source_bundle=read_future.result()
+      except Exception as e:
+        self.record(FAILED, secret, "read: " + str(e))
+        in_flight.release()
+        return
+      if action=="unchanged":
+        self.record("unchanged", secret)
+        in_flight.release()
+      else:
+        write_pool.submit(run_write, secret, action, source_bundle)
+
+    # Loop through the secrets of the source vault as the pages arrive and sync
+    # the pending ones right away, secrets finished by an interrupted run are left out
+    listed=False
+    try:
+      for secret in self.source_secrets():
+        item=self.plan_secret(secret)
+        if not self.job.is_pending(item):
+          continue
+        in_flight.acquire()
+        read_future=read_pool.submit(self.read_stage, secret, target_read_pool)
+        read_future.add_done_callback(lambda future, secret=secret: hand_off(secret, future))
+
+      # the listing is done, the plan is complete while the last secrets go through
+      self.job.print_plan()
+      listed=True
+    finally:
+      # wait for the reads (and the hand off callbacks, which run on the read
+      # workers), then for the writes they queued; the secrets started before a
+      # failed listing are journaled, and the journal is kept for the next run
+      read_pool.shutdown(wait=True)
+      target_read_pool.shutdown(wait=True)
+      write_pool.shutdown(wait=True)
+      if listed:
+        self.job.finish()
+      else:
+        self.job.close()
+    return self.job
 
 
 ###################################################
-#### Get the source secrets
+#### Summary
 ###################################################
-# get secrets from the source
-source_secrets = oci.pagination.list_call_get_all_results(
-    source_vaults_client.list_secrets,
-    source_compartment,
-    vault_id=source_vault,
-    lifecycle_state="ACTIVE"
-).data
-
-# Loop through list of secrets in source vault to add to target
-for secret in source_secrets:
-  print("Backing up " + secret.secret_name)
-  # get the secret content from the source
-  secret_content=source_secrets_client.get_secret_bundle(secret.id).data.secret_bundle_content.content
-  # check if the secret already exists
-  if secret.secret_name in target_secrets_list:
-    # if it exists, update the existing secret
-    secret_content_details = oci.vault.models.Base64SecretContentDetails(content_type=oci.vault.models.SecretContentDetails.CONTENT_TYPE_BASE64,
-                                                                         stage="CURRENT",
-                                                                         content=secret_content)
-    secrets_details = oci.vault.models.UpdateSecretDetails(secret_content=secret_content_details)
-    try:
-      result=target_vaults_client.update_secret(target_secrets_list[secret.secret_name], secrets_details)
-    except Exception as e:
-      print("Failed to backup " + secret.secret_name + ": " + str(e))
-  else:
-    # it doesn't exist, so add a new secret
-    secret_content_details = oci.vault.models.Base64SecretContentDetails(content_type=oci.vault.models.SecretContentDetails.CONTENT_TYPE_BASE64, 
-                                                                         name=secret.secret_name, 
-                                                                         stage="CURRENT", 
-                                                                         content=secret_content)
-    secrets_details = oci.vault.models.CreateSecretDetails(compartment_id=target_compartment, 
-                                                           description=secret.description, 
-                                                           secret_content=secret_content_details, 
-                                                           secret_name=secret.secret_name, 
-                                                           vault_id=target_vault,
-                                                           key_id=target_key)
-    try:
-      result=target_vaults_client.create_secret(secrets_details)
-    except Exception as e:
-      print("Failed to backup " + secret.secret_name + ": " + str(e))
+def print_summary(job):
+  summary=job.summary()
+  print("Created " + str(len(summary.get("created", []))) + " secrets, updated " + str(len(summary.get("updated", []))) + ", unchanged " + str(len(summary.get("unchanged", []))) + ", failed " + str(len(summary.get(FAILED, []))))
+  for secret_id, secret_name, reason in summary.get(FAILED, []):
+    print("Failed to backup " + secret_name + ": " + reason)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Back up the secrets of a vault to a vault in another region")
+  parser.add_argument("--source-region", default=source_region)
+  parser.add_argument("--source-compartment", default=source_compartment)
+  parser.add_argument("--source-vault", default=source_vault)
+  parser.add_argument("--target-region", default=target_region)
+  parser.add_argument("--target-compartment", default=target_compartment)
+  parser.add_argument("--target-vault", default=target_vault)
+  parser.add_argument("--target-key", default=target_key, help="key of the target vault that encrypts the copies")
+  parser.add_argument("--read-workers", type=int, default=read_workers)
+  parser.add_argument("--source-read-rate", type=float, default=source_read_rate, help="source reads per second")
+  parser.add_argument("--target-read-rate", type=float, default=target_read_rate, help="target reads per second")
+  parser.add_argument("--write-workers", type=int, default=write_workers)
+  parser.add_argument("--write-rate", type=float, default=write_rate, help="writes per second")
+  parser.add_argument("--journal-file", default=journal_file)
+  parser.add_argument("--fresh", action="store_true", default=fresh, help="start over instead of resuming an interrupted run")
+  parser.add_argument("--journal-max-age-hours", type=float, default=journal_max_age_hours, help="do not resume a journal older than this")
+  parser.add_argument("--max-in-flight", type=int, default=max_in_flight, help="secrets listed ahead of the sync")
+  parser.add_argument("--dry-run", action="store_true", default=dry_run, help="print the plan and the estimated API calls only")
+  args = parser.parse_args(argv)
+
+  backup=SecretBackup(args.source_region, args.source_compartment, args.source_vault,
+                      args.target_region, args.target_compartment, args.target_vault, args.target_key,
+                      read_workers=args.read_workers, source_read_rate=args.source_read_rate,
+                      target_read_rate=args.target_read_rate, write_workers=args.write_workers,
+                      write_rate=args.write_rate, journal_file=args.journal_file,
+                      fresh=args.fresh, journal_max_age_hours=args.journal_max_age_hours,
+                      max_in_flight=args.max_in_flight)
+  job=backup.run(dry_run=args.dry_run)
+  if not args.dry_run:
+    print_summary(job)
+  return 1 if job.summary().get(FAILED) else 0
+
 
+if __name__ == "__main__":
+  sys.exit(main())
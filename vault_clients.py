@@ -0,0 +1,152 @@
+#######################################################################
+## The following code is free to use for the general public.
+## The author makes no promises and provides no warranty.
+## This code is meant to be a starting point for others to use.
+#######################################################################
+'''
+Lazily built, cached clients for the vault replication scripts.
+
+Nothing is created until it is first used: the instance principals signer,
+the clients of each region and the management and crypto endpoints of each
+vault (one get_vault call per vault).  One signer is shared by every client,
+so its security token is fetched and refreshed once for the process instead
+of once per client.  The caches are safe to use from multiple threads and
+are kept per region, so several source and target regions can be replicated
+at the same time.
+'''
+import threading
+
+import oci
+
+from oci_instrumentation import instrument_client
+
+
+# client class of each client type
+CLIENT_TYPES = {
+  "kms_vault": oci.key_management.KmsVaultClient,
+  "kms_management": oci.key_management.KmsManagementClient,
+  "kms_crypto": oci.key_management.KmsCryptoClient,
+  "vaults": oci.vault.VaultsClient,
+  "secrets": oci.secrets.SecretsClient,
+}
+
+_signer = None
+# user principal config and client type -> endpoint used for every region, see configure()
+_config = None
+_service_endpoints = {}
+_clients = {}
+_vault_endpoints = {}
+_lock = threading.Lock()
+# one lock per cache entry, so a slow build (token fetch, get_vault) only
+# blocks the threads that need the same entry
+_entry_locks = {}
+
+
+def _cached(cache, key, build):
+  value = cache.get(key)
+  if value is not None:
+    return value
+  with _lock:
+    entry_lock = _entry_locks.setdefault((id(cache), key), threading.Lock())
+  with entry_lock:
+    value = cache.get(key)
+    if value is None:
+      value = build()
+      cache[key] = value
+  return value
+
+
+def configure(config=None, service_endpoints=None):
+  '''
+  Replaces instance principals and the regional service endpoints, for example to run with
+  a user principal or against oci_fake_server.py. Clears the cached clients.
+  KWARGS
+    config(dict) - OCI config used by every client instead of instance principals,
+                   the region is set per client
+    service_endpoints(dict) - client type -> endpoint used for every region
+  '''
+  global _config
+  with _lock:
+    _config = config
+    _service_endpoints.clear()
+    _service_endpoints.update(service_endpoints or {})
+    _clients.clear()
+    _vault_endpoints.clear()
+    _entry_locks.clear()
+
+
+def get_signer():
+  '''
+  Returns the instance principals signer shared by every client, created on first use
+  '''
+  global _signer
+  if _signer is None:
+    with _lock:
+      if _signer is None:
+        _signer = oci.auth.signers.InstancePrincipalsSecurityTokenSigner()
+  return _signer
+
+
+def get_client(client_type, region, service_endpoint=None):
+  '''
+  Gets a client, building it on first use
+  REQUIRES:
+    client_type(str) - type of client to get
+                       Options:
+                          kms_vault
+                          kms_management
+                          kms_crypto
+                          vaults
+                          secrets
+    region(str) - region of the client
+  KWARGS
+    service_endpoint(str) - endpoint of the client, needed by kms_management and kms_crypto
+  RETURNS:
+    the cached client for the client type, region and endpoint
+  '''
+  if client_type not in CLIENT_TYPES:
+    raise Exception(str(client_type) + " is not a valid client type")
+
+  service_endpoint = service_endpoint or _service_endpoints.get(client_type)
+
+  def build():
+    if _config is not None:
+      config, kwargs = dict(_config, region=region), {}
+    else:
+      config, kwargs = {"region": region}, {"signer": get_signer()}
+    if service_endpoint:
+      kwargs["service_endpoint"] = service_endpoint
+    # per-call timings are recorded when OCI_CALL_TRACE or OCI_CALL_METRICS is set (see oci_instrumentation.py)
+    return instrument_client(CLIENT_TYPES[client_type](config, **kwargs))
+
+  return _cached(_clients, (client_type, region, service_endpoint), build)
+
+
+def get_vault_endpoints(region, vault_id):
+  '''
+  Gets the endpoints of a vault, looked up once per vault
+  REQUIRES:
+    region(str) - region of the vault
+    vault_id(str) - OCID of the vault
+  RETURNS:
+    (management_endpoint, crypto_endpoint)
+  '''
+  def build():
+    vault = get_client("kms_vault", region).get_vault(vault_id).data
+    return vault.management_endpoint, vault.crypto_endpoint
+
+  return _cached(_vault_endpoints, (region, vault_id), build)
+
+
+def get_kms_management_client(region, vault_id):
+  '''
+  Gets the key management client of a vault
+  '''
+  return get_client("kms_management", region, get_vault_endpoints(region, vault_id)[0])
+
+
+def get_kms_crypto_client(region, vault_id):
+  '''
+  Gets the crypto client of a vault
+  '''
+  return get_client("kms_crypto", region, get_vault_endpoints(region, vault_id)[1])
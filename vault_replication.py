@@ -0,0 +1,213 @@
+'''
+Replicates the keys and secrets of many vaults at once.
+The manifest is a JSON file listing the source and target of every vault pair:
+  {
+    "pairs": [
+      {
+        "name": "payments-phx",
+        "source": {"region": "us-phoenix-1", "compartment": "ocid1.compartment.oc1..", "vault": "ocid1.vault.oc1.phx.."},
+        "target": {"region": "us-ashburn-1", "compartment": "ocid1.compartment.oc1..", "vault": "ocid1.vault.oc1.iad..", "key": "ocid1.key.oc1.iad.."},
+        "keys": true,
+        "secrets": true
+      }
+    ]
+  }
+"keys" and "secrets" default to true; the target "key" is only needed to replicate secrets.
+Every key and secret replication of every pair runs at the same time, limited to region_concurrency
+replications per region (a replication counts against its source and its target region). The clients
+are shared by all the replications of a region (see vault_clients.py), and so are the rate limits: the
+KMS exports, KMS imports, secret reads and secret writes of a region are limited to the rates of
+simple_key_backup.py and simple_secret_backup.py however many pairs use the region. Every pair gets its own
+state and journal files in state_dir, so an interrupted run resumes per pair.
+Usage:
+  python vault_replication.py manifest.json --region-concurrency 4 --report report.json
+'''
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+import concurrent.futures
+
+from oci_retry import RateLimiter
+from replication_job import FAILED
+from simple_key_backup import KeyBackup, export_rate, import_rate
+from simple_secret_backup import SecretBackup, source_read_rate, target_read_rate, write_rate
+
+###################################################
+#### Setup Required Config
+###################################################
+# replications running at the same time against one region
+region_concurrency=4
+
+# where the incremental state and the journals of the pairs are kept
+state_dir="replication_state"
+
+
+def read_manifest(manifest_file):
+  '''
+  Reads the manifest
+  REQUIRES:
+    manifest_file(str) - location of the manifest
+  RETURNS:
+    list of pairs, every pair with a unique "name"
+  '''
+  with open(manifest_file) as f:
+    pairs=json.load(f)["pairs"]
+  names=set()
+  for index, pair in enumerate(pairs):
+    for side in ("source", "target"):
+      for field in ("region", "compartment", "vault"):
+        if not pair.get(side, {}).get(field):
+          raise Exception("pair " + str(index) + " has no " + side + " " + field)
+    if pair.get("secrets", True) and not pair["target"].get("key"):
+      raise Exception("pair " + str(index) + " has no target key to replicate secrets with")
+    pair.setdefault("name", pair["source"]["vault"] + "-" + pair["target"]["vault"])
+    if pair["name"] in names:
+      raise Exception("pair name " + pair["name"] + " is used twice")
+    names.add(pair["name"])
+  return pairs
+
+
+class ReplicationOrchestrator(object):
+  '''
+  Runs the key and secret replication of every pair of a manifest concurrently
+  REQUIRES:
+    pairs(list) - pairs as returned by read_manifest
+  KWARGS
+    region_concurrency(int) - replications running at the same time against one region
+    state_dir(str) - where the incremental state and the journals of the pairs are kept
+    fresh(bool) - start every pair over instead of resuming an interrupted run
+  '''
+
+  def __init__(self, pairs, region_concurrency=region_concurrency, state_dir=state_dir, fresh=False):
+    self.pairs=pairs
+    self.fresh=fresh
+    self.region_concurrency=region_concurrency
+    self.state_dir=state_dir
+    self._region_slots={}
+    self._limiters={}
+    self._lock=threading.Lock()
+
+  def _region_slot(self, region):
+    with self._lock:
+      return self._region_slots.setdefault(region, threading.Semaphore(self.region_concurrency))
+
+  def _limiter(self, region, calls, rate):
+    # one rate limit per region and kind of call, shared by every pair using the region
+    with self._lock:
+      return self._limiters.setdefault((region, calls), RateLimiter(rate))
+
+  def _state_file(self, pair, name):
+    # keep the file names safe whatever the pair is called
+    return os.path.join(self.state_dir, re.sub(r"[^A-Za-z0-9_.-]", "_", pair["name"]) + "." + name)
+
+  def _replication(self, pair, kind):
+    source=pair["source"]
+    target=pair["target"]
+    if kind=="keys":
+      return KeyBackup(source["region"], source["compartment"], source["vault"],
+                       target["region"], target["compartment"], target["vault"],
+                       state_file=self._state_file(pair, "key_state.json"),
+                       journal_file=self._state_file(pair, "key_journal.jsonl"), fresh=self.fresh,
+                       export_limiter=self._limiter(source["region"], "kms_export", export_rate),
+                       import_limiter=self._limiter(target["region"], "kms_import", import_rate))
+    return SecretBackup(source["region"], source["compartment"], source["vault"],
+                        target["region"], target["compartment"], target["vault"], target["key"],
+                        journal_file=self._state_file(pair, "secret_journal.jsonl"), fresh=self.fresh,
+                        source_read_limiter=self._limiter(source["region"], "secret_reads", source_read_rate),
+                        target_read_limiter=self._limiter(target["region"], "secret_reads", target_read_rate),
+                        write_limiter=self._limiter(target["region"], "secret_writes", write_rate))
+
+  def _run_one(self, pair, kind, dry_run):
+    result={"pair":pair["name"], "kind":kind, "planned":{}, "outcomes":{}, "failures":[], "error":None}
+    # take the slots of both regions, always in the same order so two
+    # replications in opposite directions cannot wait on each other
+    slots=[self._region_slot(region) for region in sorted({pair["source"]["region"], pair["target"]["region"]})]
+    for slot in slots:
+      slot.acquire()
+    start=time.perf_counter()
+    try:
+      job=self._replication(pair, kind).run(dry_run=dry_run)
+      for item in job.plan:
+        result["planned"][item.action]=result["planned"].get(item.action, 0) + 1
+      for outcome, items in job.summary().items():
+        result["outcomes"][outcome]=len(items)
+      result["failures"]=[{"id":item_id, "name":name, "reason":reason} for item_id, name, reason in job.summary().get(FAILED, [])]
+      result["estimated_calls"]=job.estimated_calls()
+    except Exception as e:
+      result["error"]=str(e)
+    finally:
+      for slot in reversed(slots):
+        slot.release()
+    result["seconds"]=round(time.perf_counter() - start, 3)
+    return result
+
+  def run(self, dry_run=False):
+    '''
+    Runs every replication of the manifest
+    KWARGS
+      dry_run(bool) - only plan, print the plan of every replication
+    RETURNS:
+      report(dict) - {"dry_run": dry_run, "results": [one result per pair and kind], "seconds": elapsed}
+    '''
+    os.makedirs(self.state_dir, exist_ok=True)
+    tasks=[(pair, kind) for pair in self.pairs for kind in ("keys", "secrets") if pair.get(kind, True)]
+    start=time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(tasks))) as pool:
+      futures=[pool.submit(self._run_one, pair, kind, dry_run) for pair, kind in tasks]
+      results=[future.result() for future in futures]
+    return {"dry_run":dry_run, "results":results, "seconds":round(time.perf_counter() - start, 3)}
+
+
+###################################################
+#### Report
+###################################################
+def print_report(report):
+  totals={}
+  failed=0
+  for result in report["results"]:
+    counts=", ".join(outcome + " " + str(count) for outcome, count in sorted(result["outcomes"].items()))
+    planned=", ".join(action + " " + str(count) for action, count in sorted(result["planned"].items()))
+    if result["error"]:
+      failed+=1
+      print(result["pair"] + " " + result["kind"] + ": ERROR " + result["error"])
+    elif report["dry_run"]:
+      print(result["pair"] + " " + result["kind"] + ": plan " + (planned or "empty") + ", at most " + str(result["estimated_calls"]) + " API calls")
+    else:
+      print(result["pair"] + " " + result["kind"] + ": " + (counts or "nothing to replicate") + " (" + str(result["seconds"]) + "s)")
+    for failure in result["failures"]:
+      print("  failed " + str(failure["name"]) + " " + failure["id"] + ": " + str(failure["reason"]))
+    for outcome, count in result["outcomes"].items():
+      totals[outcome]=totals.get(outcome, 0) + count
+  if report["dry_run"]:
+    print("Planned " + str(len(report["results"]) - failed) + " of " + str(len(report["results"])) + " vault jobs, at most "
+          + str(sum(result.get("estimated_calls", 0) for result in report["results"])) + " API calls")
+    return
+  print("Replicated " + str(len(report["results"]) - failed) + " of " + str(len(report["results"])) + " vault jobs in " + str(report["seconds"]) + "s: "
+        + ", ".join(outcome + " " + str(count) for outcome, count in sorted(totals.items())))
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Replicate the keys and secrets of the vault pairs of a manifest")
+  parser.add_argument("manifest", help="JSON file listing the source and target of every vault pair")
+  parser.add_argument("--region-concurrency", type=int, default=region_concurrency, help="replications running at the same time against one region")
+  parser.add_argument("--state-dir", default=state_dir, help="where the state and journal files of the pairs are kept")
+  parser.add_argument("--report", help="also write the report to this JSON file")
+  parser.add_argument("--dry-run", action="store_true", help="print the plan and the estimated API calls of every pair only")
+  parser.add_argument("--fresh", action="store_true", help="start every pair over instead of resuming an interrupted run")
+  args = parser.parse_args(argv)
+
+  orchestrator=ReplicationOrchestrator(read_manifest(args.manifest), region_concurrency=args.region_concurrency, state_dir=args.state_dir, fresh=args.fresh)
+  report=orchestrator.run(dry_run=args.dry_run)
+  print_report(report)
+  if args.report:
+    with open(args.report, "w") as f:
+      json.dump(report, f, indent=1)
+  return 1 if any(result["error"] or result["failures"] for result in report["results"]) else 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())